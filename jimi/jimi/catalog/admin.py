@@ -6,6 +6,7 @@ from jimi.catalog.models import Node, Product, Category, Variance, Variant
 class NodeAdmin(MPTTModelAdmin):
     list_display = ('name', 'supplier', 'created', 'updated',)
     list_display_links = ('name',)
+    list_filter = ('_effective_supplier',)
     list_per_page = 20
     ordering = ['name']
     search_fields = ['name',
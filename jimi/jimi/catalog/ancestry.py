@@ -0,0 +1,85 @@
+"""
+Request-scoped cache of the ancestor chains of catalog nodes.
+
+Breadcrumbs and variation URLs need the ancestors of a node, often of the
+same path several times while rendering one page. Within a request every
+chain is loaded once and shared with all nodes it passes through, as the
+chain of an ancestor is a prefix of it. Chains of many nodes are loaded
+together with load(). Outside of requests chains are only kept on the
+instances they were loaded for. Saving or deleting a node drops the chains
+of the request.
+"""
+import operator
+import threading
+from django.core.signals import request_started, request_finished
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from jimi.catalog.models import Node
+
+BATCH_SIZE = 500  # Nodes per query, keeping the condition within SQLite's limits
+
+_state = threading.local()
+
+
+@receiver(request_started)
+def start(**kwargs):
+    """Share the chains loaded in this thread until the request finished."""
+    _state.chains = {}
+
+
+@receiver(request_finished)
+def finish(**kwargs):
+    _state.chains = None
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def forget(sender, **kwargs):
+    chains = getattr(_state, "chains", None)
+    if chains and issubclass(sender, Node):
+        chains.clear()
+
+
+def get(node):
+    """Ancestors of a node from the root. The list must not be changed."""
+    if getattr(node, "_ancestor_chain", None) is None:
+        load([node])
+    return node._ancestor_chain
+
+
+def load(nodes):
+    """Load the ancestor chains of many nodes, with one query per BATCH_SIZE of them."""
+    chains = getattr(_state, "chains", None)
+    missing = []
+    for node in nodes:
+        if getattr(node, "_ancestor_chain", None) is not None:
+            continue
+        if node.parent_id is None:
+            node._ancestor_chain = []
+        elif node.pk is None:  # Not in the tree yet, only its parent is
+            parent = node.parent
+            node._ancestor_chain = get(parent) + [parent]
+        elif chains is not None and node.pk in chains:
+            node._ancestor_chain = chains[node.pk]
+        else:
+            missing.append(node)
+    for i in range(0, len(missing), BATCH_SIZE):
+        _load(missing[i:i + BATCH_SIZE], chains)
+
+
+def _load(nodes, chains):
+    condition = reduce(operator.or_, [Q(tree_id=node.tree_id, lft__lt=node.lft, rght__gt=node.rght)
+                                      for node in nodes])
+    trees = {}
+    for ancestor in Node.objects.filter(condition):  # In tree order
+        path = trees.setdefault(ancestor.tree_id, [])
+        chain = [a for a in path if a.rght > ancestor.rght]
+        ancestor._ancestor_chain = chains and chains.get(ancestor.pk) or chain
+        path.append(ancestor)
+    for node in nodes:
+        node._ancestor_chain = [a for a in trees.get(node.tree_id, ())
+                                if a.lft < node.lft and a.rght > node.rght]
+    if chains is not None:
+        for node in nodes + [a for path in trees.values() for a in path]:
+            chains.setdefault(node.pk, node._ancestor_chain)
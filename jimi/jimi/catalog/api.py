@@ -0,0 +1,201 @@
+"""
+Read-only JSON API of the catalog for headless frontends.
+
+Lists are paginated by keyset: a page holds the nodes following the
+(tree_id, lft) of the cursor it was asked for, so the database never skips
+over rows and deep pages cost the same as the first one. Each page is a
+single query reading only the columns of the requested fields; price,
+stock and supplier come from the derived columns of every row.
+
+Fields are chosen with ``fields=slug,name,price``, teaser and description
+are only returned when asked for. The variation matrix of a product is
+returned whole, see jimi.catalog.matrix.
+"""
+import json
+from django.core.urlresolvers import reverse
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
+from jimi.catalog import matrix as matrices
+from jimi.catalog.models import Node
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+DEFAULT_FIELDS = ("slug", "name", "kind", "parent", "url", "price", "stock",
+                  "available", "supplier")
+
+
+def _money(money):
+    return money and {"amount": str(money.amount), "currency": str(money.currency)}
+
+
+def _price(row):
+    return _money(Node._meta.get_field("_effective_price").money(row["_effective_price"],
+                                                                 row["_effective_price_currency"]))
+
+
+def _url(row):
+    slug = row["kind"] == Node.VARIATION and row["parent__slug"] or row["slug"]
+    return reverse("node", kwargs={"slug": slug})
+
+
+# Field name -> (columns read, function of the row returning the value)
+FIELDS = {
+    "id": (("pk",), lambda row: row["pk"]),
+    "slug": (("slug",), lambda row: row["slug"]),
+    "name": (("name",), lambda row: row["name"]),
+    "kind": (("kind",), lambda row: row["kind"]),
+    "parent": (("parent__slug",), lambda row: row["parent__slug"]),
+    "url": (("kind", "slug", "parent__slug"), _url),
+    "price": (("_effective_price", "_effective_price_currency"), _price),
+    "stock": (("_stock_total",), lambda row: row["_stock_total"]),
+    "available": (("_stock_total", "_pending_customer_total"),
+                  lambda row: row["_stock_total"] - row["_pending_customer_total"]),
+    "supplier": (("_effective_supplier",), lambda row: row["_effective_supplier"] or None),
+    "active": (("active",), lambda row: row["active"]),
+    "updated": (("updated",), lambda row: row["updated"].isoformat()),
+    "teaser": (("teaser",), lambda row: row["teaser"]),
+    "description": (("description",), lambda row: row["description"]),
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _json(data, status=200):
+    return HttpResponse(json.dumps(data), content_type="application/json", status=status)
+
+
+def api_view(view):
+    """Turn BadRequest into a 400 response with the message as JSON."""
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except BadRequest, e:
+            return HttpResponseBadRequest(json.dumps({"error": str(e)}),
+                                          content_type="application/json")
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
+
+
+def requested_fields(request):
+    names = request.GET.get("fields")
+    names = names and names.split(",") or DEFAULT_FIELDS
+    unknown = [name for name in names if name not in FIELDS]
+    if unknown:
+        raise BadRequest("Unknown fields: %s" % ", ".join(unknown))
+    return names
+
+
+def serialize(rows, names):
+    return [dict((name, FIELDS[name][1](row)) for name in names) for row in rows]
+
+
+def select(queryset, names, *extra):
+    """Values of the columns needed for the fields, and of ``extra``."""
+    columns = set(extra)
+    for name in names:
+        columns.update(FIELDS[name][0])
+    return queryset.values(*columns)
+
+
+def page(request, queryset):
+    """
+    One page of nodes in tree order, following the ``after`` cursor.
+
+    The cursor of the next page is "<tree_id>.<lft>" of the last node.
+    """
+    names = requested_fields(request)
+    try:
+        limit = min(int(request.GET.get("limit", DEFAULT_LIMIT)), MAX_LIMIT)
+        after = request.GET.get("after")
+        if after:
+            tree_id, lft = [int(value) for value in after.split(".")]
+            queryset = queryset.filter(Q(tree_id__gt=tree_id) | Q(tree_id=tree_id, lft__gt=lft))
+    except ValueError:
+        raise BadRequest("Invalid limit or cursor.")
+    if limit < 1:
+        raise BadRequest("Invalid limit or cursor.")
+    rows = list(select(queryset.order_by("tree_id", "lft"), names, "tree_id", "lft")[:limit + 1])
+    following = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        query = request.GET.copy()
+        query["after"] = "%d.%d" % (rows[-1]["tree_id"], rows[-1]["lft"])
+        following = request.build_absolute_uri("?" + query.urlencode())
+    return _json({"results": serialize(rows, names), "next": following})
+
+
+def _get_node(slug, *columns):
+    nodes = list(Node.objects.filter(slug=slug, active=True).values(*columns)[:1])
+    if not nodes:
+        raise Http404("No catalog node matches %s." % slug)
+    return nodes[0]
+
+
+@api_view
+def nodes(request):
+    """Active nodes in tree order, optionally of one ``kind``."""
+    queryset = Node.objects.filter(active=True)
+    if request.GET.get("kind"):
+        queryset = queryset.filter(kind=request.GET["kind"])
+    return page(request, queryset)
+
+
+@api_view
+def node(request, slug):
+    """A single active node."""
+    names = requested_fields(request)
+    rows = list(select(Node.objects.filter(slug=slug, active=True), names)[:1])
+    if not rows:
+        raise Http404("No catalog node matches %s." % slug)
+    return _json(serialize(rows, names)[0])
+
+
+@api_view
+def children(request, slug):
+    """Active children of a node in tree order."""
+    parent = _get_node(slug, "pk")
+    return page(request, Node.objects.filter(parent=parent["pk"], active=True))
+
+
+@api_view
+def variations(request, slug):
+    """Active variations of a product in tree order."""
+    product = _get_node(slug, "pk", "kind")
+    if product["kind"] != Node.PRODUCT:
+        raise Http404("%s is not a product." % slug)
+    return page(request, Node.objects.filter(parent=product["pk"], active=True,
+                                             kind=Node.VARIATION))
+
+
+@api_view
+def prices(request):
+    """Prices and stock of the nodes given as ``slug`` parameters, with one query."""
+    slugs = request.GET.getlist("slug")[:MAX_LIMIT]
+    names = ("price", "available")
+    rows = select(Node.objects.filter(slug__in=slugs, active=True), names, "slug")
+    return _json(dict((row["slug"], serialize([row], names)[0]) for row in rows))
+
+
+@api_view
+def matrix(request, slug):
+    """Variation matrix of an active product, see jimi.catalog.matrix."""
+    products = list(Node.objects.filter(slug=slug, active=True, kind=Node.PRODUCT)[:1])
+    if not products:
+        raise Http404("No catalog product matches %s." % slug)
+    m = matrices.build(products[0])
+    return _json({
+        "axes": [{"id": axis.variance.pk,
+                  "name": axis.name,
+                  "variants": [{"id": v.pk, "name": v.name} for v in axis.variants]}
+                 for axis in m.axes],
+        "cells": [{"slug": cell.slug,
+                   "name": cell.name,
+                   "variants": [v.pk for v in cell.variants],
+                   "available": cell.available,
+                   "price_delta": _money(cell.price_delta),
+                   "url": cell.url}
+                  for key, cell in sorted(m.cells.items())],
+        "unplaced": [v.slug for v in m.unplaced]})
@@ -0,0 +1,118 @@
+"""
+Validators for conditional GET requests to catalog pages.
+
+A product page shows its node, the ancestors it inherits price and
+supplier from and its variations, so the newest ``updated`` among those
+tells when it last changed. A category page also shows facets counting
+the active nodes of its whole subtree, and with variants selected it lists
+products from anywhere below, so its whole subtree is taken into account.
+Stock moves and variant changes do not touch ``updated``; they set a
+shared stock version instead, the time of the last such change, which is
+folded into every validator.
+
+ETags are also made from the versions the page cache keeps of the page,
+see jimi.catalog.pagecache, which move with every change shown on it,
+including deleted nodes that no longer have an ``updated``.
+"""
+import hashlib
+import time
+from datetime import datetime
+from django.core.cache import cache
+from django.db.models import Count, Max, Q
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.middleware.csrf import get_token
+from django.utils import timezone
+from jimi.catalog import lookup, pagecache
+from jimi.catalog.models import Node, Variant
+from jimi.catalog.signals import stock_changed
+from jimi.catalog.snapshot import get_snapshot
+
+STOCK_VERSION_KEY = "jimi.catalog.conditional.stock_version"
+STOCK_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def stock_version():
+    """Time of the last stock or variant change, as a timestamp."""
+    version = cache.get(STOCK_VERSION_KEY)
+    if version is None:  # Expired or evicted, assume it just happened
+        cache.add(STOCK_VERSION_KEY, time.time(), STOCK_VERSION_TIMEOUT)
+        version = cache.get(STOCK_VERSION_KEY)
+    return version
+
+
+@receiver(stock_changed)
+@receiver(m2m_changed, sender=Node.variant.through)
+@receiver(post_save, sender=Variant)
+@receiver(post_delete, sender=Variant)
+def bump_stock_version(sender, **kwargs):
+    cache.set(STOCK_VERSION_KEY, time.time(), STOCK_VERSION_TIMEOUT)
+
+
+def _validators(etag, last_modified, version):
+    """ETag and Last-Modified from the newest ``updated`` and the stock version."""
+    if last_modified is None:
+        return None
+    stock_modified = datetime.fromtimestamp(version, timezone.utc)
+    return (hashlib.md5("%s:%r:%s" % (last_modified.isoformat(), version, etag)).hexdigest(),
+            max(last_modified, stock_modified))
+
+
+def node_validators(request, slug):
+    """
+    ETag and Last-Modified of a node page, or None if the page cannot be
+    validated without rendering it.
+    """
+    if not hasattr(request, "_catalog_validators"):
+        request._catalog_validators = None
+        entry = lookup.resolve(slug)
+        snapshot = get_snapshot()
+        if entry is None or entry[2] not in snapshot:
+            return None
+        page = entry[2]
+        if snapshot.kind(page) == Node.PRODUCT:
+            # Product pages carry a form with the visitor's CSRF token and
+            # set a test cookie the first time they are shown
+            if not request.session.test_cookie_worked():
+                return None
+            etag = get_token(request)
+            shown = Q(pk__in=snapshot.ancestors(page, include_self=True) + snapshot.children(page))
+        else:
+            etag = request.GET.urlencode()
+            i = snapshot.position(page)
+            shown = (Q(pk__in=snapshot.ancestors(page)) |
+                     Q(tree_id=snapshot.tree_ids[i], lft__gte=snapshot.lfts[i], lft__lte=snapshot.rghts[i]))
+        names = pagecache.dependencies(page) + [pagecache.VARIANTS]
+        etag = "%s:%s:%s:%s" % (page, names, pagecache.versions(names), etag)
+        last_modified = Node.objects.filter(shown).aggregate(Max("updated"))["updated__max"]
+        request._catalog_validators = _validators(etag, last_modified, stock_version())
+    return request._catalog_validators
+
+
+def node_etag(request, slug):
+    validators = node_validators(request, slug)
+    return validators and validators[0] or None
+
+
+def node_last_modified(request, slug):
+    validators = node_validators(request, slug)
+    return validators and validators[1] or None
+
+
+def categories_validators(request, slug=None):
+    if not hasattr(request, "_catalog_validators"):
+        categories = Node.objects.filter(kind=Node.CATEGORY).aggregate(Max("updated"), Count("pk"))
+        request._catalog_validators = _validators(categories["pk__count"],
+                                                  categories["updated__max"],
+                                                  stock_version())
+    return request._catalog_validators
+
+
+def categories_etag(request, slug=None):
+    validators = categories_validators(request, slug)
+    return validators and validators[0] or None
+
+
+def categories_last_modified(request, slug=None):
+    validators = categories_validators(request, slug)
+    return validators and validators[1] or None
@@ -0,0 +1,267 @@
+"""
+Variant facet index for filtering the catalog by size, colour and such.
+
+For every variant the index keeps the set of active nodes linked to it as
+a bitmap over the positions of the tree snapshot, held in a plain Python
+integer. Because the snapshot is in tree order, the nodes below a category
+are one contiguous run of bits, so filters and facet counts come down to a
+few bitwise operations instead of joins over the variant links.
+
+Variants of the same variance are alternatives (size 42 or 43), variants
+of different variances must all match (size 42 and red).
+
+Linking and unlinking variants and switching nodes or variants active is
+applied to the index of this process as it happens. Other processes
+rebuild theirs from the database; the index is rebuilt as well when the
+tree structure has changed.
+"""
+import threading
+import time
+from binascii import unhexlify
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from jimi.catalog.models import Node, Variant
+from jimi.catalog.snapshot import get_snapshot
+from jimi.routers import read_primary
+
+GENERATION_KEY = "jimi.catalog.facets.generation"
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+_lock = threading.Lock()
+_index = None
+
+
+# Character whose code is the number of set bits of each byte value.
+_BYTE_BITS = "".join(chr(bin(i).count("1")) for i in range(256))
+
+
+def bit_count(mask):
+    """Number of set bits of a mask, counted a byte at a time."""
+    digits = "%x" % mask
+    data = unhexlify(len(digits) % 2 and "0" + digits or digits).translate(_BYTE_BITS)
+    return sum(bits * data.count(chr(bits)) for bits in range(1, 9))
+
+
+def positions(mask):
+    """Positions of the set bits of a mask, in ascending order."""
+    bits = bin(mask)[:1:-1]
+    return [i for i, bit in enumerate(bits) if bit == "1"]
+
+
+class FacetIndex(object):
+    """Bitmaps of active nodes per variant over the positions of a TreeSnapshot."""
+    def __init__(self, snapshot, active, links, variants, generation=None):
+        self.snapshot = snapshot
+        self.generation = generation
+        self.variances = {}  # variant id -> variance id, active variants only
+        self.bits = {}  # variant id -> mask of linked nodes
+        self.active = 0
+        for variant_id, variance_id, variant_active in variants:
+            if variant_active:
+                self.variances[variant_id] = variance_id
+        for node_id in active:
+            if node_id in snapshot:
+                self.active |= 1 << snapshot.position(node_id)
+        for node_id, variant_id in links:
+            if node_id in snapshot:
+                self.bits[variant_id] = self.bits.get(variant_id, 0) | 1 << snapshot.position(node_id)
+
+    def subtree(self, node_id):
+        """Mask of a node and its descendants."""
+        i = self.snapshot.position(node_id)
+        return (1 << self.snapshot.ends[i]) - (1 << i)
+
+    def _selected(self, variant_ids, exclude_variance=None):
+        groups = {}
+        for variant_id in variant_ids:
+            variance_id = self.variances.get(variant_id)
+            if variance_id is not None and variance_id != exclude_variance:
+                groups[variance_id] = groups.get(variance_id, 0) | self.bits.get(variant_id, 0)
+        return groups.values()
+
+    def match(self, variant_ids=(), within=None):
+        """
+        Mask of the active nodes having the given variants, optionally
+        below the node ``within``.
+        """
+        mask = self.active
+        if within is not None:
+            mask &= self.subtree(within)
+        for group in self._selected(variant_ids):
+            mask &= group
+        return mask
+
+    def nodes(self, mask):
+        """Ids of the nodes in a mask, in tree order."""
+        ids = self.snapshot.ids
+        return [ids[i] for i in positions(mask)]
+
+    def products(self, mask):
+        """Ids of the products in a mask or having variations in it, in tree order."""
+        snapshot = self.snapshot
+        result = []
+        seen = set()
+        for i in positions(mask):
+            kind = snapshot.kinds[i]
+            if kind == Node.VARIATION:
+                node_id = snapshot.parents[i]
+            elif kind == Node.PRODUCT:
+                node_id = snapshot.ids[i]
+            else:
+                continue
+            if node_id not in seen:
+                seen.add(node_id)
+                result.append(node_id)
+        result.sort(key=snapshot.position)
+        return result
+
+    def counts(self, variant_ids=(), within=None):
+        """
+        Number of matching nodes for every variant, given the variants
+        already selected.
+
+        A variant is counted against the selection of the other variances
+        only, so its count is what selecting it as well would match.
+        """
+        base = self.active
+        if within is not None:
+            base &= self.subtree(within)
+        selected = {}
+        result = {}
+        for variant_id, variance_id in self.variances.iteritems():
+            if variance_id not in selected:
+                mask = base
+                for group in self._selected(variant_ids, exclude_variance=variance_id):
+                    mask &= group
+                selected[variance_id] = mask
+            count = bit_count(self.bits.get(variant_id, 0) & selected[variance_id])
+            if count:
+                result[variant_id] = count
+        return result
+
+    def link(self, node_id, variant_id, linked=True):
+        if node_id in self.snapshot:
+            bit = 1 << self.snapshot.position(node_id)
+            mask = self.bits.get(variant_id, 0)
+            self.bits[variant_id] = linked and mask | bit or mask & ~bit
+
+    def unlink_all(self, node_id=None, variant_id=None):
+        """Remove all links of a node or of a variant."""
+        if variant_id is not None:
+            self.bits.pop(variant_id, None)
+        elif node_id in self.snapshot:
+            bit = 1 << self.snapshot.position(node_id)
+            for variant_id in self.bits:
+                self.bits[variant_id] &= ~bit
+
+    def set_active(self, node_id, active):
+        if node_id in self.snapshot:
+            bit = 1 << self.snapshot.position(node_id)
+            self.active = active and self.active | bit or self.active & ~bit
+
+    def set_variant(self, variant_id, variance_id, active):
+        if active:
+            self.variances[variant_id] = variance_id
+        else:
+            self.variances.pop(variant_id, None)
+
+
+def build_index(snapshot, generation=None):
+    """Read active flags and variant links with three queries."""
+    active = Node.objects.filter(active=True).values_list('pk', flat=True)
+    links = Node.variant.through.objects.values_list('node', 'variant')
+    variants = Variant.objects.values_list('pk', 'variance', 'active')
+    with read_primary():
+        return FacetIndex(snapshot, active.iterator(), links.iterator(), variants.iterator(),
+                          generation)
+
+
+def current_generation():
+    """Generation of the variant links as seen by all processes sharing the cache."""
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, int(time.time() * 1000), GENERATION_TIMEOUT)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def get_index():
+    """Facet index of the catalog, rebuilt if it is outdated."""
+    global _index
+    snapshot = get_snapshot()
+    generation = current_generation()
+    with _lock:
+        index = _index
+        if index is not None and index.generation == generation and index.snapshot is not snapshot:
+            # Only structural changes move positions around
+            if index.snapshot.ids == snapshot.ids and index.snapshot.ends == snapshot.ends:
+                index.snapshot = snapshot
+        if index is None or index.generation != generation or index.snapshot is not snapshot:
+            index = _index = build_index(snapshot, generation)
+    return index
+
+
+def invalidate():
+    """Mark all facet indexes as outdated, e.g. after bulk changes to variant links."""
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, int(time.time() * 1000), GENERATION_TIMEOUT)
+
+
+def _update(apply):
+    """Apply a change to the index of this process and outdate the others."""
+    with _lock:
+        try:
+            generation = cache.incr(GENERATION_KEY)
+        except ValueError:
+            generation = None
+            cache.set(GENERATION_KEY, int(time.time() * 1000), GENERATION_TIMEOUT)
+        index = _index
+        if index is not None:
+            apply(index)
+            # Keep the index unless some other process changed things as well
+            if generation is not None and index.generation == generation - 1:
+                index.generation = generation
+
+
+@receiver(m2m_changed, sender=Node.variant.through)
+def update_links(sender, instance, action, reverse, pk_set, **kwargs):
+    """Follow variant links being added and removed."""
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    linked = action == "post_add"
+
+    def apply(index):
+        if action == "post_clear":
+            if reverse:
+                index.unlink_all(variant_id=instance.pk)
+            else:
+                index.unlink_all(node_id=instance.pk)
+        elif reverse:
+            for node_id in pk_set:
+                index.link(node_id, instance.pk, linked)
+        else:
+            for variant_id in pk_set:
+                index.link(instance.pk, variant_id, linked)
+    _update(apply)
+
+
+@receiver(post_save)
+def update_active(sender, instance, created=False, **kwargs):
+    """Follow nodes and variants being switched active or inactive."""
+    if issubclass(sender, Node):
+        _update(lambda index: index.set_active(instance.pk, instance.active))
+    elif sender is Variant:
+        _update(lambda index: index.set_variant(instance.pk, instance.variance_id,
+                                                instance.active))
+
+
+@receiver(post_delete, sender=Variant)
+def update_deleted(sender, instance, **kwargs):
+    """Forget variants being deleted."""
+    def apply(index):
+        index.set_variant(instance.pk, None, False)
+        index.unlink_all(variant_id=instance.pk)
+    _update(apply)
@@ -0,0 +1,98 @@
+"""
+In-process cache resolving URL slugs to catalog nodes.
+
+The node view only needs to know which node a slug stands for, what kind
+it is and which product page shows it. Those are kept for the most
+recently used slugs, so resolving a hot URL does not touch the database.
+Entries of a node are dropped when it is saved or deleted in this
+process. Changes made by other processes are not seen here, so entries
+have to be checked against the node read for them, see
+jimi.catalog.views._get_page_node().
+"""
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from jimi.catalog.models import Node
+from jimi.routers import read_primary
+
+
+class SlugCache(object):
+    """
+    Bounded mapping of slug to (node id, kind, product id), least recently
+    used entries are evicted first.
+
+    The product id is the node whose page is rendered for the slug: the
+    parent product for variations, the node itself otherwise.
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._slugs = {}  # node id -> slugs of entries mentioning it
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, slug):
+        with self._lock:
+            entry = self._entries.pop(slug, None)
+            if entry is not None:
+                self._entries[slug] = entry  # Most recently used goes last
+            return entry
+
+    def set(self, slug, entry):
+        with self._lock:
+            self._remove(slug)
+            self._entries[slug] = entry
+            for node_id in set((entry[0], entry[2])):
+                self._slugs.setdefault(node_id, set()).add(slug)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, node_id):
+        """Forget all entries of a node, or of the variations of a product."""
+        with self._lock:
+            for slug in list(self._slugs.get(node_id, ())):
+                self._remove(slug)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._slugs.clear()
+
+    def _remove(self, slug):
+        entry = self._entries.pop(slug, None)
+        if entry is None:
+            return
+        for node_id in set((entry[0], entry[2])):
+            slugs = self._slugs[node_id]
+            slugs.discard(slug)
+            if not slugs:
+                del self._slugs[node_id]
+
+
+slugs = SlugCache(getattr(settings, "CATALOG_SLUG_CACHE_SIZE", 1000))
+
+
+def resolve(slug):
+    """(node id, kind, product id) for a slug, or None if there is no such node."""
+    entry = slugs.get(slug)
+    if entry is None:
+        try:
+            with read_primary():
+                pk, kind, parent = Node.objects.values_list("pk", "kind", "parent").get(slug=slug)
+        except Node.DoesNotExist:
+            return None
+        entry = (pk, kind, kind == Node.VARIATION and parent or pk)
+        slugs.set(slug, entry)
+    return entry
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def discard_on_change(sender, instance, **kwargs):
+    """Drop cached slugs of a node that was saved or deleted."""
+    if issubclass(sender, Node):
+        slugs.discard(instance.pk)
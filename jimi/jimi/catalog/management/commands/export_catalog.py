@@ -0,0 +1,106 @@
+import csv
+import json
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from jimi.catalog.models import Node
+
+# Columns understood by import_catalog, followed by the derived values.
+COLUMNS = ("kind", "name", "slug", "parent", "price", "stock", "supplier", "active",
+           "teaser", "description", "meta_keywords", "meta_description", "variants",
+           "effective_price", "effective_supplier", "stock_total",
+           "pending_customer_total", "pending_supplier_total")
+FIELDS = ("pk", "tree_id", "lft", "kind", "name", "slug", "parent__slug", "_price",
+          "_stock", "_supplier", "active", "teaser", "description", "meta_keywords",
+          "meta_description", "_effective_price", "_effective_supplier", "_stock_total",
+          "_pending_customer_total", "_pending_supplier_total", "_price_currency",
+          "_effective_price_currency")
+
+
+def chunks(queryset, size):
+    """
+    Rows of FIELDS in tree order, one list of at most ``size`` at a time.
+
+    Every chunk is a separate query continuing after the (tree_id, lft) of
+    the last row seen, so the database never has to skip over rows and only
+    one chunk is held in memory.
+    """
+    queryset = queryset.order_by("tree_id", "lft").values_list(*FIELDS)
+    rows = list(queryset[:size])
+    while rows:
+        yield rows
+        tree_id, lft = rows[-1][1:3]
+        rows = list(queryset.filter(Q(tree_id__gt=tree_id) |
+                                    Q(tree_id=tree_id, lft__gt=lft))[:size])
+
+
+def variants(rows):
+    """Variant ids of the given rows, keyed by node id."""
+    result = {}
+    links = Node.variant.through.objects.filter(node__in=[row[0] for row in rows])
+    for node_id, variant_id in links.order_by("variant").values_list("node", "variant"):
+        result.setdefault(node_id, []).append(variant_id)
+    return result
+
+
+class Command(BaseCommand):
+    help = ("Export the catalog as CSV or JSON Lines in tree order.\n\n"
+            "Parents always come before their children, so the output can be\n"
+            "read back by import_catalog. Effective price and supplier and the\n"
+            "subtree totals are added after the imported columns.")
+    option_list = BaseCommand.option_list + (
+        make_option("--format",
+                    dest="format",
+                    choices=("csv", "jsonl"),
+                    default="csv",
+                    help="Output format."),
+        make_option("--output", "-o",
+                    dest="output",
+                    help="File to write to instead of standard output."),
+        make_option("--chunk-size",
+                    dest="chunk_size",
+                    type="int",
+                    default=1000,
+                    help="Number of nodes read at a time."),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError("Unexpected arguments: %s" % " ".join(args))
+        output = options.get("output")
+        f = output and open(output, "wb") or sys.stdout
+        try:
+            write = options.get("format") == "jsonl" and self.write_jsonl or self.write_csv
+            write(f, self.records(options.get("chunk_size") or 1000))
+        finally:
+            if output:
+                f.close()
+
+    def records(self, chunk_size):
+        price_field = Node._meta.get_field("_price")
+        effective_price_field = Node._meta.get_field("_effective_price")
+        for rows in chunks(Node.objects.all(), chunk_size):
+            links = variants(rows)
+            for row in rows:
+                record = dict(zip(COLUMNS, row[3:15] + (links.get(row[0], []),) + row[15:20]))
+                # Written the way import_catalog reads it, "SEK 12.00"
+                record["price"] = unicode(price_field.money(record["price"], row[20]) or "")
+                record["effective_price"] = unicode(
+                    effective_price_field.money(record["effective_price"], row[21]) or "")
+                for column in ("parent", "price", "effective_price"):
+                    record[column] = record[column] or ""
+                yield record
+
+    def write_csv(self, f, records):
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for record in records:
+            record["variants"] = "|".join(str(v) for v in record["variants"])
+            record["active"] = int(record["active"])
+            writer.writerow([unicode(record[c]).encode("utf-8") for c in COLUMNS])
+
+    def write_jsonl(self, f, records):
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True))
+            f.write("\n")
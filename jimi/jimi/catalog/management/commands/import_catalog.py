@@ -0,0 +1,171 @@
+import csv
+import json
+import time
+from optparse import make_option
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.template.defaultfilters import slugify
+from jimi.catalog.models import Node
+from jimi.catalog import facets, search, snapshot
+from jimi.catalog.signals import stock_changed
+from jimi.price.fields import Money
+
+KINDS = {"c": Node.CATEGORY, "category": Node.CATEGORY,
+         "p": Node.PRODUCT, "product": Node.PRODUCT,
+         "v": Node.VARIATION, "variation": Node.VARIATION}
+TEXT_FIELDS = ("teaser", "description", "meta_keywords", "meta_description")
+
+
+def read_csv(f):
+    for row in csv.DictReader(f):
+        yield dict((k, v.decode("utf-8")) for k, v in row.items() if v is not None)
+
+
+def read_jsonl(f):
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+class Command(BaseCommand):
+    args = "<file>"
+    help = ("Import categories, products and variations from CSV or JSON Lines.\n\n"
+            "Every row needs a name and may give kind (c, p or v), slug, parent\n"
+            "(slug of a node imported earlier or already in the catalog), price\n"
+            "(e.g. \"SEK 12.00\"), stock, supplier, active, teaser, description,\n"
+            "meta_keywords, meta_description and variants (Variant ids separated\n"
+            "by \"|\" in CSV, a list in JSON Lines). Rows are inserted in batches\n"
+            "and the tree is numbered once at the end.")
+    option_list = BaseCommand.option_list + (
+        make_option("--format",
+                    dest="format",
+                    choices=("csv", "jsonl"),
+                    help="Input format, guessed from the file name if omitted."),
+        make_option("--batch-size",
+                    dest="batch_size",
+                    type="int",
+                    default=1000,
+                    help="Number of rows inserted at a time."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: import_catalog %s" % self.args)
+        path = args[0]
+        fmt = options.get("format") or (path.endswith(".csv") and "csv" or "jsonl")
+        self.verbosity = int(options.get("verbosity", 1))
+        self.batch_size = options.get("batch_size") or 1000
+        start = time.time()
+        with open(path, "rb") as f:
+            count = self.import_rows(fmt == "csv" and read_csv(f) or read_jsonl(f))
+        snapshot.invalidate()
+        facets.invalidate()
+        # Nodes that were there before got new descendants
+        stock_changed.send(sender=Node, node_ids=list(self.existing_parents))
+        elapsed = max(time.time() - start, 0.001)
+        if self.verbosity > 0:
+            self.stdout.write("Imported %d catalog node(s) in %.1f s (%d rows/s).\n"
+                              % (count, elapsed, count / elapsed))
+
+    @transaction.commit_on_success
+    def import_rows(self, rows):
+        self.slugs = dict(Node.objects.values_list("slug", "pk"))
+        self.kinds = dict(Node.objects.values_list("pk", "kind"))
+        self.trees = dict(Node.objects.values_list("pk", "tree_id"))
+        self.slug_counters = {}
+        self.next_id = self.first_id = (Node.objects.aggregate(Max("pk"))["pk__max"] or 0) + 1
+        self.touched_trees = set([0])
+        self.existing_parents = set()
+        nodes, links = [], []
+        count = 0
+        start = time.time()
+        for line, row in enumerate(rows, 1):
+            try:
+                nodes.append(self.build_node(row, links))
+            except (KeyError, ValueError, ValidationError), e:
+                raise CommandError("Row %d: %s" % (line, e))
+            count += 1
+            if len(nodes) >= self.batch_size:
+                self.flush(nodes, links)
+                if self.verbosity > 1:
+                    self.stdout.write("%d rows (%d rows/s)\n"
+                                      % (count, count / max(time.time() - start, 0.001)))
+        self.flush(nodes, links)
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Node]):
+            cursor.execute(sql)
+        tree_ids = Node.objects.rebuild_tree_fields(self.touched_trees)
+        Node.objects.rebuild_derived(tree_ids)
+        search.index(Node.objects.filter(pk__gte=self.first_id))
+        return count
+
+    def build_node(self, row, links):
+        """Turn one input row into an unsaved Node with its id assigned."""
+        name = row["name"]
+        parent = row.get("parent") or None
+        if parent is not None:
+            if parent not in self.slugs:
+                raise ValueError("Unknown parent %s." % parent)
+            parent = self.slugs[parent]
+            if parent < self.first_id:
+                self.existing_parents.add(parent)
+        kind = row.get("kind")
+        if kind:
+            kind = KINDS[kind.lower()]
+        elif parent is not None and self.kinds[parent] == Node.PRODUCT:
+            kind = Node.VARIATION
+        else:
+            kind = Node.PRODUCT
+        slug = self.unique_slug(row.get("slug"), name)
+        price = row.get("price") or Money(0)
+        if not isinstance(price, Money):
+            price = Node._meta.get_field("_price").to_python(price)
+        active = row.get("active", True)
+        if not isinstance(active, bool):
+            active = active.lower() not in ("", "0", "false", "no")
+        node = Node(id=self.next_id,
+                    name=name,
+                    slug=slug,
+                    kind=kind,
+                    parent_id=parent,
+                    active=active,
+                    _supplier=row.get("supplier") or "",
+                    _price=price,
+                    _stock=int(row.get("stock") or 0),
+                    lft=0, rght=0, level=0, tree_id=0,
+                    **dict((f, row.get(f) or "") for f in TEXT_FIELDS))
+        variants = row.get("variants") or []
+        if not isinstance(variants, list):
+            variants = variants.split("|")
+        for variant in variants:
+            links.append(Node.variant.through(node_id=node.id, variant_id=int(variant)))
+        self.slugs[slug] = node.id
+        self.kinds[node.id] = kind
+        self.trees[node.id] = parent is not None and self.trees[parent] or 0
+        self.touched_trees.add(self.trees[node.id])
+        self.next_id += 1
+        return node
+
+    def unique_slug(self, slug, name):
+        """Slug given in the input, or one made unique from the name."""
+        if slug:
+            if slug in self.slugs or slug in Node.RESERVED_SLUGS:
+                raise ValueError("Slug %s is already taken." % slug)
+            return slug
+        base = slugify(name)[:120] or "node"
+        n = self.slug_counters.get(base, 1)
+        slug = base
+        while slug in self.slugs or slug in Node.RESERVED_SLUGS:
+            n += 1
+            slug = "%s-%d" % (base, n)
+        self.slug_counters[base] = n
+        return slug
+
+    def flush(self, nodes, links):
+        Node.objects.bulk_create(nodes)
+        Node.variant.through.objects.bulk_create(links)
+        del nodes[:]
+        del links[:]
@@ -0,0 +1,28 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from jimi.catalog.models import Node
+
+
+class Command(NoArgsCommand):
+    help = ("Recompute the derived columns of catalog nodes, e.g. after"
+            " bulk edits that bypassed Node.save().")
+    option_list = NoArgsCommand.option_list + (
+        make_option("--renumber",
+                    action="store_true",
+                    dest="renumber",
+                    default=False,
+                    help="Number all trees anew, with the gaps of CATALOG_TREE_GAP."),
+    )
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbose = int(options.get('verbosity', 1)) > 0
+        if options.get('renumber'):
+            trees = Node.objects.rebuild_tree_fields(
+                Node.objects.values_list('tree_id', flat=True).distinct())
+            if verbose:
+                self.stdout.write("Renumbered %d catalog tree(s).\n" % len(trees))
+        repaired = Node.objects.rebuild_derived()
+        if verbose:
+            self.stdout.write("Repaired %d catalog node(s).\n" % repaired)
@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+from jimi.catalog import search
+
+
+class Command(NoArgsCommand):
+    help = ("Rebuild the catalog search index, e.g. after bulk edits that"
+            " bypassed Node.save().")
+
+    def handle_noargs(self, **options):
+        indexed = search.index()
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Indexed %d catalog node(s).\n" % indexed)
@@ -0,0 +1,591 @@
+import json
+import operator
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import F, Max, Q
+from django.db.models.query import EmptyQuerySet
+from mptt.managers import TreeManager
+from jimi.price.fields import Money
+from jimi.price.managers import MoneyQuerySet
+from jimi.catalog.signals import stock_changed
+
+# Derived columns written by rebuild_derived(), in the order of its rows.
+DERIVED_FIELDS = ('_stock_total',
+                  '_pending_customer_total',
+                  '_pending_supplier_total',
+                  '_descendant_count',
+                  '_effective_price',
+                  '_effective_price_currency',
+                  '_effective_supplier',
+                  '_path')
+
+# Stock movements: signs applied to stock and pending_customer, and the
+# condition each line has to meet, with %(q)s for its quantity.
+RESERVE = (0, 1, "%(stock)s - %(pending)s >= %(q)s")
+RELEASE = (0, -1, "%(pending)s >= %(q)s")
+COMMIT = (-1, -1, "%(pending)s >= %(q)s")
+
+def encode_path(entries):
+    """Text stored as the path of a node with the given [id, slug, name] ancestors."""
+    return json.dumps(entries, separators=(',', ':'))
+
+
+MAX_TREE_VALUE = 2 ** 31 - 1  # Largest lft/rght an integer column holds
+
+
+def tree_gap():
+    """
+    Distance between the lft/rght values of renumbered trees.
+
+    Anything above 1 turns on gap numbering, see NodeManager.insert_node().
+    """
+    return getattr(settings, 'CATALOG_TREE_GAP', 0)
+
+
+class NodeQuerySet(MoneyQuerySet):
+    """QuerySet for catalog nodes."""
+
+    def with_aggregates(self):
+        """
+        Load nodes ready for listings, with a fixed number of queries.
+
+        Price, stock, available stock, in_stock and supplier are read from
+        the derived columns on each row, so the only thing left to fetch is
+        the parent that variation URLs are built from. It is joined in, and
+        the whole set costs a single query however many nodes it holds.
+        """
+        return self.select_related('parent')
+
+    def in_root_name_order(self):
+        """
+        List of the nodes in tree order, with the trees ordered by the name
+        of their first node, usually the root, as order_insertion_by
+        would. Tree ids follow the order the roots were created in
+        instead, see NodeManager.lock_trees().
+        """
+        trees = []
+        for node in self.order_by('tree_id', 'lft'):
+            if not trees or trees[-1][0].tree_id != node.tree_id:
+                trees.append([node])
+            else:
+                trees[-1].append(node)
+        trees.sort(key=lambda tree: tree[0].name)
+        return [node for tree in trees for node in tree]
+
+    def none(self):
+        return self._clone(klass=EmptyNodeQuerySet)
+
+
+class EmptyNodeQuerySet(EmptyQuerySet, NodeQuerySet):
+    """No nodes, e.g. the children of a leaf, with the methods of NodeQuerySet."""
+
+
+class NodeManager(TreeManager):
+    """
+    Tree manager for catalog nodes.
+
+    Besides the usual MPTT operations it knows how to repair the
+    derived columns kept on every node.
+    """
+
+    def get_queryset(self):
+        return NodeQuerySet(self.model, using=self._db).order_by(self.tree_id_attr,
+                                                                 self.left_attr)
+    get_query_set = get_queryset
+
+    def get_empty_query_set(self):
+        return EmptyNodeQuerySet(self.model, using=self._db)
+
+    def with_aggregates(self):
+        return self.get_queryset().with_aggregates()
+
+    def rebuild_derived(self, tree_ids=None):
+        """
+        Recompute the derived columns of all nodes, or of the given trees.
+
+        Subtree rollups and the number of descendants are summed up from
+        the descendants, effective price, supplier and the path are
+        inherited down from the ancestors. The whole catalog is walked once in tree order and only rows whose stored
+        values are off get written. Returns the number of rows that were
+        repaired.
+        """
+        price_field = self.model._meta.get_field('_price')
+        to_money = self.model._meta.get_field('_effective_price').money
+        rows = self.get_query_set()
+        if tree_ids is not None:
+            rows = rows.filter(tree_id__in=list(tree_ids))
+        rows = rows.values_list('pk', 'level',
+                                '_stock',
+                                '_pending_customer',
+                                '_pending_supplier',
+                                '_price',
+                                '_price_currency',
+                                '_supplier',
+                                'slug',
+                                'name',
+                                *DERIVED_FIELDS)
+        updates = []
+        # [pk, level, totals, price, supplier, path, stored values] of open ancestors
+        stack = []
+
+        def close(entry):
+            pk, level, totals, price, supplier, path, stored = entry
+            path = encode_path(path[:-1])
+            if (totals != stored[:4] or price != to_money(stored[4], stored[5]) or
+                    supplier != stored[6] or path != stored[7]):
+                updates.append(totals + [price.amount, price.currency.code, supplier, path, pk])
+            if stack:
+                parent_totals = stack[-1][2]
+                for i in range(3):
+                    parent_totals[i] += totals[i]
+                parent_totals[3] += totals[3] + 1
+
+        for row in rows.iterator():
+            pk, level, stock, pcust, psupp, price, currency, supplier, slug, name = row[:10]
+            while stack and stack[-1][1] >= level:
+                close(stack.pop())
+            price = price_field.money(price, currency) or Money(0)
+            path = [[pk, slug, name]]
+            if stack:
+                price += stack[-1][3]
+                supplier = supplier or stack[-1][4]
+                path = stack[-1][5] + path
+            stack.append([pk, level, [stock, pcust, psupp, 0], price, supplier, path,
+                          list(row[10:])])
+        while stack:
+            close(stack.pop())
+        self._update_rows(DERIVED_FIELDS, updates)
+        return len(updates)
+
+    def lock_trees(self, tree_ids):
+        """
+        Lock trees against concurrent structural writes until the end of
+        the transaction. Returns the sorted tree ids.
+
+        Locking protocol: a tree is locked by locking the row of its root
+        with SELECT ... FOR UPDATE. Every write changing lft, rght, level,
+        tree_id or the derived columns of a tree holds the lock of that
+        tree, so writes to one tree are serialized while writes to other
+        trees go on in parallel. Writes spanning several trees lock all of
+        them at once in ascending order of tree id, which keeps writers
+        from deadlocking. A writer creating a tree locks the root of the
+        last tree to take the following id, see _get_next_tree_id(); as
+        that tree has the highest id, this lock comes last as well. Tree
+        ids of existing trees are never shifted, new roots are added as
+        the last tree whatever their name. Listings of several trees put
+        them in order of their root names themselves, see
+        NodeQuerySet.in_root_name_order().
+
+        Node.save(), Node.delete() and move_node() follow the protocol in a
+        transaction of their own unless one is already managed, see
+        tree_lock(). Stock
+        movements lock the trees of the moved nodes as well, so the subtree
+        totals they add to go by positions that cannot change meanwhile;
+        the counters themselves are changed by atomic conditional updates.
+        On backends without SELECT ... FOR UPDATE, like SQLite, the roots
+        are written to instead, which locks the whole database there.
+        """
+        tree_ids = sorted(set(tree_ids))
+        if not tree_ids:
+            return tree_ids
+        roots = self._on_write_db().filter(parent=None, tree_id__in=tree_ids)
+        if self._get_connection().features.has_select_for_update:
+            list(roots.select_for_update().order_by('tree_id').values_list('pk', flat=True))
+        else:  # Writing takes the lock of the whole database
+            roots.update(tree_id=F('tree_id'))
+        return tree_ids
+
+    @contextmanager
+    def tree_lock(self, *pks):
+        """
+        Hold the locks of the trees of some nodes while running a block,
+        see lock_trees(). The block runs in a transaction that is committed
+        at its end, unless one is already managed.
+
+        Yields the (tree_id, lft, rght, level) of each node by id, as read
+        once the trees are locked.
+        """
+        using = self._db or router.db_for_write(self.model)
+        if transaction.is_managed(using=using):
+            yield self._lock_trees_of(pks)
+        else:
+            with transaction.commit_on_success(using=using):
+                yield self._lock_trees_of(pks)
+
+    def _lock_trees_of(self, pks):
+        pks = [pk for pk in pks if pk is not None]
+        locked = []
+        while pks:
+            rows = self._on_write_db().filter(pk__in=pks).values_list(
+                'pk', 'tree_id', 'lft', 'rght', 'level')
+            current = dict((row[0], row[1:]) for row in rows)
+            tree_ids = set(row[0] for row in current.values())
+            if tree_ids.issubset(locked):
+                return current
+            # Read before the lock, or a node moved to another tree while waiting
+            locked = self.lock_trees(tree_ids.union(locked))
+        return {}
+
+    def _on_write_db(self):
+        return self.using(self._db or router.db_for_write(self.model))
+
+    def _get_connection(self, **hints):
+        if self._db:  # Of db_manager(), rather than the router's choice
+            return connections[self._db]
+        return super(NodeManager, self)._get_connection(**hints)
+
+    def _get_next_tree_id(self):
+        """
+        Id for a new tree, following the last one. The root of the last
+        tree stays locked until the end of the transaction, so concurrent
+        writers cannot take the same id.
+        """
+        last = 0
+        while True:
+            roots = self._on_write_db().filter(parent=None, tree_id__gte=last)
+            ids = list(roots.order_by('-tree_id').values_list('tree_id', flat=True)[:1])
+            if not ids or ids[0] == last:
+                return last + 1
+            # Trees created while waiting for the lock show up in the next round
+            last = self.lock_trees(ids)[0]
+
+    def rebuild_tree_fields(self, tree_ids):
+        """
+        Recompute lft, rght, level and tree_id of whole trees in one pass.
+
+        Unlike ``rebuild()`` this reads the given trees with a single query
+        and numbers them in memory, which makes it suitable for large bulk
+        inserts. Nodes that are not numbered yet are expected in tree 0;
+        they are attached to the tree of their parent, or become new trees
+        after the existing ones if they have none. Children are ordered
+        like ``MPTTMeta.order_insertion_by`` would. The trees are locked,
+        see lock_trees(). Returns the ids of all trees that were numbered.
+        """
+        tree_ids = self.lock_trees(tree_ids)
+        order_by = self.model._mptt_meta.order_insertion_by
+        rows = list(self.get_query_set().filter(tree_id__in=list(tree_ids)).values_list(
+            'pk', 'parent', 'tree_id', 'lft', 'rght', 'level', *order_by))
+        # Leave tree_gap() - 1 numbers free after every value
+        step = max(1, min(tree_gap(), MAX_TREE_VALUE // (2 * len(rows) + 1)))
+        children = {}
+        nodes = {}
+        for row in rows:
+            nodes[row[0]] = row
+            children.setdefault(row[1], []).append(row)
+        for siblings in children.values():
+            siblings.sort(key=lambda row: tuple(row[6:]) + (row[3], row[0]))
+        roots = children.pop(None, [])
+        if [row for row in roots if row[2] == 0]:
+            next_tree_id = self._get_next_tree_id()
+        trees = []
+        for root in sorted(roots, key=lambda row: (row[2] == 0, row[2])):
+            if root[2] == 0:
+                root = (root[0], None, next_tree_id) + root[3:]
+                next_tree_id += 1
+            trees.append(root)
+        updates = []
+        for root in trees:
+            tree_id = root[2]
+            counter = step
+            stack = [(root, 0, iter(children.get(root[0], ())))]
+            lefts = {root[0]: counter}
+            while stack:
+                node, level, remaining = stack[-1]
+                child = next(remaining, None)
+                counter += step
+                if child is not None:
+                    lefts[child[0]] = counter
+                    stack.append((child, level + 1, iter(children.get(child[0], ()))))
+                    continue
+                stack.pop()
+                pk = node[0]
+                values = [lefts.pop(pk), counter, level, tree_id]
+                if values != [nodes[pk][3], nodes[pk][4], nodes[pk][5], nodes[pk][2]]:
+                    updates.append(values + [pk])
+        self._update_rows(('lft', 'rght', 'level', 'tree_id'), updates)
+        return [root[2] for root in trees]
+
+    def insert_node(self, node, target, position='last-child', save=False, allow_existing_pk=False):
+        """
+        Set up the tree fields of a new node, see TreeManager.insert_node().
+
+        With gap numbering (CATALOG_TREE_GAP above 1) a new child takes the
+        middle third of the free numbers between its neighbours, so nothing
+        but the new row is written. Only once a gap has run out is the tree
+        renumbered, leaving gaps everywhere again. A gap of g takes about
+        log3(g) inserts at the same spot.
+
+        New roots always become the last tree, see lock_trees().
+        """
+        if self._base_manager:
+            return self._base_manager.insert_node(node, target, position=position, save=save,
+                                                  allow_existing_pk=allow_existing_pk)
+        if target is not None and target.parent_id is None and position in ('left', 'right'):
+            target = None  # Rather than shifting the ids of the following trees
+        if tree_gap() <= 1 or target is None or not (
+                position == 'last-child' or position == 'left' and target.parent_id is not None):
+            node = super(NodeManager, self).insert_node(node, target, position, save=False,
+                                                        allow_existing_pk=allow_existing_pk)
+            if tree_gap() > 1 and node.parent_id is None:  # Leave room for children
+                node.lft, node.rght = tree_gap(), 2 * tree_gap()
+        else:
+            parent_id, right_id = position == 'left' and (target.parent_id, target.pk) or (target.pk, None)
+            tree_id, level, a, b = self._free_numbers(parent_id, right_id)
+            node.lft = a + (b - a) // 3
+            node.rght = a + 2 * (b - a) // 3
+            node.level = level
+            node.tree_id = tree_id
+            node.parent_id = parent_id
+        if save:
+            node.save()
+        return node
+
+    def move_node(self, node, target, position='last-child'):
+        """
+        Move a node and its subtree, see TreeManager.move_node().
+
+        The node is saved at its new place, which keeps the derived
+        columns in sync as saving it with a new parent does: the subtree
+        totals go from the old ancestors to the new ones, inherited price
+        and supplier and the path are cascaded down the subtree. The trees
+        of the node and the target are locked, see lock_trees().
+        """
+        if self._base_manager:
+            return self._base_manager.move_node(node, target, position=position)
+        node._save_locked((target, position), using=self._db)
+
+    def _move_node(self, node, target, position='last-child', save=True):
+        """
+        Move a node and its subtree, see TreeManager.move_node().
+
+        With gap numbering, non-root nodes moving below another node are
+        placed into the free numbers there if their subtree fits, so only
+        the moved rows are written. Nodes moving next to a root become the
+        last tree, roots stay where they are.
+        """
+        if self._base_manager:
+            return self._base_manager._move_node(node, target, position=position, save=save)
+        if target is not None and target.parent_id is None and position in ('left', 'right'):
+            target = None  # Rather than shifting the ids of the trees in between
+        if tree_gap() > 1 and node.parent_id is not None and target is not None and (
+                position == 'last-child' or position == 'left' and target.parent_id is not None):
+            if self._move_into_gap(node, target, position):
+                if save:
+                    node.save()
+                return
+            # The tree may have been renumbered in the attempt
+            self._refresh_tree_fields(node)
+            self._refresh_tree_fields(target)
+        return super(NodeManager, self)._move_node(node, target, position, save=save)
+
+    def _move_into_gap(self, node, target, position):
+        parent_id, right_id = position == 'left' and (target.parent_id, target.pk) or (target.pk, None)
+        tree_id, lft, rght, level = self.filter(pk=node.pk).values_list(
+            'tree_id', 'lft', 'rght', 'level')[0]
+        parent = self.filter(pk=parent_id).values_list('tree_id', 'lft', 'rght')[0]
+        if parent[0] == tree_id and lft <= parent[1] <= rght:
+            return False  # Into its own subtree, left to MPTT to reject
+        size = 2 * self.filter(tree_id=tree_id, lft__gte=lft, lft__lte=rght).count() + 1
+        new_tree_id, new_level, a, b = self._free_numbers(parent_id, right_id, node.pk, size)
+        if b - a < size:
+            return False
+        if tree_id == new_tree_id:  # Renumbering may have moved the node
+            tree_id, lft, rght = self.filter(pk=node.pk).values_list('tree_id', 'lft', 'rght')[0]
+        subtree = self.filter(tree_id=tree_id, lft__gte=lft, lft__lte=rght)
+        if rght - lft < b - a - 1:  # Fits as it is
+            shift = a + (b - a - (rght - lft)) // 2 - lft
+            subtree.update(lft=F('lft') + shift,
+                           rght=F('rght') + shift,
+                           level=F('level') + new_level - level,
+                           tree_id=new_tree_id)
+            node.lft, node.rght = lft + shift, rght + shift
+        else:  # Spread its numbers evenly over the gap
+            rows = list(subtree.values_list('pk', 'lft', 'rght', 'level'))
+            step = (b - a) // size
+            numbers = dict((value, a + step * (i + 1)) for i, value in
+                           enumerate(sorted([row[1] for row in rows] + [row[2] for row in rows])))
+            self._update_rows(('lft', 'rght', 'level', 'tree_id'),
+                              [[numbers[row[1]], numbers[row[2]], row[3] + new_level - level,
+                                new_tree_id, row[0]] for row in rows])
+            node.lft, node.rght = numbers[lft], numbers[rght]
+        node.level, node.tree_id = new_level, new_tree_id
+        if node.parent_id != parent_id:  # Moved by move_node() rather than by a new parent
+            node.parent = target if position == 'last-child' else target.parent
+        node._mptt_cached_fields[self.parent_attr] = parent_id
+        return True
+
+    def _free_numbers(self, parent_id, right_id, exclude=None, size=3):
+        """
+        Tree id and level of a new child of a node, and the numbers
+        between which it is free to take lft and rght values: after the
+        previous sibling or the parent's lft, before the sibling
+        ``right_id`` or the parent's rght. The tree is renumbered if there
+        are less than ``size``.
+        """
+        for attempt in range(2):
+            tree_id, level, lft, rght = self.filter(pk=parent_id).values_list(
+                'tree_id', 'level', 'lft', 'rght')[0]
+            if right_id is not None:
+                rght = self.filter(pk=right_id).values_list('lft', flat=True)[0]
+            previous = self.filter(parent=parent_id, lft__lt=rght).exclude(pk=exclude)
+            lft = previous.aggregate(Max('rght'))['rght__max'] or lft
+            if rght - lft >= size or attempt:
+                break
+            self.rebuild_tree_fields([tree_id])
+        return tree_id, level + 1, lft, rght
+
+    def _close_gap(self, size, target, tree_id):
+        if tree_gap() <= 1:  # Gaps left by deleted nodes are welcome
+            super(NodeManager, self)._close_gap(size, target, tree_id)
+
+    def _post_insert_update_cached_parent_right(self, instance, right_shift, seen=None):
+        if tree_gap() <= 1:
+            return super(NodeManager, self)._post_insert_update_cached_parent_right(
+                instance, right_shift, seen)
+        # Gaps make the shift unpredictable, read the numbers back instead
+        while instance is not None:
+            self._refresh_tree_fields(instance)
+            instance = getattr(instance, '_parent_cache', None)
+
+    def _refresh_tree_fields(self, instance):
+        instance.lft, instance.rght, instance.level, instance.tree_id = self.filter(
+            pk=instance.pk).values_list('lft', 'rght', 'level', 'tree_id')[0]
+
+    def _update_rows(self, fields, rows):
+        """Write rows of field values followed by the primary key."""
+        if not rows:
+            return
+        connection = self._get_connection()
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        sql = "UPDATE %s SET %s WHERE %s = %%s" % (
+            qn(opts.db_table),
+            ", ".join("%s = %%s" % qn(opts.get_field(f).column) for f in fields),
+            qn(opts.pk.column))
+        connection.cursor().executemany(sql, rows)
+        transaction.commit_unless_managed(using=connection.alias)
+
+    def reserve(self, lines, batch_size=500):
+        """
+        Reserve quantities of nodes for customers.
+
+        ``lines`` are (node or node id, quantity) pairs. A line succeeds if
+        the node has that many items in stock that are not pending to
+        customers yet, and adds them to the pending ones. Returns the lines
+        that failed for lack of stock, as (node id, quantity) pairs.
+        """
+        return self._move_stock(RESERVE, lines, batch_size)
+
+    def release(self, lines, batch_size=500):
+        """Give back reserved quantities. Returns the lines that were not reserved."""
+        return self._move_stock(RELEASE, lines, batch_size)
+
+    def commit(self, lines, batch_size=500):
+        """Take reserved quantities out of stock. Returns the lines that were not reserved."""
+        return self._move_stock(COMMIT, lines, batch_size)
+
+    @transaction.commit_on_success
+    def _move_stock(self, movement, lines, batch_size):
+        """
+        Apply a stock movement with conditional UPDATE statements.
+
+        Counters are never read and written back, every line is checked and
+        changed by the database in the same statement, so concurrent
+        movements cannot overwrite each other. All lines of a batch go into
+        a single statement. Should some of them fail, the batch is rolled
+        back to a savepoint and retried line by line to tell which failed;
+        on backends without savepoints lines are always applied one by one.
+        """
+        quantities = {}
+        for node, quantity in lines:
+            node_id = getattr(node, 'pk', node)
+            if int(quantity) <= 0:
+                raise ValueError("Quantity of %s must be positive." % node_id)
+            quantities[node_id] = quantities.get(node_id, 0) + int(quantity)
+        connection = self._get_connection()
+        node_ids = sorted(quantities)
+        failed = []
+        done = []
+        # The trees are locked first, as structural writes do, so the
+        # positions the rollups go by cannot move until the end
+        with self.tree_lock(*node_ids) as positions:
+            for i in range(0, len(node_ids), batch_size):
+                batch = [(pk, quantities[pk]) for pk in node_ids[i:i + batch_size]]
+                sid = None
+                if len(batch) > 1 and connection.features.uses_savepoints:
+                    sid = transaction.savepoint(using=connection.alias)
+                    if self._update_stock(movement, batch) == len(batch):
+                        transaction.savepoint_commit(sid, using=connection.alias)
+                        done.extend(batch)
+                        continue
+                    transaction.savepoint_rollback(sid, using=connection.alias)
+                for line in batch:
+                    if self._update_stock(movement, [line]):
+                        done.append(line)
+                    else:
+                        failed.append(line)
+            if done:
+                self._update_stock_rollups(movement, done, positions)
+        if done:
+            stock_changed.send(sender=self.model, node_ids=[pk for pk, quantity in done])
+        return failed
+
+    def _update_stock(self, movement, lines, own=True):
+        """
+        Move stock of all lines that meet the condition, returns their number.
+
+        With ``own`` false only the subtree totals are changed, whatever
+        the condition, as needed for the ancestors of the moved lines.
+        """
+        connection = self._get_connection()
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        columns = dict((field.lstrip('_'), qn(opts.get_field(field).column))
+                       for field in ('_stock', '_stock_total',
+                                     '_pending_customer', '_pending_customer_total'))
+        case = "CASE %s %s END" % (qn(opts.pk.column), " ".join(["WHEN %s THEN %s"] * len(lines)))
+        case_params = [value for line in lines for value in line]
+        stock_sign, pending_sign, condition = movement
+        assignments, params = [], []
+        for name, sign in (('stock', stock_sign), ('pending_customer', pending_sign)):
+            for column in own and (name, name + '_total') or (name + '_total',):
+                if sign:
+                    assignments.append("%s = %s %s (%s)" % (columns[column], columns[column],
+                                                            sign > 0 and "+" or "-", case))
+                    params.extend(case_params)
+        sql = "UPDATE %s SET %s WHERE %s IN (%s)" % (
+            qn(opts.db_table),
+            ", ".join(assignments),
+            qn(opts.pk.column),
+            ", ".join(["%s"] * len(lines)))
+        params.extend(pk for pk, quantity in lines)
+        if own:
+            sql += " AND " + condition % {'stock': columns['stock'],
+                                          'pending': columns['pending_customer'],
+                                          'q': "(%s)" % case}
+            params.extend(case_params)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+    def _update_stock_rollups(self, movement, lines, positions):
+        """
+        Add the moved quantities to the subtree totals of all ancestors.
+
+        ``positions`` are the (tree_id, lft, rght, level) of the moved nodes
+        by id, as yielded by tree_lock(), which has to be held.
+        """
+        quantities = dict(lines)
+        nodes = [(pk,) + positions[pk][:3] for pk in quantities if pk in positions]
+        if not nodes:
+            return
+        ancestors = reduce(operator.or_, [Q(tree_id=tree_id, lft__lt=lft, rght__gt=rght)
+                                          for pk, tree_id, lft, rght in nodes])
+        deltas = []
+        rows = self._on_write_db().filter(ancestors).values_list('pk', 'tree_id', 'lft', 'rght')
+        for pk, tree_id, lft, rght in rows:
+            deltas.append((pk, sum(quantities[node[0]] for node in nodes
+                                   if node[1] == tree_id and lft < node[2] and node[3] < rght)))
+        for i in range(0, len(deltas), 500):
+            self._update_stock(movement, deltas[i:i + 500], own=False)
@@ -0,0 +1,126 @@
+"""
+Variation matrix of a product, e.g. its sizes by its colours.
+
+Every variance the variations of a product have variants of is an axis of
+the matrix, and every variation is a cell at the combination of its
+variants. A cell knows the available stock of its variation, the price it
+adds to the product and the URL selecting it. Whatever the number of
+variations, the matrix is built from two queries: the variations with
+their derived columns, and their variant links joined with the variants
+and variances. The view passes the variations it loaded anyway, leaving
+one query.
+
+Only active variations and variants are placed. Variations lacking a
+variant of some axis, having several of one variance or sharing their
+combination with an earlier variation are listed as ``unplaced``.
+"""
+import itertools
+from jimi.catalog.models import Node, Variant, Variance
+from jimi.price.fields import Money
+
+
+class Axis(object):
+    """A variance of the matrix with its variants, in the order they were created."""
+    def __init__(self, variance):
+        self.variance = variance
+        self.variants = []
+
+    @property
+    def name(self):
+        return self.variance.name
+
+
+class Cell(object):
+    """A variation placed in the matrix."""
+    def __init__(self, variation, variants, url):
+        self.variation = variation
+        self.variants = variants  # One per axis
+        self.url = url
+
+    @property
+    def slug(self):
+        return self.variation.slug
+
+    @property
+    def name(self):
+        return self.variation.name
+
+    @property
+    def available(self):
+        return self.variation.stock_available
+
+    @property
+    def price_delta(self):
+        """Price of the variation on top of the price of the product."""
+        return self.variation._price or Money(0)
+
+
+class VariationMatrix(object):
+    """Variations of a product by their variants, see build()."""
+    def __init__(self, product, variations, links):
+        """
+        ``links`` are (variation id, variant id, variant name, variance id,
+        variance name) rows of the active variants of the variations.
+        """
+        self.product = product
+        variances, variants, by_variation = {}, {}, {}
+        for node_id, variant_id, variant_name, variance_id, variance_name in links:
+            if variance_id not in variances:
+                variances[variance_id] = Axis(Variance(pk=variance_id, name=variance_name))
+            if variant_id not in variants:
+                variants[variant_id] = Variant(pk=variant_id, name=variant_name,
+                                               variance_id=variance_id)
+                variances[variance_id].variants.append(variants[variant_id])
+            by_variation.setdefault(node_id, []).append(variants[variant_id])
+        self.axes = [variances[pk] for pk in sorted(variances)]
+        for axis in self.axes:
+            axis.variants.sort(key=lambda variant: variant.pk)
+        url = product.get_absolute_url()
+        self.cells = {}  # Tuple of variant ids, one per axis -> Cell
+        self.unplaced = []
+        for variation in variations:
+            chosen = dict((v.variance_id, v) for v in by_variation.get(variation.pk, ()))
+            key = tuple(chosen.get(axis.variance.pk) for axis in self.axes)
+            pks = tuple(getattr(v, "pk", None) for v in key)
+            if (not self.axes or None in key or pks in self.cells or
+                    len(chosen) < len(by_variation[variation.pk])):
+                self.unplaced.append(variation)
+                continue
+            self.cells[pks] = Cell(variation, list(key), "%s?variation=%s" % (url, variation.slug))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def get(self, variants):
+        """Cell at a combination of variants, one per axis, or None."""
+        return self.cells.get(tuple(getattr(v, "pk", v) for v in variants))
+
+    @property
+    def columns(self):
+        """Combinations of variants of all axes but the first."""
+        return list(itertools.product(*[axis.variants for axis in self.axes[1:]]))
+
+    def rows(self):
+        """
+        Variants of the first axis with the cells of each column, None
+        where no variation has the combination.
+        """
+        columns = self.columns
+        for variant in self.axes and self.axes[0].variants or ():
+            yield variant, [self.get((variant,) + column) for column in columns]
+
+
+def build(product, variations=None):
+    """
+    Matrix of a product. Its ``variations`` are read if not given, e.g.
+    when they were loaded with with_aggregates() already.
+    """
+    if variations is None:
+        variations = Node.objects.filter(parent=product.pk, kind=Node.VARIATION, active=True)
+    variations = [v for v in variations if v.active and v.kind == Node.VARIATION]
+    links = []
+    if variations:
+        links = Node.variant.through.objects.filter(
+            node__parent=product.pk, variant__active=True).values_list(
+            "node", "variant", "variant__name", "variant__variance", "variant__variance__name")
+    return VariationMatrix(product, variations, links)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'Node._effective_price'
+        db.add_column('jimi_catalog', '_effective_price',
+                      self.gf('jimi.price.fields.MoneyField')(max_length=21, null=True, db_column='effective_price'),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'Node._effective_price'
+        db.delete_column('jimi_catalog', 'effective_price')
+
+
+    models = {
+        'catalog.node': {
+            'Meta': {'object_name': 'Node', 'db_table': "'jimi_catalog'"},
+            '_effective_price': ('jimi.price.fields.MoneyField', [], {'max_length': '21', 'null': 'True', 'db_column': "'effective_price'"}),
+            '_pending_customer': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_column': "'pending_customer'"}),
+            '_pending_customer_total': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_column': "'pending_customer_total'"}),
+            '_pending_supplier': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_column': "'pending_supplier'"}),
+            '_pending_supplier_total': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_column': "'pending_supplier_total'"}),
+            '_price': ('jimi.price.fields.MoneyField', [], {'default': '0.0', 'max_length': '21', 'db_column': "'price'"}),
+            '_stock': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_column': "'stock'"}),
+            '_stock_total': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_column': "'stock_total'"}),
+            '_supplier': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_column': "'supplier'", 'blank': 'True'}),
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'kind': ('django.db.models.fields.CharField', [], {'max_length': '1', 'db_index': 'True'}),
+            u'level': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            u'lft': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'meta_description': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'meta_keywords': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'parent': ('mptt.fields.TreeForeignKey', [], {'blank': 'True', 'related_name': "'children'", 'null': 'True', 'to': "orm['catalog.Node']"}),
+            u'rght': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '128'}),
+            'teaser': ('django.db.models.fields.TextField', [], {}),
+            u'tree_id': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'variant': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['catalog.Variant']", 'symmetrical': 'False', 'db_table': "'jimi_productvariant'", 'blank': 'True'})
+        },
+        'catalog.variance': {
+            'Meta': {'object_name': 'Variance', 'db_table': "'jimi_variance'"},
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'internal_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'catalog.variant': {
+            'Meta': {'object_name': 'Variant', 'db_table': "'jimi_variant'"},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'internal_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'variance': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catalog.Variance']"})
+        }
+    }
+
+    complete_apps = ['catalog']
\ No newline at end of file
@@ -1,2 +1,9 @@
 from node import Node, Category, Product
 from variance import Variance, Variant
+from search import SearchTerm
+import jimi.catalog.ancestry  # Connects the request scope of ancestor chains
+import jimi.catalog.snapshot  # Connects the snapshot invalidation receivers
+import jimi.catalog.search  # Connects the search index receivers
+import jimi.catalog.facets  # Connects the facet index receivers
+import jimi.catalog.conditional  # Connects the stock version receivers
+import jimi.catalog.pagecache  # Connects the page cache receivers
@@ -1,10 +1,22 @@
-from django.db import models
+import json
+from django.core.exceptions import ValidationError
+from django.db import models, router
+from django.db.models import F
+from django.utils import timezone
 from mptt.models import MPTTModel, TreeForeignKey
 from variance import Variant
-from jimi.price.fields import Money, MoneyField
+from jimi.catalog.managers import NodeManager, encode_path, tree_gap
+from jimi.catalog.signals import stock_changed
+from jimi.price.fields import DecimalMoneyField, Money
 from django.utils.translation import ugettext as _
 
 
+def validate_slug(value):
+    """Reject slugs of other catalog pages, see Node.RESERVED_SLUGS."""
+    if value in Node.RESERVED_SLUGS:
+        raise ValidationError(_("%s is the address of another catalog page.") % value)
+
+
 class Node(MPTTModel):
     """
     A catalog node.
@@ -17,6 +29,8 @@ class Node(MPTTModel):
     KIND_CHOICES = ((CATEGORY, _("Category")),
                     (PRODUCT, _("Product")),
                     (VARIATION, _("Product variation")))
+    # Pages in jimi.catalog.urls matched before node slugs
+    RESERVED_SLUGS = ("search",)
     name = models.CharField(_("Name"), max_length=128)
     kind = models.CharField(_("Kind"),
                             max_length=1,
@@ -29,6 +43,7 @@ class Node(MPTTModel):
                                      help_text=_("Variant of product"))
     slug = models.SlugField(max_length=128,
                             unique=True,
+                            validators=[validate_slug],
                             help_text=_("Unique text string for page URL. Created from name."))
     teaser = models.TextField(_("Teaser"))
     description = models.TextField(_("Description"))
@@ -47,11 +62,12 @@ class Node(MPTTModel):
                                  db_column="supplier",
                                  help_text=_("Supplier for catalog node. Fallback to parent"
                                           + " node supplier."))
-    _price = MoneyField(_("Price"),
-                        default=0.00,
-                        db_column="price",
-                        help_text=_("Total price is accumulated from fragments"
-                                 + " spanning categories, product and variation"))
+    # Amount in the price column, currency code in price_currency
+    _price = DecimalMoneyField(_("Price"),
+                               default=0.00,
+                               db_column="price",
+                               help_text=_("Total price is accumulated from fragments"
+                                        + " spanning categories, product and variation"))
     _stock = models.IntegerField(_("Stock"),
                                  default=0,
                                  db_column="stock",
@@ -65,39 +81,296 @@ class Node(MPTTModel):
                                             default=0,
                                             db_column="pending_supplier",
                                             help_text=_("Number of items pending from supplier"))
+    # Subtree rollups of the three counters above, maintained on save.
+    # Run the rebuild_catalog command to repair them after bulk edits.
+    _stock_total = models.IntegerField(default=0,
+                                       editable=False,
+                                       db_column="stock_total")
+    _pending_customer_total = models.IntegerField(default=0,
+                                                  editable=False,
+                                                  db_column="pending_customer_total")
+    _pending_supplier_total = models.IntegerField(default=0,
+                                                  editable=False,
+                                                  db_column="pending_supplier_total")
+    # Number of nodes below, maintained on save like the rollups above.
+    _descendant_count = models.IntegerField(default=0,
+                                            editable=False,
+                                            db_column="descendant_count")
+    # Sum of _price over the ancestors and the node itself, maintained on save.
+    # Amount in the effective_price column, currency code in effective_price_currency
+    _effective_price = DecimalMoneyField(null=True,
+                                         editable=False,
+                                         db_column="effective_price")
+    # First _supplier found on the node or its ancestors, maintained on save.
+    _effective_supplier = models.CharField(_("Supplier"),
+                                           max_length=255,
+                                           blank=True,
+                                           editable=False,
+                                           db_index=True,
+                                           db_column="effective_supplier")
+    # Ancestors from the root as a JSON list of [id, slug, name], maintained on save.
+    _path = models.TextField(blank=True,
+                             editable=False,
+                             db_column="path")
     # TODO tax classification
 
+    objects = NodeManager()
+
     class MPTTMeta:
         order_insertion_by = ['name']
 
     class Meta:
         db_table = 'jimi_catalog'
         app_label = 'catalog'
+        # Tree order, as read by keyset pagination and the whole tree readers
+        index_together = [['tree_id', 'lft']]
+
+    def __init__(self, *args, **kwargs):
+        super(Node, self).__init__(*args, **kwargs)
+        self._remember_counters()
 
     def __unicode__(self):
         return self.name
 
+    def _remember_counters(self):
+        """Keep the stock counters as loaded, to tell what the instance changed."""
+        self._loaded_counters = (self._stock, self._pending_customer, self._pending_supplier)
+
+    def save(self, *args, **kwargs):
+        """
+        Save node and keep the derived columns of the tree in sync.
+
+        Subtree rollups are pushed up to the ancestors, inherited price
+        and supplier are cascaded down to the descendants. Everything is
+        derived from what is stored in the database, so a stale instance
+        cannot overwrite changes made elsewhere in the tree. The same goes
+        for the stock counters of the node: only what was changed on the
+        instance since it was loaded is added to the stored ones, stock
+        movements made meanwhile are kept. The trees written to are
+        locked, see NodeManager.lock_trees().
+        """
+        self._save_locked(None, *args, **kwargs)
+
+    def _save_locked(self, move, *args, **kwargs):
+        """
+        Save under the tree lock, first moving the node to ``move``, a
+        (target, position) pair, if given. See NodeManager.move_node().
+        """
+        # Every query of the save, reads included, goes to this database
+        using = kwargs['using'] = kwargs.get('using') or router.db_for_write(Node, instance=self)
+        target = move and move[0]
+        with Node.objects.db_manager(using).tree_lock(self.pk, self.parent_id,
+                                                      getattr(target, 'pk', None)) as current:
+            self._use_tree_fields(current)
+            if target is not None:
+                target._use_tree_fields(current)
+            self._save(move, *args, **kwargs)
+
+    def _use_tree_fields(self, current):
+        """Take over the tree fields read under lock, for the node and its parent."""
+        for node in (self, getattr(self, Node.parent.cache_name, None)):
+            if node is not None and node.pk in current:
+                node.tree_id, node.lft, node.rght, node.level = current[node.pk]
+
+    def _save(self, move, *args, **kwargs):
+        using = kwargs['using']
+        old = None
+        if self.pk:
+            old = list(Node.objects.using(using).filter(pk=self.pk).values(
+                'parent', 'tree_id', 'lft', 'rght',
+                '_price', '_price_currency', '_effective_price', '_effective_price_currency',
+                '_supplier', '_effective_supplier',
+                'slug', 'name', '_path',
+                '_stock', '_pending_customer', '_pending_supplier',
+                '_stock_total', '_pending_customer_total', '_pending_supplier_total',
+                '_descendant_count'))
+            old = old and old[0] or None
+        relocated = old is not None and (move is not None or old['parent'] != self.parent_id)
+        if relocated:  # Subtree totals leave the old ancestors before these are renumbered
+            Node._update_rollups(old['tree_id'], old['lft'], old['rght'],
+                                 -old['_stock_total'],
+                                 -old['_pending_customer_total'],
+                                 -old['_pending_supplier_total'],
+                                 -old['_descendant_count'] - 1,
+                                 using)
+        if move is not None:
+            Node.objects.db_manager(using)._move_node(self, move[0], move[1], save=False)
+        price_field = self._meta.get_field('_price')
+        cascade = (old is None or relocated or
+                   price_field.money(old['_price'], old['_price_currency']) != self._price or
+                   old['_supplier'] != self._supplier)
+        renamed = old is not None and (old['slug'] != self.slug or old['name'] != self.name)
+        if cascade:
+            price, supplier, self._path = self._inherited(using)
+            self._effective_price = price + (self._price or Money(0))
+            self._effective_supplier = self._supplier or supplier
+        else:
+            self._effective_price = self._meta.get_field('_effective_price').money(
+                old['_effective_price'], old['_effective_price_currency'])
+            self._effective_supplier = old['_effective_supplier']
+            self._path = old['_path'] or self._inherited(using)[2]
+        if old is None:  # New node, all of it goes to the ancestors
+            self._stock_total = self._stock
+            self._pending_customer_total = self._pending_customer
+            self._pending_supplier_total = self._pending_supplier
+            self._descendant_count = 0
+            delta = (self._stock_total,
+                     self._pending_customer_total,
+                     self._pending_supplier_total,
+                     1)
+        else:
+            delta = (self._stock - self._loaded_counters[0],
+                     self._pending_customer - self._loaded_counters[1],
+                     self._pending_supplier - self._loaded_counters[2],
+                     0)
+            self._stock = old['_stock'] + delta[0]
+            self._pending_customer = old['_pending_customer'] + delta[1]
+            self._pending_supplier = old['_pending_supplier'] + delta[2]
+            self._stock_total = old['_stock_total'] + delta[0]
+            self._pending_customer_total = old['_pending_customer_total'] + delta[1]
+            self._pending_supplier_total = old['_pending_supplier_total'] + delta[2]
+            self._descendant_count = old['_descendant_count']
+            if relocated:  # All of it goes to the new ancestors
+                delta = (self._stock_total,
+                         self._pending_customer_total,
+                         self._pending_supplier_total,
+                         self._descendant_count + 1)
+        super(Node, self).save(*args, **kwargs)
+        self._remember_counters()
+        self._ancestor_chain = None  # It may have moved
+        self._update_ancestor_rollups(*delta, using=using)
+        parent = getattr(self, Node.parent.cache_name, None)
+        while parent is not None and delta[3]:  # As MPTT updates the rght of cached parents
+            parent._descendant_count += delta[3]
+            parent = getattr(parent, Node.parent.cache_name, None)
+        if (cascade or renamed) and old is not None:
+            self._cascade_inherited(using)
+        if old is not None and old['parent'] not in (None, self.parent_id):
+            # Its page lost a child without anything else changing
+            Node.objects.using(using).filter(pk=old['parent']).update(updated=timezone.now())
+        if any(delta[:3]):
+            stock_changed.send(sender=Node, node_ids=[self.pk])
+
+    def _inherited(self, using=None):
+        """
+        Effective price and supplier of the parent as stored in the
+        database ``using``, and the path of the node below it.
+        """
+        if self.parent_id is None:
+            return Money(0), "", encode_path([])
+        parents = Node.objects.using(using).filter(pk=self.parent_id)
+        price, currency, supplier, slug, name, path = parents.values_list(
+            '_effective_price', '_effective_price_currency',
+            '_effective_supplier', 'slug', 'name', '_path')[0]
+        path = encode_path(json.loads(path or "[]") + [[self.parent_id, slug, name]])
+        price = self._meta.get_field('_effective_price').money(price, currency)
+        return price or Money(0), supplier, path
+
+    def _cascade_inherited(self, using=None):
+        """
+        Recompute the effective price and supplier and the path of all
+        descendants.
+
+        The subtree is read once in tree order from the node's lft/rght
+        range. One UPDATE is issued per distinct new price and supplier,
+        changed paths are written in one batch.
+        """
+        if self.rght - self.lft <= 1:
+            return
+        price_field = self._meta.get_field('_price')
+        effective_price_field = self._meta.get_field('_effective_price')
+        nodes = Node.objects.db_manager(using)
+        rows = nodes.filter(tree_id=self.tree_id,
+                            lft__gt=self.lft,
+                            lft__lt=self.rght).values_list(
+            'pk', 'level', 'slug', 'name', '_price', '_price_currency', '_supplier',
+            '_effective_price', '_effective_price_currency', '_effective_supplier', '_path')
+        path = json.loads(self._path) + [[self.pk, self.slug, self.name]]
+        stack = [(self.level, self._effective_price, self._effective_supplier, path)]
+        changed = {}
+        paths = []
+        for (pk, level, slug, name, price, currency, supplier,
+             old_price, old_currency, old_supplier, old_path) in rows.iterator():
+            while stack[-1][0] >= level:
+                stack.pop()
+            price = stack[-1][1] + (price_field.money(price, currency) or Money(0))
+            supplier = supplier or stack[-1][2]
+            path = stack[-1][3]
+            stack.append((level, price, supplier, path + [[pk, slug, name]]))
+            if (price != effective_price_field.money(old_price, old_currency) or
+                    supplier != old_supplier):
+                changed.setdefault((unicode(price), supplier), (price, []))[1].append(pk)
+            if encode_path(path) != old_path:
+                paths.append([encode_path(path), pk])
+        for (key, supplier), (price, pks) in changed.items():
+            for i in range(0, len(pks), 500):
+                nodes.filter(pk__in=pks[i:i + 500]).update(
+                    _effective_price=price,
+                    _effective_supplier=supplier)
+        nodes._update_rows(('_path',), paths)
+
+    def delete(self, *args, **kwargs):
+        """Delete node and its subtree, taking it out of the rollups."""
+        using = kwargs['using'] = kwargs.get('using') or router.db_for_write(Node, instance=self)
+        with Node.objects.db_manager(using).tree_lock(self.pk) as current:
+            self._use_tree_fields(current)
+            self._delete(*args, **kwargs)
+
+    def _delete(self, *args, **kwargs):
+        using = kwargs['using']
+        totals = list(Node.objects.using(using).filter(pk=self.pk).values_list(
+            'tree_id', 'lft', 'rght',
+            '_stock_total', '_pending_customer_total', '_pending_supplier_total',
+            '_descendant_count'))
+        for tree_id, lft, rght, stock, pcust, psupp, descendants in totals:
+            Node._update_rollups(tree_id, lft, rght, -stock, -pcust, -psupp, -descendants - 1, using)
+        if self.parent_id is not None:
+            Node.objects.using(using).filter(pk=self.parent_id).update(updated=timezone.now())
+        super(Node, self).delete(*args, **kwargs)
+        if any(totals and totals[0][3:6] or ()):
+            stock_changed.send(sender=Node, node_ids=[self.pk])
+
+    def _update_ancestor_rollups(self, stock, pending_customer, pending_supplier, descendants,
+                                 using=None):
+        """Add amounts to the subtree rollups of all ancestors."""
+        Node._update_rollups(self.tree_id, self.lft, self.rght,
+                             stock, pending_customer, pending_supplier, descendants, using)
+
+    @staticmethod
+    def _update_rollups(tree_id, lft, rght, stock, pending_customer, pending_supplier,
+                        descendants, using=None):
+        """Add amounts to the rollups of nodes enclosing the lft/rght range."""
+        if not (stock or pending_customer or pending_supplier or descendants):
+            return
+        ancestors = Node.objects.using(using).filter(tree_id=tree_id, lft__lt=lft, rght__gt=rght)
+        ancestors.update(
+            _stock_total=F('_stock_total') + stock,
+            _pending_customer_total=F('_pending_customer_total') + pending_customer,
+            _pending_supplier_total=F('_pending_supplier_total') + pending_supplier,
+            _descendant_count=F('_descendant_count') + descendants)
+
     @property
     def price(self):
         """Aggregate price from node and it's ancestors."""
-        p = Money(0)
-        for n in self.get_ancestors(include_self=True):
-            p += n._price
-        return p
+        if self._effective_price is None:  # Not saved yet
+            return self._inherited()[0] + (self._price or Money(0))
+        return self._effective_price
 
     @price.setter
     def price(self, value):
         """Set node price."""
+        previous = self._price or Money(0)
         self._price = value
+        if self._effective_price is not None:
+            self._effective_price += self._price - previous
 
     @property
     def supplier(self):
         """Get supplier, either from node itself or from the first ancestor
         where it is set."""
-        for n in self.get_ancestors(include_self=True, ascending=True):
-            if n._supplier:
-                return n._supplier
-        return None
+        if self._supplier:
+            return self._supplier
+        return self._effective_supplier or None
 
     @supplier.setter
     def supplier(self, value):
@@ -107,14 +380,12 @@ class Node(MPTTModel):
     @property
     def stock(self):
         """Aggregate stock level from node and it's descendants."""
-        c = 0
-        for n in self.get_descendants(include_self=True):
-            c += n._stock
-        return c
+        return self._stock_total
 
     @stock.setter
     def stock(self, value):
         """Set stock level."""
+        self._stock_total += value - self._stock
         self._stock = value
 
     @property
@@ -124,14 +395,12 @@ class Node(MPTTModel):
         Aggregated from node and it's descendants.
 
         TODO: Generate this from orders."""
-        c = 0
-        for n in self.get_descendants(include_self=True):
-            c += n._pending_customer
-        return c
+        return self._pending_customer_total
 
     @pending_customer.setter
     def pending_customer(self, value):
         """Set amount pending to customer."""
+        self._pending_customer_total += value - self._pending_customer
         self._pending_customer = value
 
     @property
@@ -141,16 +410,55 @@ class Node(MPTTModel):
         Aggregated from node and it's descendants.
 
         TODO: Generate this from orders."""
-        c = 0
-        for n in self.get_descendants(include_self=True):
-            c += n._pending_supplier
-        return c
+        return self._pending_supplier_total
 
     @pending_supplier.setter
     def pending_supplier(self, value):
         """Set amount pending from supplier."""
+        self._pending_supplier_total += value - self._pending_supplier
         self._pending_supplier = value
 
+    def reserve(self, quantity):
+        """Reserve items for a customer. Returns whether enough were in stock."""
+        return self._move_stock(Node.objects.reserve, quantity, 0, 1)
+
+    def release(self, quantity):
+        """Give back reserved items. Returns whether as many were reserved."""
+        return self._move_stock(Node.objects.release, quantity, 0, -1)
+
+    def commit(self, quantity):
+        """Take reserved items out of stock. Returns whether as many were reserved."""
+        return self._move_stock(Node.objects.commit, quantity, -1, -1)
+
+    def _move_stock(self, move, quantity, stock_sign, pending_sign):
+        if move([(self.pk, quantity)]):
+            return False
+        quantity = int(quantity)
+        stock, pending_customer, pending_supplier = self._loaded_counters
+        self._loaded_counters = (stock + stock_sign * quantity,
+                                 pending_customer + pending_sign * quantity,
+                                 pending_supplier)
+        self._stock += stock_sign * quantity
+        self._stock_total += stock_sign * quantity
+        self._pending_customer += pending_sign * quantity
+        self._pending_customer_total += pending_sign * quantity
+        return True
+
+    def get_descendant_count(self):
+        """
+        Number of descendants. If the tree is numbered with gaps it is
+        read from the row as stored, so is_leaf_node() and get_children()
+        stay free of queries.
+        """
+        if tree_gap() > 1:
+            return self._descendant_count
+        return super(Node, self).get_descendant_count()
+
+    def get_leafnodes(self, include_self=False):
+        if tree_gap() > 1:
+            return self.get_descendants(include_self=include_self).filter(children__isnull=True)
+        return super(Node, self).get_leafnodes(include_self=include_self)
+
     @property
     def stock_available(self):
         """Number of inventory items available for sale."""
@@ -169,21 +477,71 @@ class Node(MPTTModel):
     @property
     def is_variation(self):
         """Determine if node is a product variation"""
-        return self.is_leave_node() and self.parent.kind == "P"
+        return self.is_leave_node() and self._cached_parent().kind == "P"
 
     @property
     def has_variations(self):
         """Determine if node is product with variations"""
         return self.kind == Node.PRODUCT and not self.is_leave_node()
 
+    @property
+    def path(self):
+        """
+        Ancestors from the root as stored on the row, as PathEntry objects.
+
+        Enough for breadcrumbs and URLs without loading the ancestors.
+        None if the path has not been computed yet.
+        """
+        if not self._path:
+            return None
+        return [PathEntry(*entry) for entry in json.loads(self._path)]
+
+    def get_cached_ancestors(self, include_self=False):
+        """
+        Ancestors of the node from the root, as a list.
+
+        Unlike get_ancestors() the chain is loaded at most once per
+        request, see jimi.catalog.ancestry.
+        """
+        from jimi.catalog import ancestry
+        chain = ancestry.get(self)
+        return include_self and chain + [self] or list(chain)
+
+    def _cached_parent(self):
+        """Parent, joined in by select_related() or from the cached ancestors."""
+        if self.parent_id is None or hasattr(self, Node.parent.cache_name):
+            return self.parent
+        return self.get_cached_ancestors()[-1]
+
     @models.permalink
     def get_absolute_url(self):
+        """Canonical URL, the product page for variations."""
         if self.kind == Node.VARIATION:  # Parent URL for variations
-            return ("node", (), {'slug': self.get_ancestors(ascending=True)[0].slug})
+            path = self.path
+            slug = path and path[-1].slug or self._cached_parent().slug
+            return ("node", (), {'slug': slug})
         else:
             return ("node", (), {'slug': self.slug})
 
 
+class PathEntry(object):
+    """An ancestor of a node as stored in the node's path."""
+    def __init__(self, pk, slug, name):
+        self.pk = pk
+        self.slug = slug
+        self.name = name
+
+    def __unicode__(self):
+        return self.name
+
+    def __repr__(self):
+        return "<PathEntry: %s>" % self.slug
+
+    @models.permalink
+    def get_absolute_url(self):
+        return ("node", (), {'slug': self.slug})
+
+
 class Category(Node):
     """Catalog nodes representing categories"""
     class Meta:
@@ -0,0 +1,21 @@
+from django.db import models
+from node import Node
+
+
+class SearchTerm(models.Model):
+    """
+    Entry of the catalog search index.
+
+    One row per distinct term of a node, weighted by how often and in
+    which fields the term occurs. Maintained by jimi.catalog.search.
+    """
+    term = models.CharField(max_length=64, db_index=True)
+    node = models.ForeignKey(Node, related_name='search_terms')
+    weight = models.IntegerField()
+
+    class Meta:
+        db_table = 'jimi_catalog_searchterm'
+        app_label = 'catalog'
+
+    def __unicode__(self):
+        return self.term
@@ -0,0 +1,163 @@
+"""
+Cache of rendered category and product pages.
+
+A page shows its node, its ancestors (names, inherited price and supplier)
+and its children, so that is what a cached page depends on. Every node has
+a version number in the cache, and a page is stored under a key made from
+the versions of all nodes it depends on, looked up in the tree snapshot.
+Changing a node bumps its version, which outdates exactly its own page,
+the page of its parent and the pages of all its descendants; the other
+pages of the catalog stay cached. Adding, moving and removing children
+changes the child set of a page and hence its key.
+
+Stock moves bump the moved nodes and their ancestors, whose totals
+changed. So do variant links and switching nodes active or inactive, as
+category pages count variants of everything below them.
+
+Pages are only cached for plain GET requests. The CSRF token of product
+pages is cached as a placeholder and filled in when a page is served.
+"""
+import hashlib
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db.models.signals import (pre_save, post_save, pre_delete, post_delete,
+                                      m2m_changed)
+from django.dispatch import receiver
+from jimi.catalog import lookup
+from jimi.catalog.models import Node, Variant, Variance
+from jimi.catalog.signals import stock_changed
+from jimi.catalog.snapshot import get_snapshot
+
+CSRF_PLACEHOLDER = "__jimi_csrf_token__"
+VERSION_KEY = "jimi.catalog.page.version.%s"
+VARIANTS = "variants"  # Version of variant and variance names
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+_changed = threading.local()
+
+
+def dependencies(page):
+    """Ids of the nodes the page of a node depends on."""
+    snapshot = get_snapshot()
+    return snapshot.ancestors(page, include_self=True) + snapshot.children(page)
+
+
+def versions(names):
+    """Current versions of nodes or other names, initialized where missing."""
+    keys = [VERSION_KEY % name for name in names]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            cache.add(key, int(time.time() * 1000), VERSION_TIMEOUT)
+            found[key] = cache.get(key)
+    return [found[key] for key in keys]
+
+
+def page_key(request, slug):
+    """Cache key of the page for a slug, or None if it is not to be cached."""
+    if request.method != "GET" or request.GET:
+        return None
+    entry = lookup.resolve(slug)
+    if entry is None or entry[2] not in get_snapshot():
+        return None
+    names = dependencies(entry[2]) + [VARIANTS]
+    fingerprint = "%s:%s:%s" % (entry[2], names, versions(names))
+    return "jimi.catalog.page.%s" % hashlib.md5(fingerprint).hexdigest()
+
+
+def get_page(key):
+    return key is not None and cache.get(key) or None
+
+
+def store_page(key, content):
+    timeout = getattr(settings, "CATALOG_PAGE_CACHE_TIMEOUT", 60 * 60)
+    if key is not None and timeout:
+        cache.set(key, content, timeout)
+
+
+def _incr(names):
+    for name in names:
+        try:
+            cache.incr(VERSION_KEY % name)
+        except ValueError:
+            pass  # Not depended on by any cached page
+
+
+def bump(names):
+    """Outdate the cached pages depending on the given nodes or names."""
+    _incr(names)
+    pending = getattr(_changed, "names", None)
+    if pending is None:
+        pending = _changed.names = set()
+    pending.update(names)
+
+
+def bump_with_ancestors(node_ids):
+    snapshot = get_snapshot()
+    names = set()
+    for node_id in node_ids:
+        names.add(node_id)
+        if node_id in snapshot:
+            names.update(snapshot.ancestors(node_id))
+    bump(names)
+
+
+@receiver(pre_save)
+def bump_on_activation(sender, instance, **kwargs):
+    """Outdate the ancestors of nodes switched active or inactive."""
+    if issubclass(sender, Node) and instance.pk is not None:
+        active = Node.objects.filter(pk=instance.pk).values_list("active", flat=True)
+        if list(active) not in ([instance.active], []):
+            bump_with_ancestors([instance.pk])
+
+
+@receiver(post_save)
+def bump_on_save(sender, instance, **kwargs):
+    if issubclass(sender, Node):
+        bump([instance.pk])
+    elif sender in (Variant, Variance):
+        bump([VARIANTS])
+
+
+@receiver(pre_delete)
+def bump_before_delete(sender, instance, **kwargs):
+    """Outdate the ancestors of nodes about to be deleted, their totals change."""
+    if issubclass(sender, Node):
+        bump_with_ancestors([instance.pk])
+
+
+@receiver(post_delete)
+def bump_on_delete(sender, instance, **kwargs):
+    if sender in (Variant, Variance):
+        bump([VARIANTS])
+
+
+@receiver(stock_changed)
+def bump_on_stock_change(sender, node_ids, **kwargs):
+    bump_with_ancestors(node_ids)
+
+
+@receiver(m2m_changed, sender=Node.variant.through)
+def bump_on_link(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ("post_add", "post_remove"):
+        bump_with_ancestors(reverse and pk_set or [instance.pk])
+    elif action == "post_clear":
+        if reverse:
+            bump([VARIANTS])
+        else:
+            bump_with_ancestors([instance.pk])
+
+
+@receiver(request_finished)
+def bump_after_request(sender, **kwargs):
+    """
+    Outdate changed pages again once the request changing them finished,
+    so pages rendered from data that was not committed yet are not kept.
+    """
+    names = getattr(_changed, "names", None)
+    if names:
+        _changed.names = None
+        _incr(names)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text search over the catalog.
+
+Active nodes are indexed into SearchTerm rows: one row per distinct term
+of a node, weighted by the fields the term occurs in. A query matches the
+nodes having every query word as a prefix of one of their terms, ranked
+by the weights of the matching terms. Rare words count for more than
+common ones, exact words for more than mere prefixes. Words shorter than
+MIN_PREFIX_LENGTH only match terms equal to them, as their prefixes would
+match a large part of the index. The database ranks the matches and only
+returns the best ones.
+
+The index is kept up to date whenever a node is saved. Code changing the
+catalog behind the ORM's back should call index() for the nodes it
+touched, or run the rebuild_search_index command.
+"""
+import math
+import re
+import unicodedata
+from django.db import connections, router
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from jimi.catalog.models import Node, SearchTerm
+
+# Indexed fields and the weight of each of their words.
+FIELD_WEIGHTS = (("name", 8),
+                 ("meta_keywords", 4),
+                 ("slug", 2),
+                 ("teaser", 2),
+                 ("meta_description", 2),
+                 ("description", 1))
+MAX_QUERY_TERMS = 8
+MIN_PREFIX_LENGTH = 3
+MAX_RESULTS = 200
+TERM_LENGTH = SearchTerm._meta.get_field('term').max_length
+
+_word = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """Lowercase words of a text with accents stripped, so "Kläder" is "klader"."""
+    text = unicodedata.normalize("NFKD", unicode(text or ""))
+    text = u"".join(c for c in text if not unicodedata.combining(c)).lower()
+    return [word[:TERM_LENGTH] for word in _word.findall(text)]
+
+
+def weigh(values):
+    """Weight of every term of a node, given its values of FIELD_WEIGHTS."""
+    weights = {}
+    for (field, weight), text in zip(FIELD_WEIGHTS, values):
+        for term in tokenize(text):
+            weights[term] = weights.get(term, 0) + weight
+    return weights
+
+
+def _write(rows):
+    """Replace the index entries of (pk, active, values) rows."""
+    SearchTerm.objects.filter(node__in=[row[0] for row in rows]).delete()
+    SearchTerm.objects.bulk_create([SearchTerm(node_id=pk, term=term, weight=weight)
+                                    for pk, active, values in rows if active
+                                    for term, weight in weigh(values).items()])
+
+
+def index(queryset=None, chunk_size=1000):
+    """Index the nodes of a queryset, all nodes by default. Returns their number."""
+    if queryset is None:
+        queryset = Node.objects.all()
+    fields = [field for field, weight in FIELD_WEIGHTS]
+    queryset = queryset.order_by("pk").values_list("pk", "active", *fields)
+    count = 0
+    rows = list(queryset[:chunk_size])
+    while rows:
+        _write([(row[0], row[1], row[2:]) for row in rows])
+        count += len(rows)
+        rows = list(queryset.filter(pk__gt=rows[-1][0])[:chunk_size])
+    return count
+
+
+def _matching(column, word, connection):
+    """SQL condition of the terms a query word matches, and its parameters."""
+    if len(word) < MIN_PREFIX_LENGTH:
+        return "%s = %%s" % column, [word]
+    return ("%s %s" % (column, connection.operators['startswith']),
+            [connection.ops.prep_for_like_query(word) + "%"])
+
+
+def find(query, limit=MAX_RESULTS):
+    """
+    Ids of the active nodes matching a query, at most ``limit`` of them,
+    best matches first.
+
+    Takes a query counting the nodes matching each word, then a single
+    one grouping, ranking and limiting the matches.
+    """
+    words = []
+    for word in tokenize(query):
+        if word not in words:
+            words.append(word)
+    words = words[:MAX_QUERY_TERMS]
+    if not words:
+        return []
+    connection = connections[router.db_for_read(SearchTerm)]
+    qn = connection.ops.quote_name
+    opts = SearchTerm._meta
+    term, node, weight = [qn(opts.get_field(name).column) for name in ("term", "node", "weight")]
+    conditions, scores, having, params, score_params, having_params = [], [], [], [], [], []
+    for word in words:
+        prefix = len(word) >= MIN_PREFIX_LENGTH and "term__startswith" or "term"
+        count = SearchTerm.objects.filter(**{prefix: word}).values("node").distinct().count()
+        if not count:
+            return []
+        rarity = 1 / math.log(2 + count)
+        condition, condition_params = _matching(term, word, connection)
+        conditions.append(condition)
+        params.extend(condition_params)
+        scores.append("CASE WHEN %s = %%s THEN %%s WHEN %s THEN %%s ELSE 0 END" % (term, condition))
+        score_params.extend([word, rarity] + condition_params + [rarity * 0.5])
+        having.append("SUM(CASE WHEN %s THEN 1 ELSE 0 END) > 0" % condition)
+        having_params.extend(condition_params)
+    sql = ("SELECT %(node)s, SUM(%(weight)s * (%(scores)s)) AS score FROM %(table)s "
+           "WHERE %(conditions)s GROUP BY %(node)s HAVING %(having)s "
+           "ORDER BY score DESC, %(node)s LIMIT %%s" % {
+               'node': node,
+               'weight': weight,
+               'scores': " + ".join(scores),
+               'table': qn(opts.db_table),
+               'conditions': " OR ".join(conditions),
+               'having': " AND ".join(having)})
+    cursor = connection.cursor()
+    cursor.execute(sql, score_params + params + having_params + [limit])
+    return [row[0] for row in cursor.fetchall()]
+
+
+@receiver(post_save)
+def index_on_save(sender, instance, **kwargs):
+    """Reindex a node whenever it is saved."""
+    if issubclass(sender, Node):
+        _write([(instance.pk, instance.active,
+                 [getattr(instance, field) for field, weight in FIELD_WEIGHTS])])
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent after the stock or pending counters of nodes changed, which also
+# changes the subtree totals of their ancestors.
+stock_changed = Signal(providing_args=["node_ids"])
@@ -0,0 +1,189 @@
+"""
+XML sitemap of the catalog pages.
+
+Active categories and products are listed in order of their ids, in chunks
+of at most CHUNK_SIZE URLs with a sitemap index pointing at the chunks.
+Variations are left out, they are shown on the page of their product.
+
+Each URL is built from the slug of its row, so a chunk is read in batches
+by id whatever the depth of the tree. Where the chunks start, together with
+the number, id range and newest ``updated`` of the rows each holds, is kept
+in an index file in CATALOG_SITEMAP_ROOT. It is read again from the
+database only when the same figures taken over all pages, one aggregate
+query, have changed.
+
+A chunk is written to CATALOG_SITEMAP_ROOT before it is streamed to the
+client, next to a fingerprint of its figures. As long as the fingerprint
+stays the same the chunk is served from that file.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from xml.sax.saxutils import escape
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db.models import Count, Max
+from jimi.catalog.models import Node
+
+CHUNK_SIZE = 50000  # URLs per sitemap, the limit of the protocol
+BATCH_SIZE = 2000  # Rows read per query
+
+INDEX_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+INDEX_FOOTER = '</sitemapindex>\n'
+INDEX_ENTRY = '<sitemap><loc>%s</loc><lastmod>%s</lastmod></sitemap>\n'
+HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+FOOTER = '</urlset>\n'
+ENTRY = '<url><loc>%s</loc><lastmod>%s</lastmod></url>\n'
+
+
+def root():
+    return getattr(settings, "CATALOG_SITEMAP_ROOT",
+                   os.path.join(tempfile.gettempdir(), "jimi-sitemaps"))
+
+
+def pages():
+    """Nodes having a page of their own, in order of their ids."""
+    return Node.objects.filter(active=True,
+                               kind__in=(Node.CATEGORY, Node.PRODUCT)).order_by("pk")
+
+
+def read_chunks():
+    """
+    First id, number of pages, last id and newest ``updated`` of every
+    chunk, reading the ids in batches.
+    """
+    chunks = []
+    last, count = 0, 0
+    while True:
+        batch = list(pages().filter(pk__gt=last).values_list("pk", "updated")[:BATCH_SIZE])
+        for i, (pk, updated) in enumerate(batch, count):
+            if i % CHUNK_SIZE == 0:
+                chunks.append({"start": pk, "count": 0, "updated": updated})
+            chunk = chunks[-1]
+            chunk["count"] += 1
+            chunk["last"] = pk
+            chunk["updated"] = max(chunk["updated"], updated)
+        if len(batch) < BATCH_SIZE:
+            break
+        last, count = batch[-1][0], count + len(batch)
+    for chunk in chunks:
+        chunk["lastmod"] = lastmod(chunk["updated"])
+        chunk["updated"] = chunk["updated"].isoformat()
+    return chunks
+
+
+def index_path():
+    return os.path.join(root(), "chunks.json")
+
+
+def chunks():
+    """
+    Chunks of the sitemap as read by read_chunks(), taken from the index
+    file as long as the pages have not changed since it was written.
+    """
+    stats = pages().aggregate(Count("pk"), Max("pk"), Max("updated"))
+    key = "%s:%s:%s:%s" % (CHUNK_SIZE, stats["pk__count"], stats["pk__max"],
+                           stats["updated__max"])
+    try:
+        with open(index_path()) as f:
+            index = json.load(f)
+        if index["key"] == key:
+            return index["chunks"]
+    except (IOError, ValueError, KeyError):
+        pass
+    chunks = read_chunks()
+    store(index_path(), [json.dumps({"key": key, "chunks": chunks})])
+    return chunks
+
+
+def chunk_nodes(chunks, number):
+    """Pages in chunk ``number``, or None if there is no such chunk."""
+    if not 0 <= number < len(chunks):
+        return None
+    return pages().filter(pk__range=(chunks[number]["start"], chunks[number]["last"]))
+
+
+def fingerprint(chunk, base_url):
+    """Key of what a chunk is generated from."""
+    key = "%s:%s:%s:%s:%s" % (base_url, chunk["start"], chunk["count"],
+                              chunk["last"], chunk["updated"])
+    return hashlib.md5(key).hexdigest()
+
+
+def lastmod(updated):
+    return updated.replace(microsecond=0).isoformat()
+
+
+def page_url_prefix():
+    """Path of node pages up to the slug."""
+    return reverse("node", kwargs={"slug": "-"})[:-2]
+
+
+def rows(nodes):
+    """Slugs and update times of the nodes, read in batches by id."""
+    last = 0
+    while True:
+        batch = list(nodes.filter(pk__gt=last).values_list("pk", "slug", "updated")[:BATCH_SIZE])
+        for row in batch:
+            yield row
+        if len(batch) < BATCH_SIZE:
+            break
+        last = batch[-1][0]
+
+
+def generate(nodes, base_url):
+    """Lines of the sitemap of some nodes, ``base_url`` ending in the slug prefix."""
+    yield HEADER
+    for pk, slug, updated in rows(nodes):
+        yield ENTRY % (escape(base_url + slug + "/"), lastmod(updated))
+    yield FOOTER
+
+
+def path(number):
+    return os.path.join(root(), "sitemap-%d.xml" % number)
+
+
+def cached(number, key):
+    """File of a chunk if it was generated from the same fingerprint, or None."""
+    try:
+        with open(path(number) + ".key") as f:
+            if f.read() == key:
+                return open(path(number))
+    except IOError:
+        pass
+    return None
+
+
+def store(name, lines, key=None):
+    """
+    Write lines to a file, and ``key`` next to it if given, all or nothing.
+    """
+    if not os.path.isdir(root()):
+        os.makedirs(root())
+    fd, temp = tempfile.mkstemp(dir=root(), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            for line in lines:
+                f.write(line.encode("utf-8"))
+        if key is not None:
+            with open(temp + ".key", "w") as f:
+                f.write(key)
+        os.rename(temp, name)
+        if key is not None:
+            os.rename(temp + ".key", name + ".key")
+    finally:
+        for leftover in (temp, temp + ".key"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def generate_and_store(number, key, lines):
+    """
+    Write the lines of a chunk to its file, returning the file opened for
+    reading. Nothing is kept if writing fails.
+    """
+    store(path(number), lines, key)
+    return open(path(number))
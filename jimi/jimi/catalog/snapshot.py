@@ -0,0 +1,255 @@
+"""
+Read-only in-process snapshot of the whole catalog tree.
+
+The catalog changes rarely compared to how often it is browsed, so every
+process keeps one compact copy of the tree structure in memory. Saving or
+deleting a node bumps a generation counter kept in the Django cache, which
+is shared between processes; the snapshot is rebuilt lazily on the next
+access after the counter moved. A cache kept per process, like locmem,
+would leave the other processes serving the old catalog, so it is refused
+unless the CATALOG_SINGLE_PROCESS setting says only one process runs.
+
+The counter is bumped once more when the request that changed the catalog
+has finished, so a snapshot built by another process while the change was
+not committed yet is not kept. Code changing the catalog outside of
+requests or behind the ORM's back should call invalidate() when done.
+
+Stock moves far more often than the tree, so it has a counter of its own:
+moving stock leaves the tree generation alone, and a snapshot reloads just
+its stock column the next time a stock is asked for after that counter
+moved.
+"""
+import threading
+import time
+from array import array
+from decimal import Decimal
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_finished
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from jimi.catalog.models import Node
+from jimi.catalog.signals import stock_changed
+from jimi.price.arrays import DECIMAL_PLACES, to_minor
+from jimi.price.fields import Money, Currency
+from jimi.routers import read_primary
+
+GENERATION_KEY = "jimi.catalog.snapshot.generation"
+STOCK_GENERATION_KEY = "jimi.catalog.snapshot.stock_generation"
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+_lock = threading.Lock()
+_snapshot = None
+_changed = threading.local()
+
+
+def check_cache(cache=cache):
+    """
+    Refuses a cache that is not shared between processes.
+
+    The snapshot, facet index, page cache and stock versions of every
+    process are invalidated through it.
+    """
+    if (isinstance(cache, LocMemCache) and
+            not getattr(settings, "CATALOG_SINGLE_PROCESS", False)):
+        raise ImproperlyConfigured(
+            "The catalog needs a cache shared between processes, not %s; "
+            "set CATALOG_SINGLE_PROCESS if only one process serves the shop"
+            % cache.__class__.__name__)
+
+check_cache()
+
+
+class TreeSnapshot(object):
+    """
+    Catalog tree held in parallel arrays.
+
+    Rows are stored in tree order (tree_id, lft), so the descendants of the
+    node at position ``i`` are the rows from ``i + 1`` up to ``ends[i]``.
+    Prices are kept in minor units (cents), rounded half to even, next to
+    their currency code.
+    """
+    def __init__(self, rows, generation=None, stock_generation=None):
+        self.generation = generation
+        self.stock_generation = stock_generation
+        self.ids = array('l')
+        self.parents = array('l')  # 0 for root nodes
+        self.tree_ids = array('l')
+        self.lfts = array('l')
+        self.rghts = array('l')
+        self.ends = array('l')
+        self.prices = array('l')
+        self.stocks = array('l')
+        self.kinds = []
+        self.slugs = []
+        self.currencies = []
+        self._positions = {}
+        self._slugs = {}
+        price_field = Node._meta.get_field('_price')
+        stack = []  # positions of open ancestors
+        for pk, parent, tree_id, lft, rght, kind, slug, price, currency, stock in rows:
+            i = len(self.ids)
+            while stack and (self.tree_ids[stack[-1]] != tree_id or
+                             self.rghts[stack[-1]] < lft):
+                self.ends[stack.pop()] = i
+            price = price_field.money(price, currency) or Money(0)
+            self.ids.append(pk)
+            self.parents.append(parent or 0)
+            self.tree_ids.append(tree_id)
+            self.lfts.append(lft)
+            self.rghts.append(rght)
+            self.ends.append(i + 1)
+            self.prices.append(to_minor(price.amount))
+            self.stocks.append(stock)
+            self.kinds.append(kind)
+            self.slugs.append(slug)
+            self.currencies.append(intern(str(price.currency)))
+            self._positions[pk] = i
+            self._slugs[slug] = i
+            stack.append(i)
+        while stack:
+            self.ends[stack.pop()] = len(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, node_id):
+        return node_id in self._positions
+
+    def position(self, node_id):
+        """Row of a node; raises KeyError for unknown ids."""
+        return self._positions[node_id]
+
+    def by_slug(self, slug):
+        """Id of the node with the given slug, or None."""
+        i = self._slugs.get(slug)
+        return i is not None and self.ids[i] or None
+
+    def kind(self, node_id):
+        return self.kinds[self._positions[node_id]]
+
+    def slug(self, node_id):
+        return self.slugs[self._positions[node_id]]
+
+    def ancestors(self, node_id, ascending=False, include_self=False):
+        """Ids of the ancestors of a node, from the root unless ascending."""
+        result = include_self and [node_id] or []
+        parent = self.parents[self._positions[node_id]]
+        while parent:
+            result.append(parent)
+            parent = self.parents[self._positions[parent]]
+        if not ascending:
+            result.reverse()
+        return result
+
+    def descendants(self, node_id, include_self=False):
+        """Ids of the descendants of a node in tree order."""
+        i = self._positions[node_id]
+        start = i if include_self else i + 1
+        return self.ids[start:self.ends[i]].tolist()
+
+    def children(self, node_id):
+        """Ids of the direct children of a node in tree order."""
+        i = self._positions[node_id]
+        result = []
+        j = i + 1
+        while j < self.ends[i]:
+            result.append(self.ids[j])
+            j = self.ends[j]
+        return result
+
+    def stock(self, node_id):
+        """Stock of a node and its descendants."""
+        i = self._positions[node_id]
+        return sum(self._current_stocks()[i:self.ends[i]])
+
+    def _current_stocks(self):
+        """Stock column, reloaded if stock moved since it was read."""
+        generation = current_generation(STOCK_GENERATION_KEY)
+        if self.stock_generation is not None and self.stock_generation != generation:
+            stocks = array('l', [0]) * len(self.ids)
+            with read_primary():
+                for pk, stock in Node.objects.values_list('pk', '_stock').iterator():
+                    i = self._positions.get(pk)
+                    if i is not None:
+                        stocks[i] = stock
+            self.stocks, self.stock_generation = stocks, generation
+        return self.stocks
+
+    def price(self, node_id):
+        """Price of a node accumulated from its ancestors."""
+        total = Money(0)
+        for pk in self.ancestors(node_id, include_self=True):
+            i = self._positions[pk]
+            total += Money(amount=Decimal(self.prices[i]).scaleb(-DECIMAL_PLACES),
+                           currency=Currency(self.currencies[i]))
+        return total
+
+
+def build_snapshot(generation=None):
+    """Read the catalog tree with a single query."""
+    stock_generation = current_generation(STOCK_GENERATION_KEY)  # Read first, moves since reload
+    rows = Node.objects.values_list('pk', 'parent', 'tree_id', 'lft', 'rght',
+                                    'kind', 'slug', '_price', '_price_currency', '_stock')
+    with read_primary():
+        return TreeSnapshot(rows.iterator(), generation, stock_generation)
+
+
+def current_generation(key=GENERATION_KEY):
+    """Generation of the catalog, or its stock, as seen by all processes sharing the cache."""
+    generation = cache.get(key)
+    if generation is None:  # Expired or evicted, start somewhere new
+        cache.add(key, int(time.time() * 1000), GENERATION_TIMEOUT)
+        generation = cache.get(key)
+    return generation
+
+
+def get_snapshot():
+    """Snapshot of the catalog tree, rebuilt if the catalog changed."""
+    global _snapshot
+    generation = current_generation()
+    snapshot = _snapshot
+    if snapshot is None or snapshot.generation != generation:
+        with _lock:
+            snapshot = _snapshot
+            if snapshot is None or snapshot.generation != generation:
+                snapshot = _snapshot = build_snapshot(generation)
+    return snapshot
+
+
+def invalidate(key=GENERATION_KEY):
+    """Mark all snapshots, or only their stock with STOCK_GENERATION_KEY, as outdated."""
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000), GENERATION_TIMEOUT)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_on_change(sender, **kwargs):
+    """Outdate snapshots whenever a catalog node is saved or deleted."""
+    if issubclass(sender, Node):
+        _changed.pending = True
+        invalidate()
+
+
+@receiver(stock_changed)
+def invalidate_stock_on_change(sender, **kwargs):
+    """Outdate the stock of snapshots whenever stock moved."""
+    if issubclass(sender, Node):
+        _changed.stock_pending = True
+        invalidate(STOCK_GENERATION_KEY)
+
+
+@receiver(request_finished)
+def invalidate_after_request(sender, **kwargs):
+    """Outdate snapshots again once changes made by a request are committed."""
+    if getattr(_changed, 'pending', False):
+        _changed.pending = False
+        invalidate()
+    if getattr(_changed, 'stock_pending', False):
+        _changed.stock_pending = False
+        invalidate(STOCK_GENERATION_KEY)
@@ -1 +1,6 @@
-from tests import NodeTest, CategoryTest, ProductTest
+from tests import (NodeTest, RollupTest, EffectivePriceTest, EffectiveSupplierTest,
+                   SnapshotTest, ImportTest, ExportTest, LookupTest, SearchTest,
+                   FacetTest, StockTest, StockContentionTest,
+                   RouterTest, ConditionalTest, PageCacheTest, AncestryTest,
+                   SitemapTest, ApiTest, GapTreeTest, PathTest, TreeLockTest,
+                   CategoryTest, ProductTest)
@@ -1,8 +1,41 @@
-from django.test import TestCase
-from jimi.catalog import models
+import json
+import os
+import shutil
+import tempfile
+import threading
+from decimal import Decimal
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import connection, connections, transaction
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils.unittest import skipIf, skipUnless
+from django.core.management import call_command
+from django.core.management.commands import syncdb
+from jimi.catalog import ancestry, facets, lookup, matrix, models, pagecache, search, snapshot
+from jimi.catalog import sitemap
+from jimi import routers
+from jimi.lists.models import Item
 from jimi.price.fields import Money
 
 
+def make_node(slug, parent=None, kind=models.Node.PRODUCT, **kwargs):
+    """Create and save a catalog node with sensible defaults."""
+    kwargs.setdefault("_price", Money(0))
+    node = models.Node(name=slug, slug=slug, kind=kind, parent=parent,
+                       teaser="", description="", active=True,
+                       meta_keywords="", meta_description="", **kwargs)
+    node.save()
+    return node
+
+
+def reload(node):
+    return models.Node.objects.get(pk=node.pk)
+
+
 class NodeTest(TestCase):
     def test_price(self):
         """Tests that price accumulation works."""
@@ -10,9 +43,1422 @@ class NodeTest(TestCase):
         self.assertGreaterEqual(self.node.price, Money())
 
 
+class RollupTest(TestCase):
+    def setUp(self):
+        self.root = models.Node.objects.get(slug="software")
+        self.category = models.Node.objects.get(slug="damklader")
+        self.product = models.Node.objects.get(slug="bh")
+
+    def test_read_without_queries(self):
+        """Tests that rollups are read from the row."""
+        with self.assertNumQueries(0):
+            self.assertEqual(self.root.stock, 3)
+            self.assertEqual(self.root.stock_available, 3)
+            self.assertEqual(self.category.pending_supplier, 0)
+
+    def test_leaf_change(self):
+        """Tests that changing a leaf updates all ancestors."""
+        self.product.stock = 7
+        self.product.pending_customer = 2
+        self.assertEqual(self.product.stock, 7)
+        self.product.save()
+        self.assertEqual(reload(self.root).stock, 7)
+        self.assertEqual(reload(self.category).stock_available, 5)
+        self.assertEqual(reload(self.product).pending_customer, 2)
+
+    def test_stale_instance(self):
+        """Tests that saving a stale ancestor keeps its rollup intact."""
+        stale = reload(self.category)
+        self.product.stock = 10
+        self.product.save()
+        stale.name = "Renamed"
+        stale.save()
+        self.assertEqual(reload(self.category).stock, 10)
+
+    def test_stale_counters(self):
+        """Tests that saving a stale node keeps the stock moved since it was loaded."""
+        self.product.stock = 10
+        self.product.save()
+        stale = reload(self.product)
+        models.Node.objects.reserve([(self.product, 3)])
+        stale.name = "Renamed"
+        stale.save()
+        product = reload(self.product)
+        self.assertEqual((product._stock, product._pending_customer), (10, 3))
+        self.assertEqual(reload(self.root).pending_customer, 3)
+        self.assertEqual(stale.pending_customer, 3)
+        models.Node.objects.commit([(self.product, 1)])
+        product.stock = 15
+        product.save()
+        self.assertEqual(reload(self.product).stock, 14)
+        self.assertEqual(reload(self.root).stock, 14)
+        self.assertTrue(product.release(2))
+        product.save()
+        self.assertEqual(reload(self.product).pending_customer, 0)
+        self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+
+    def test_insert_move_delete(self):
+        """Tests that rollups follow inserts, moves and deletes."""
+        node = make_node("extra", parent=self.category, _stock=4)
+        self.assertEqual(reload(self.root).stock, 7)
+        self.assertEqual(reload(self.category).stock, 7)
+        node.parent = models.Node.objects.get(slug="hardware")
+        node.save()
+        self.assertEqual(reload(self.category).stock, 3)
+        self.assertEqual(models.Node.objects.get(slug="hardware").stock, 4)
+        reload(node).delete()
+        self.assertEqual(models.Node.objects.get(slug="hardware").stock, 0)
+        self.assertEqual(reload(self.root).stock, 3)
+
+    def test_rebuild(self):
+        """Tests that the rebuild command repairs rollups."""
+        models.Node.objects.filter(pk=self.product.pk).update(_stock=11)
+        models.Node.objects.filter(pk=self.root.pk).update(_pending_customer_total=5)
+        call_command("rebuild_catalog", verbosity=0)
+        self.assertEqual(reload(self.root).stock, 11)
+        self.assertEqual(reload(self.root).pending_customer, 0)
+        self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+
+
+class EffectivePriceTest(TestCase):
+    def setUp(self):
+        self.category = models.Node.objects.get(slug="klader")
+        self.product = models.Node.objects.get(slug="tolles-hemd")
+        self.variation = models.Node.objects.get(slug="tolles-hemd-rot")
+
+    def test_read_without_queries(self):
+        """Tests that price is read from the row."""
+        with self.assertNumQueries(0):
+            self.assertEqual(self.variation.price, Money("14.00", "SEK"))
+            self.assertEqual(self.product.price, Money("12.00", "SEK"))
+
+    def test_cascade(self):
+        """Tests that a price change is cascaded to the subtree only."""
+        self.category.price = Money("20.00", "SEK")
+        self.assertEqual(self.category.price, Money("20.00", "SEK"))
+        self.category.save()
+        self.assertEqual(reload(self.product).price, Money("22.00", "SEK"))
+        self.assertEqual(reload(self.variation).price, Money("24.00", "SEK"))
+        self.assertEqual(models.Node.objects.get(slug="software").price, Money("0.00", "SEK"))
+        self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+
+    def test_insert_and_move(self):
+        """Tests that new and moved nodes pick up inherited prices."""
+        node = make_node("cheap", parent=self.product, _price=Money("1.00", "SEK"))
+        self.assertEqual(reload(node).price, Money("13.00", "SEK"))
+        self.product.parent = models.Node.objects.get(slug="hardware")
+        self.product.save()
+        self.assertEqual(reload(node).price, Money("3.00", "SEK"))
+        self.assertEqual(reload(self.variation).price, Money("4.00", "SEK"))
+
+    def test_queries(self):
+        """Tests that the database filters, orders and sums effective prices."""
+        nodes = models.Node.objects.filter(_effective_price__gte=Money("12.00", "SEK"))
+        prices = [node.price for node in nodes.order_by("_effective_price", "pk")]
+        self.assertEqual(prices, sorted(prices))
+        self.assertIn(self.product.price, prices)
+        self.assertNotIn(self.category.price, prices)
+        self.assertFalse(nodes.filter(_effective_price__gte=Money("12.00", "EUR")).exists())
+        self.assertEqual(nodes.money_aggregate("_effective_price"), {"SEK": sum(prices, Money(0))})
+
+    def test_other_database(self):
+        """Tests that saving to another database reads the inherited values from there."""
+        connections.databases["other"] = {"ENGINE": "django.db.backends.sqlite3",
+                                          "NAME": ":memory:"}
+        try:
+            syncdb.Command().execute(database="other", interactive=False, verbosity=0,
+                                     load_initial_data=True)
+            other = models.Node.objects.using("other")
+            other.filter(pk=self.category.pk).update(_effective_price=Money("50.00", "SEK"))
+            product = other.get(pk=self.product.pk)
+            product.supplier = "Other"
+            product.save(using="other")
+            price = Money("50.00", "SEK") + product._price
+            self.assertEqual(other.get(pk=self.product.pk).price, price)
+            self.assertEqual(other.get(pk=self.variation.pk).price, price + self.variation._price)
+            self.assertEqual(reload(self.variation).price, Money("14.00", "SEK"))
+            self.assertEqual(reload(self.variation).supplier, self.variation.supplier)
+        finally:
+            connections["other"].close()
+            del connections.databases["other"]
+            del connections._connections.other
+
+    def test_rebuild(self):
+        """Tests that rebuilding repairs effective prices."""
+        models.Node.objects.filter(pk=self.category.pk).update(_price=Money("1.00", "SEK"))
+        self.assertEqual(models.Node.objects.rebuild_derived(), 8)
+        self.assertEqual(reload(self.variation).price, Money("5.00", "SEK"))
+
+
+class EffectiveSupplierTest(TestCase):
+    def setUp(self):
+        self.category = models.Node.objects.get(slug="klader")
+        self.product = models.Node.objects.get(slug="tolles-hemd")
+        self.variation = models.Node.objects.get(slug="tolles-hemd-rot")
+
+    def test_inheritance(self):
+        """Tests that suppliers are inherited from the closest ancestor."""
+        self.assertEqual(self.variation.supplier, None)
+        self.category.supplier = "Acme"
+        self.category.save()
+        self.product.supplier = "Hemdfabrik"
+        self.product.save()
+        variation = reload(self.variation)
+        with self.assertNumQueries(0):
+            self.assertEqual(variation.supplier, "Hemdfabrik")
+        self.assertEqual(models.Node.objects.get(slug="bh").supplier, "Acme")
+        self.assertEqual(models.Node.objects.get(slug="hardware").supplier, None)
+        self.assertEqual(list(models.Node.objects.filter(_effective_supplier="Hemdfabrik")
+                              .values_list("slug", flat=True)),
+                         ["tolles-hemd", "tolles-hemd-blau",
+                          "tolles-hemd-braun", "tolles-hemd-rot"])
+
+    def test_rebuild(self):
+        """Tests that rebuilding repairs effective suppliers."""
+        models.Node.objects.filter(pk=self.category.pk).update(_supplier="Acme")
+        models.Node.objects.rebuild_derived()
+        self.assertEqual(reload(self.variation).supplier, "Acme")
+
+
+class SnapshotTest(TestCase):
+    def setUp(self):
+        snapshot.invalidate()  # Rolled back changes of other tests
+        self.snapshot = snapshot.get_snapshot()
+        self.ids = dict(models.Node.objects.values_list("slug", "pk"))
+
+    def test_structure(self):
+        """Tests ancestor chains, descendant ranges and children."""
+        ids = self.ids
+        self.assertEqual(self.snapshot.ancestors(ids["tolles-hemd-rot"]),
+                         [ids["software"], ids["klader"], ids["tolles-hemd"]])
+        self.assertEqual(self.snapshot.descendants(ids["klader"]),
+                         list(models.Node.objects.get(slug="klader")
+                              .get_descendants().values_list("pk", flat=True)))
+        self.assertEqual(self.snapshot.descendants(ids["hardware"], include_self=True),
+                         [ids["hardware"], ids["schmuck"]])
+        self.assertEqual(self.snapshot.children(ids["klader"]),
+                         [ids["damklader"], ids["tolle-hose"], ids["tolles-hemd"]])
+        self.assertEqual(self.snapshot.by_slug("bh"), ids["bh"])
+        self.assertEqual(self.snapshot.kind(ids["bh"]), models.Node.PRODUCT)
+
+    def test_rollups(self):
+        """Tests that rollups match the database."""
+        for slug in ("software", "damklader", "tolles-hemd-rot"):
+            node = models.Node.objects.get(slug=slug)
+            self.assertEqual(self.snapshot.stock(node.pk), node.stock)
+            self.assertEqual(self.snapshot.price(node.pk), node.price)
+
+    def test_minor_units(self):
+        """Tests that prices are kept in hundredths as read, floats included."""
+        tree = snapshot.TreeSnapshot([(1, None, 1, 1, 4, "c", "a", 0.29, "SEK", 0),
+                                      (2, 1, 1, 2, 3, "p", "b", Decimal("-1.15"), "SEK", 0)])
+        self.assertEqual(list(tree.prices), [29, -115])
+        self.assertEqual(tree.price(2), Money("-0.86", "SEK"))
+
+    def test_invalidation(self):
+        """Tests that the snapshot is shared and rebuilt after changes."""
+        with self.assertNumQueries(0):
+            self.assertTrue(snapshot.get_snapshot() is self.snapshot)
+        make_node("fresh", parent=models.Node.objects.get(slug="hardware"))
+        rebuilt = snapshot.get_snapshot()
+        self.assertFalse(rebuilt is self.snapshot)
+        self.assertTrue(rebuilt.by_slug("fresh") in rebuilt.children(self.ids["hardware"]))
+
+    def test_stock_moves(self):
+        """Tests that moving stock reloads the stock but keeps the snapshot."""
+        generation = snapshot.current_generation()
+        before = self.snapshot.stock(self.ids["damklader"])
+        bh = models.Node.objects.get(slug="bh")
+        self.assertTrue(bh.reserve(1))
+        self.assertTrue(bh.commit(1))
+        self.assertEqual(snapshot.current_generation(), generation)
+        self.assertTrue(snapshot.get_snapshot() is self.snapshot)
+        self.assertEqual(self.snapshot.stock(self.ids["damklader"]), before - 1)
+        self.assertEqual(self.snapshot.stock(self.ids["damklader"]),
+                         models.Node.objects.get(slug="damklader").stock)
+
+    def test_shared_cache(self):
+        """Tests that a cache kept per process is refused unless allowed."""
+        local = LocMemCache("snapshot-test", {})
+        with override_settings(CATALOG_SINGLE_PROCESS=False):
+            self.assertRaises(ImproperlyConfigured, snapshot.check_cache, local)
+            snapshot.check_cache()  # The configured one is shared
+        with override_settings(CATALOG_SINGLE_PROCESS=True):
+            snapshot.check_cache(local)
+
+
+class ImportTest(TestCase):
+    def import_file(self, suffix, content):
+        with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+            f.write(content)
+            f.flush()
+            call_command("import_catalog", f.name, verbosity=0, batch_size=2)
+
+    def assertValidTree(self):
+        """Checks tree fields against a renumbering by MPTT itself."""
+        def state():
+            # MPTT orders trees by root name, new trees are appended on import
+            trees = {}
+            for row in models.Node.objects.values_list("tree_id", "pk", "lft", "rght", "level"):
+                trees.setdefault(row[0], []).append(row[1:])
+            return sorted(sorted(rows) for rows in trees.values())
+        before = state()
+        models.Node.objects.rebuild()
+        self.assertEqual(before, state())
+
+    def test_csv(self):
+        """Tests importing CSV into a new tree and below existing nodes."""
+        variant = models.Variant.objects.create(
+            name="red", variance=models.Variance.objects.create(name="Colour"))
+        self.import_file(".csv", "\n".join([
+            "kind,name,slug,parent,price,stock,variants",
+            "c,Shoes,,,SEK 100.00,,",
+            "p,Boot,,shoes,SEK 50.00,,",
+            "v,Boot,,boot,,4,%d" % variant.pk,
+            "p,Anorak,,klader,SEK 1.00,2,",
+            "c,Accessories,,,,,"]))
+        boot = models.Node.objects.get(slug="boot-2")
+        self.assertEqual(boot.kind, models.Node.VARIATION)
+        self.assertEqual(list(boot.variant.all()), [variant])
+        self.assertEqual(boot.price, Money("150.00", "SEK"))
+        self.assertEqual(models.Node.objects.get(slug="shoes").stock, 4)
+        self.assertEqual(models.Node.objects.get(slug="software").stock, 5)
+        self.assertEqual(models.Node.objects.get(slug="anorak").price, Money("11.00", "SEK"))
+        self.assertEqual(list(models.Node.objects.get(slug="klader").get_children()
+                              .values_list("slug", flat=True)),
+                         ["anorak", "damklader", "tolle-hose", "tolles-hemd"])
+        self.assertValidTree()
+
+    def test_jsonl(self):
+        """Tests importing JSON Lines with explicit slugs."""
+        self.import_file(".jsonl", "\n".join([
+            '{"name": "Hats", "kind": "c", "slug": "hats", "supplier": "Acme"}',
+            '{"name": "Fedora", "parent": "hats", "stock": 1, "variants": []}']))
+        fedora = models.Node.objects.get(slug="fedora")
+        self.assertEqual(fedora.supplier, "Acme")
+        self.assertEqual(fedora.get_ancestors()[0].slug, "hats")
+        self.assertValidTree()
+
+
+class ExportTest(TestCase):
+    def export(self, fmt):
+        with tempfile.NamedTemporaryFile() as f:
+            call_command("export_catalog", format=fmt, output=f.name, chunk_size=3)
+            return f.read()
+
+    def test_jsonl(self):
+        """Tests that the export lists every node in tree order with derived values."""
+        records = [json.loads(line) for line in self.export("jsonl").splitlines()]
+        self.assertEqual([r["slug"] for r in records],
+                         list(models.Node.objects.values_list("slug", flat=True)))
+        rot = [r for r in records if r["slug"] == "tolles-hemd-rot"][0]
+        self.assertEqual(rot["parent"], "tolles-hemd")
+        self.assertEqual(rot["effective_price"], "SEK 14.00")
+        self.assertEqual(rot["variants"],
+                         list(models.Node.objects.get(slug="tolles-hemd-rot").variant.values_list("pk", flat=True)))
+        self.assertEqual(records[0]["stock_total"], models.Node.objects.get(slug=records[0]["slug"]).stock)
+
+    def test_round_trip(self):
+        """Tests that an exported catalog imports back unchanged."""
+        exported = self.export("csv")
+        models.Node.objects.all().delete()
+        with tempfile.NamedTemporaryFile(suffix=".csv") as f:
+            f.write(exported)
+            f.flush()
+            call_command("import_catalog", f.name, verbosity=0)
+        self.assertEqual(self.export("csv"), exported)
+
+
+class LookupTest(TestCase):
+    def setUp(self):
+        lookup.slugs.clear()
+        cache.clear()
+
+    def test_lru(self):
+        """Tests that the least recently used slug is evicted first."""
+        cache = lookup.SlugCache(2)
+        cache.set("a", (1, "p", 1))
+        cache.set("b", (2, "v", 1))
+        cache.get("a")
+        cache.set("c", (3, "p", 3))
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), (1, "p", 1))
+        cache.discard(1)
+        self.assertEqual(len(cache), 1)
+
+    def test_resolve(self):
+        """Tests that variations resolve to their product without queries once cached."""
+        rot = models.Node.objects.get(slug="tolles-hemd-rot")
+        entry = (rot.pk, models.Node.VARIATION, rot.parent_id)
+        self.assertEqual(lookup.resolve("tolles-hemd-rot"), entry)
+        with self.assertNumQueries(0):
+            self.assertEqual(lookup.resolve("tolles-hemd-rot"), entry)
+        self.assertEqual(lookup.resolve("missing"), None)
+
+    def test_invalidation(self):
+        """Tests that renamed and deleted nodes drop out of the cache."""
+        node = models.Node.objects.get(slug="bh")
+        lookup.resolve("bh")
+        node.slug = "bra"
+        node.save()
+        self.assertEqual(lookup.resolve("bh"), None)
+        self.assertEqual(lookup.resolve("bra")[0], node.pk)
+        node.delete()
+        self.assertEqual(lookup.resolve("bra"), None)
+
+    def test_view(self):
+        """Tests that variation URLs show the product page."""
+        response = self.client.get("/catalog/tolles-hemd-rot/")
+        self.assertEqual(response.context["node"].slug, "tolles-hemd")
+        self.assertEqual(self.client.get("/catalog/missing/").status_code, 404)
+
+    def test_view_stale(self):
+        """Tests that entries outdated by other processes are resolved again."""
+        rot = models.Node.objects.get(slug="tolles-hemd-rot")
+        for slug in ("tolles-hemd-rot", "tolles-hemd-blau", "bh"):
+            lookup.resolve(slug)
+        # Changed behind the signals, as by another process
+        models.Node.objects.filter(pk=rot.pk).update(parent=models.Node.objects.get(slug="bh"))
+        models.Node.objects.filter(slug="tolles-hemd-blau").update(slug="tolles-hemd-blue")
+        models.Node.objects.filter(slug="bh").update(slug="bra")
+        self.assertEqual(self.client.get("/catalog/tolles-hemd-blau/").status_code, 404)
+        self.assertEqual(self.client.get("/catalog/bh/").status_code, 404)
+        response = self.client.get("/catalog/tolles-hemd-rot/")
+        self.assertEqual(response.context["node"].slug, "bra")
+
+
+class SearchTest(TestCase):
+    def slugs(self, query):
+        return list(models.Node.objects.get(pk=pk).slug for pk in search.find(query))
+
+    def test_tokenize(self):
+        """Tests that words are lowercased and stripped of accents."""
+        self.assertEqual(search.tokenize(u"Damkl\xe4der, T-Shirt"), ["damklader", "t", "shirt"])
+
+    def test_find(self):
+        """Tests prefix matching of all words and ranking by field."""
+        self.assertEqual(self.slugs("klader"), ["klader"])
+        self.assertEqual(self.slugs("dam"), ["damklader"])
+        self.assertEqual(self.slugs("tolles hemd bra"), ["tolles-hemd-braun"])
+        self.assertEqual(self.slugs("tolle")[0], "tolle-hose")  # Exact word first
+        self.assertEqual(self.slugs("hemd hose"), [])
+        self.assertEqual(search.find(""), [])
+
+    def test_short_words(self):
+        """Tests that words shorter than the minimum prefix only match whole terms."""
+        self.assertEqual(self.slugs("bh"), ["bh"])
+        self.assertEqual(self.slugs("tolles hemd br"), [])
+        self.assertEqual(self.slugs("kl"), [])
+
+    def test_limit(self):
+        """Tests that matches are ranked and limited by the database."""
+        for i in range(25):
+            make_node("shoe-%d" % i)
+        with self.assertNumQueries(3):  # A count per word and the matches
+            found = search.find("shoe tolle", limit=10)
+        self.assertEqual(found, [])
+        found = search.find("shoe", limit=10)
+        self.assertEqual(len(found), 10)
+        self.assertEqual(found, search.find("shoe")[:10])
+
+    def test_incremental(self):
+        """Tests that saved nodes are reindexed and inactive ones dropped."""
+        node = models.Node.objects.get(slug="bh")
+        node.name = "Bustier"
+        node.save()
+        self.assertEqual(self.slugs("bust"), ["bh"])
+        self.assertEqual(self.slugs("BH"), ["bh"])  # Still in the slug
+        node.active = False
+        node.save()
+        self.assertEqual(self.slugs("bust"), [])
+
+    def test_view(self):
+        """Tests paginated search results."""
+        for i in range(25):
+            make_node("shoe-%d" % i)
+        response = self.client.get("/catalog/search/", {"q": "shoe", "page": 2})
+        self.assertEqual(response.context["paginator"].count, 25)
+        self.assertEqual(len(response.context["nodes"]), 5)
+        self.assertEqual(self.client.get("/catalog/search/", {"q": "shoe", "page": 3}).status_code, 404)
+
+    def test_reserved_slug(self):
+        """Tests that nodes cannot take the slug of the search page."""
+        field = models.Node._meta.get_field("slug")
+        self.assertRaises(ValidationError, field.clean, "search", None)
+        self.assertEqual(field.clean("searches", None), "searches")
+        self.assertEqual(self.client.get("/catalog/search/").context["query"], "")
+
+
+class FacetTest(TestCase):
+    def setUp(self):
+        snapshot.invalidate()
+        facets.invalidate()
+        size = models.Variance.objects.create(name="Size")
+        colour = models.Variance.objects.create(name="Colour")
+        self.v42 = models.Variant.objects.create(name="42", variance=size)
+        self.v43 = models.Variant.objects.create(name="43", variance=size)
+        self.red = models.Variant.objects.create(name="red", variance=colour)
+        self.nodes = dict((n.slug, n) for n in models.Node.objects.all())
+        self.nodes["tolles-hemd-rot"].variant.add(self.v42, self.red)
+        self.nodes["tolles-hemd-blau"].variant.add(self.v42)
+        self.nodes["tolle-hose"].variant.add(self.v43)
+
+    def products(self, variants, within=None):
+        index = facets.get_index()
+        return [index.snapshot.slug(pk)
+                for pk in index.products(index.match([v.pk for v in variants], within))]
+
+    def test_match(self):
+        """Tests that variances are combined with and, their variants with or."""
+        self.assertEqual(self.products([self.v42, self.red]), ["tolles-hemd"])
+        self.assertEqual(self.products([self.v42, self.v43]), ["tolle-hose", "tolles-hemd"])
+        self.assertEqual(self.products([self.v42], within=self.nodes["damklader"].pk), [])
+        index = facets.get_index()
+        self.assertEqual(index.nodes(index.match([self.red.pk])), [self.nodes["tolles-hemd-rot"].pk])
+
+    def test_counts(self):
+        """Tests that facet counts ignore the selection of their own variance."""
+        index = facets.get_index()
+        self.assertEqual(index.counts([self.v42.pk]), {self.v42.pk: 2, self.v43.pk: 1, self.red.pk: 1})
+        self.assertEqual(index.counts([self.v42.pk, self.red.pk]),
+                         {self.v42.pk: 1, self.red.pk: 1})
+
+    def test_incremental(self):
+        """Tests that link and active changes update the index in place."""
+        index = facets.get_index()
+        self.nodes["tolles-hemd-braun"].variant.add(self.red)
+        hemd = self.nodes["tolles-hemd"]
+        hemd.active = False
+        hemd.save()
+        self.red.active = False
+        self.red.save()
+        with self.assertNumQueries(1):  # Only the snapshot is read again
+            self.assertTrue(facets.get_index() is index)
+        self.assertEqual(index.counts(), {self.v42.pk: 2, self.v43.pk: 1})
+        self.nodes["tolles-hemd-blau"].variant.clear()
+        self.assertEqual(index.counts(), {self.v42.pk: 1, self.v43.pk: 1})
+
+    def test_view(self):
+        """Tests filtering a category page by variant."""
+        response = self.client.get("/catalog/klader/", {"variant": self.v43.pk})
+        self.assertEqual([n.slug for n in response.context["products"]], ["tolle-hose"])
+        self.assertEqual(dict((v.name, n) for v, n, query in response.context["facets"]),
+                         {"42": 2, "43": 1})  # Nothing red in size 43
+        self.assertContains(response, 'href="/catalog/klader/?variant=%d&amp;variant=%d"'
+                                      % (self.v43.pk, self.v42.pk))
+        self.assertContains(response, 'href="/catalog/klader/">Size: 43')
+
+    def test_bit_count(self):
+        """Tests counting the set bits of masks of any size."""
+        for mask in (0, 1, 0xff, 0x100, 2 ** 200 - 1, (2 ** 1000 - 1) // 3):
+            self.assertEqual(facets.bit_count(mask), bin(mask).count("1"))
+
+
+class StockTest(TestCase):
+    def counters(self, slug):
+        node = models.Node.objects.get(slug=slug)
+        return node._stock, node._pending_customer, node.stock, node.pending_customer
+
+    def test_reserve(self):
+        """Tests that reservations are limited by available stock."""
+        bh = models.Node.objects.get(slug="bh")
+        self.assertEqual(models.Node.objects.reserve([(bh, 2)]), [])
+        self.assertEqual(self.counters("bh"), (3, 2, 3, 2))
+        self.assertEqual(self.counters("software")[3], 2)
+        self.assertEqual(models.Node.objects.reserve([(bh, 2)]), [(bh.pk, 2)])
+        self.assertEqual(self.counters("bh"), (3, 2, 3, 2))
+        self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+
+    def test_batch(self):
+        """Tests that failed lines of a batch are reported and the rest applied."""
+        bh = models.Node.objects.get(slug="bh")
+        hose = models.Node.objects.get(slug="tolle-hose")
+        make_node("hat", parent=models.Node.objects.get(slug="klader"), _stock=1)
+        hat = models.Node.objects.get(slug="hat")
+        failed = models.Node.objects.reserve([(bh, 1), (hose, 1), (hat.pk, 1), (bh, 1)])
+        self.assertEqual(failed, [(hose.pk, 1)])
+        self.assertEqual(self.counters("bh")[1], 2)
+        self.assertEqual(self.counters("klader")[3], 3)
+        self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+        self.assertRaises(ValueError, models.Node.objects.reserve, [(bh, 0)])
+
+    def test_release_commit(self):
+        """Tests giving back and shipping reserved items."""
+        bh = models.Node.objects.get(slug="bh")
+        self.assertTrue(bh.reserve(2))
+        self.assertTrue(bh.commit(1))
+        self.assertEqual((bh.stock, bh.pending_customer), (2, 1))
+        self.assertEqual(self.counters("bh"), (2, 1, 2, 1))
+        self.assertFalse(bh.release(2))
+        self.assertTrue(bh.release(1))
+        self.assertEqual(self.counters("damklader")[2:], (2, 0))
+        self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+
+
+class StockContentionTest(TransactionTestCase):
+    @skipIf(connection.vendor == "sqlite" and
+            connection.settings_dict.get("TEST_NAME") in (None, "", ":memory:"),
+            "Threads do not share in-memory SQLite databases")
+    def test_concurrent_reservations(self):
+        """Tests that concurrent checkouts never oversell or lose updates."""
+        hat = make_node("hat", parent=models.Node.objects.get(slug="klader"), _stock=50)
+        results = []
+
+        def checkout():
+            try:
+                for i in range(10):
+                    results.append(models.Node.objects.reserve([(hat.pk, 1)]) == [])
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(True), 50)
+        hat = reload(hat)
+        self.assertEqual((hat.stock, hat.pending_customer), (50, 50))
+        self.assertEqual(models.Node.objects.get(slug="software").pending_customer, 50)
+        self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+
+
+class RouterTest(TestCase):
+    def setUp(self):
+        self.middleware = routers.ReplicaMiddleware()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        routers.finish_request()
+
+    def request(self, method="get", **cookies):
+        request = getattr(self.factory, method)("/catalog/")
+        request.COOKIES.update(cookies)
+        self.middleware.process_request(request)
+
+    @override_settings(DATABASE_REPLICAS=("replica",))
+    def test_reads(self):
+        """Tests that only catalog reads of safe requests go to the replica."""
+        self.request()
+        self.assertEqual(models.Category.objects.all().db, "replica")
+        self.assertEqual(models.Variant.objects.all().db, "replica")
+        self.assertEqual(Item.objects.all().db, "default")
+        self.request("post")
+        self.assertEqual(models.Node.objects.all().db, "default")
+        self.request(**{routers.PRIMARY_COOKIE: "1"})
+        self.assertEqual(models.Node.objects.all().db, "default")
+
+    @override_settings(DATABASE_REPLICAS=("replica",))
+    def test_sticky(self):
+        """Tests that requests stick to the primary after writing."""
+        self.request()
+        make_node("hat")
+        self.assertEqual(models.Node.objects.all().db, "default")
+        response = self.middleware.process_response(None, HttpResponse())
+        self.assertTrue(routers.PRIMARY_COOKIE in response.cookies)
+        self.assertEqual(models.Node.objects.all().db, "default")  # Outside requests
+        self.request()
+        response = self.middleware.process_response(None, HttpResponse())
+        self.assertFalse(routers.PRIMARY_COOKIE in response.cookies)
+
+    def test_no_replicas(self):
+        """Tests that everything uses the default database without replicas."""
+        self.request()
+        self.assertEqual(models.Node.objects.all().db, "default")
+
+    def test_stale_replica(self):
+        """Tests that shared caches are filled from the primary, not a lagging replica."""
+        connections.databases["replica"] = {"ENGINE": "django.db.backends.sqlite3",
+                                            "NAME": ":memory:"}
+        try:
+            syncdb.Command().execute(database="replica", interactive=False, verbosity=0,
+                                     load_initial_data=True)
+            snapshot.invalidate()
+            cache.clear()
+            make_node("fresh", parent=models.Node.objects.get(slug="hardware"))
+            self.assertFalse(models.Node.objects.using("replica").filter(slug="fresh").exists())
+            with self.settings(DATABASE_REPLICAS=("replica",)):
+                self.request()
+                self.assertEqual(models.Node.objects.all().db, "replica")
+                fresh = snapshot.get_snapshot().by_slug("fresh")
+                index = facets.get_index()
+                self.assertTrue(index.active & index.subtree(fresh))
+                self.assertEqual(lookup.resolve("fresh")[0], fresh)
+                routers.finish_request()
+                self.assertContains(self.client.get("/catalog/hardware/"), "/catalog/fresh/")
+                self.assertEqual(self.client.get("/catalog/fresh/").status_code, 200)
+        finally:
+            connections["replica"].close()
+            del connections.databases["replica"]
+            del connections._connections.replica
+
+
+class ConditionalTest(TestCase):
+    def setUp(self):
+        snapshot.invalidate()
+        cache.clear()
+
+    def get(self, url, response=None):
+        headers = {}
+        if response is not None:
+            headers["HTTP_IF_NONE_MATCH"] = response["ETag"]
+            headers["HTTP_IF_MODIFIED_SINCE"] = response["Last-Modified"]
+        return self.client.get(url, **headers)
+
+    def assertNotModified(self, url, response):
+        revalidated = self.get(url, response)
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated.templates, [])
+
+    def assertModified(self, url, response):
+        self.assertEqual(self.get(url, response).status_code, 200)
+
+    def test_category(self):
+        """Tests that category pages revalidate until something they show changes."""
+        response = self.get("/catalog/klader/")
+        self.assertNotModified("/catalog/klader/", response)
+        hose = models.Node.objects.get(slug="tolle-hose")
+        hose.save()  # A child
+        self.assertModified("/catalog/klader/", response)
+        response = self.get("/catalog/klader/")
+        models.Node.objects.get(slug="software").save()  # An ancestor
+        self.assertModified("/catalog/klader/", response)
+        response = self.get("/catalog/klader/")
+        models.Node.objects.get(slug="bh").reserve(1)  # Stock below
+        self.assertModified("/catalog/klader/", response)
+        response = self.get("/catalog/klader/")
+        models.Node.objects.get(slug="schmuck").save()  # In another category
+        self.assertNotModified("/catalog/klader/", response)
+
+    def test_category_subtree(self):
+        """Tests that category pages change with the facets and products of their subtree."""
+        response = self.get("/catalog/klader/")
+        rot = models.Node.objects.get(slug="tolles-hemd-rot")
+        rot.active = False
+        rot.save()  # A great-grandchild counted by the facets
+        self.assertModified("/catalog/klader/", response)
+        colour = models.Variance.objects.create(name="Colour")
+        red = models.Variant.objects.create(name="red", variance=colour)
+        models.Node.objects.get(slug="bh").variant.add(red)
+        url = "/catalog/klader/?variant=%d" % red.pk
+        self.get(url)  # Outdates the changes again once they are committed
+        response = self.get(url)
+        self.assertNotModified(url, response)
+        bh = models.Node.objects.get(slug="bh")
+        bh.name = "Bustier"
+        bh.save()  # A grandchild listed for the variant
+        self.assertModified(url, response)
+        response = self.get(url)
+        red.name = "rot"
+        red.save()
+        self.assertModified(url, response)
+
+    def test_moved_child(self):
+        """Tests that pages change when a child moves away."""
+        response = self.get("/catalog/klader/")
+        hose = models.Node.objects.get(slug="tolle-hose")
+        hose.parent = models.Node.objects.get(slug="hardware")
+        hose.save()
+        self.assertModified("/catalog/klader/", response)
+
+    def test_product(self):
+        """Tests that product pages revalidate once the test cookie is set."""
+        response = self.get("/catalog/tolles-hemd/")
+        self.assertFalse(response.has_header("ETag"))
+        response = self.get("/catalog/tolles-hemd/")
+        self.assertNotModified("/catalog/tolles-hemd/", response)
+        self.assertNotModified("/catalog/tolles-hemd-rot/", response)
+        models.Node.objects.get(slug="tolles-hemd-rot").variant.add(models.Variant.objects.create(
+            name="red", variance=models.Variance.objects.create(name="Colour")))
+        self.assertModified("/catalog/tolles-hemd/", response)
+
+
+class PageCacheTest(TestCase):
+    def setUp(self):
+        snapshot.invalidate()
+        cache.clear()
+
+    def assertCached(self, url):
+        self.client.get(url)
+        with self.assertNumQueries(1):  # The Last-Modified of the page
+            self.assertEqual(self.client.get(url).templates, [])
+
+    def assertRendered(self, url):
+        self.assertNotEqual(self.client.get(url).templates, [])
+
+    def test_cached(self):
+        """Tests that pages are served from the cache without rendering them."""
+        self.assertCached("/catalog/klader/")
+        self.assertRendered("/catalog/klader/?variant=1")
+
+    def test_dependencies(self):
+        """Tests that changes outdate the pages showing them and no other ones."""
+        for url in ("/catalog/klader/", "/catalog/damklader/", "/catalog/hardware/"):
+            self.assertCached(url)
+        software = models.Node.objects.get(slug="software")
+        software._price = Money("1.00", "SEK")
+        software.save()  # Inherited by both
+        self.assertRendered("/catalog/klader/")
+        self.assertRendered("/catalog/damklader/")
+        self.assertCached("/catalog/hardware/")
+        models.Node.objects.get(slug="bh").reserve(1)  # Stock totals of all ancestors
+        self.assertRendered("/catalog/klader/")
+        self.assertRendered("/catalog/damklader/")
+        self.assertCached("/catalog/hardware/")
+
+    def test_new_child(self):
+        """Tests that pages are rendered again when children are added."""
+        self.assertCached("/catalog/klader/")
+        make_node("extra", parent=models.Node.objects.get(slug="klader"))
+        self.assertRendered("/catalog/klader/")
+
+    def test_csrf_token(self):
+        """Tests that cached product pages carry the token of each visitor."""
+        response = self.client.get("/catalog/tolles-hemd/")
+        self.assertNotIn(pagecache.CSRF_PLACEHOLDER, response.content)
+        self.assertIn(response.cookies["csrftoken"].value, response.content)
+        other = self.client_class()
+        response = other.get("/catalog/tolles-hemd/")
+        self.assertEqual(response.templates, [])
+        self.assertIn(response.cookies["csrftoken"].value, response.content)
+        self.assertTrue(other.session.test_cookie_worked())
+
+
+class AncestryTest(TestCase):
+    def setUp(self):
+        ancestry.start()
+
+    def tearDown(self):
+        ancestry.finish()
+
+    def test_shared_chains(self):
+        """Tests that a chain is loaded once per request, prefixes included."""
+        with self.assertNumQueries(1):
+            rot = models.Node.objects.filter(slug="tolles-hemd-rot").values_list("pk", flat=True)[0]
+        rot = models.Node.objects.get(pk=rot)
+        with self.assertNumQueries(1):
+            self.assertEqual(rot.get_absolute_url(), "/catalog/tolles-hemd/")
+            self.assertEqual([n.slug for n in rot.get_cached_ancestors()],
+                             ["software", "klader", "tolles-hemd"])
+        hemd = models.Node.objects.get(slug="tolles-hemd")
+        klader = models.Node.objects.get(slug="klader")
+        rot = reload(rot)
+        with self.assertNumQueries(0):
+            self.assertEqual([n.slug for n in hemd.get_cached_ancestors(include_self=True)],
+                             ["software", "klader", "tolles-hemd"])
+            self.assertEqual([n.slug for n in klader.get_cached_ancestors()], ["software"])
+            self.assertEqual([n.slug for n in rot.get_cached_ancestors()],
+                             ["software", "klader", "tolles-hemd"])
+
+    def test_load(self):
+        """Tests that the chains of many nodes are loaded with one query."""
+        nodes = list(models.Node.objects.all())
+        with self.assertNumQueries(1):
+            ancestry.load(nodes)
+            urls = [n.get_absolute_url() for n in nodes]
+        self.assertEqual(urls, [n.get_absolute_url() for n in models.Node.objects.with_aggregates()])
+        for node in nodes:
+            self.assertEqual(node.get_cached_ancestors(), list(node.get_ancestors()))
+
+    def test_changes(self):
+        """Tests that chains are loaded again once nodes changed."""
+        bh = models.Node.objects.get(slug="bh")
+        bh.get_cached_ancestors()
+        bh.parent = models.Node.objects.get(slug="hardware")
+        bh.save()
+        fresh = reload(bh)
+        with self.assertNumQueries(1):
+            self.assertEqual([n.slug for n in fresh.get_cached_ancestors()], ["hardware"])
+            self.assertEqual([n.slug for n in bh.get_cached_ancestors()], ["hardware"])
+
+    def test_outside_requests(self):
+        """Tests that chains stay on their instances outside of requests."""
+        ancestry.finish()
+        bh = models.Node.objects.get(slug="bh")
+        with self.assertNumQueries(1):
+            bh.get_cached_ancestors()
+            bh.get_cached_ancestors()
+        bh = reload(bh)
+        with self.assertNumQueries(1):
+            bh.get_cached_ancestors()
+
+
+class SitemapTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(CATALOG_SITEMAP_ROOT=self.root)
+        self.settings.enable()
+        self.generated = 0
+        self.generate = sitemap.generate
+
+        def generate(*args):
+            self.generated += 1
+            return self.generate(*args)
+        sitemap.generate = generate
+
+    def tearDown(self):
+        sitemap.generate = self.generate
+        sitemap.CHUNK_SIZE = 50000
+        sitemap.BATCH_SIZE = 2000
+        self.settings.disable()
+        shutil.rmtree(self.root)
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return "".join(response.streaming_content)
+
+    def test_sitemap(self):
+        """Tests that all category and product pages are listed once."""
+        index = self.client.get("/sitemap.xml").content
+        self.assertEqual(index.count("<sitemap>"), 1)
+        self.assertIn("<loc>http://testserver/sitemap-0.xml</loc>", index)
+        content = self.get("/sitemap-0.xml")
+        pages = models.Node.objects.exclude(kind=models.Node.VARIATION)
+        self.assertEqual(content.count("<url>"), pages.count())
+        for node in pages:
+            self.assertIn("<loc>http://testserver%s</loc><lastmod>%s</lastmod>" % (
+                node.get_absolute_url(), node.updated.replace(microsecond=0).isoformat()), content)
+        self.assertNotIn("tolles-hemd-rot", content)
+        self.assertEqual(self.client.get("/sitemap-1.xml").status_code, 404)
+
+    def test_chunks(self):
+        """Tests that the pages are split among chunks."""
+        sitemap.CHUNK_SIZE = 3
+        index = self.client.get("/sitemap.xml").content
+        chunks = index.count("<sitemap>")
+        self.assertEqual(chunks, 3)
+        content = "".join(self.get("/sitemap-%d.xml" % i) for i in range(chunks))
+        self.assertEqual(content.count("<url>"),
+                         models.Node.objects.exclude(kind=models.Node.VARIATION).count())
+
+    def test_read_chunks(self):
+        """Tests that the chunk boundaries are read in one pass over the ids."""
+        ids = list(sitemap.pages().values_list("pk", flat=True))
+        sitemap.CHUNK_SIZE = 2
+        sitemap.BATCH_SIZE = 3
+        with self.assertNumQueries(len(ids) // 3 + 1):
+            chunks = sitemap.read_chunks()
+        self.assertEqual([chunk["start"] for chunk in chunks], ids[::2])
+        self.assertEqual([chunk["last"] for chunk in chunks], ids[1::2] + ids[len(ids) // 2 * 2:])
+        self.assertEqual(sum(chunk["count"] for chunk in chunks), len(ids))
+
+    def test_index(self):
+        """Tests that the chunks are kept until the pages change."""
+        chunks = sitemap.chunks()
+        with self.assertNumQueries(1):
+            self.assertEqual(sitemap.chunks(), chunks)
+        hose = models.Node.objects.get(slug="tolle-hose")
+        hose.save()
+        self.assertNotEqual(sitemap.chunks(), chunks)
+        hose.active = False
+        hose.save()
+        self.assertEqual(sitemap.chunks()[0]["count"], chunks[0]["count"] - 1)
+
+    def test_failed(self):
+        """Tests that nothing is stored of a chunk failing to generate."""
+        def generate(*args):
+            yield sitemap.HEADER
+            raise IOError("Disconnected")
+        sitemap.generate = generate
+        self.assertRaises(IOError, self.client.get, "/sitemap-0.xml")
+        self.assertEqual(os.listdir(self.root), ["chunks.json"])
+
+    def test_stored(self):
+        """Tests that chunks are generated again only once they changed."""
+        content = self.get("/sitemap-0.xml")
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get("/sitemap-0.xml"), content)
+        self.assertEqual(self.generated, 1)
+        hose = models.Node.objects.get(slug="tolle-hose")
+        hose.slug = "neue-hose"
+        hose.save()
+        content = self.get("/sitemap-0.xml")
+        self.assertEqual(self.generated, 2)
+        self.assertIn("/catalog/neue-hose/", content)
+        hose.active = False
+        hose.save()
+        self.assertNotIn("/catalog/neue-hose/", self.get("/sitemap-0.xml"))
+        self.assertEqual(sorted(os.listdir(self.root)),
+                         ["chunks.json", "sitemap-0.xml", "sitemap-0.xml.key"])
+
+
+class ApiTest(TestCase):
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_pages(self):
+        """Tests that pages follow each other in tree order at constant cost."""
+        expected = [n.slug for n in models.Node.objects.all()]
+        slugs, queries = [], []
+        url = "/catalog/api/nodes/"
+        params = {"limit": 2, "fields": "slug"}
+        while url:
+            connection.use_debug_cursor = True
+            try:
+                data = self.get(url, **params)
+            finally:
+                connection.use_debug_cursor = False
+            queries.append(len(connection.queries))
+            slugs.extend(node["slug"] for node in data["results"])
+            url, params = data["next"], {}
+        self.assertEqual(slugs, expected)
+        self.assertEqual(queries, [1] * len(queries))
+
+    def test_fields(self):
+        """Tests that only the requested fields are read and returned."""
+        data = self.get("/catalog/api/nodes/tolles-hemd-rot/")
+        self.assertEqual(data["url"], "/catalog/tolles-hemd/")
+        self.assertEqual(data["price"], {"amount": "14.00", "currency": "SEK"})
+        self.assertNotIn("description", data)
+        with self.assertNumQueries(1):
+            data = self.get("/catalog/api/nodes/tolles-hemd/", fields="name,description")
+        self.assertEqual(sorted(data), ["description", "name"])
+        response = self.client.get("/catalog/api/nodes/", {"fields": "name,password"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get("/catalog/api/nodes/", {"after": "x"}).status_code, 400)
+
+    def test_children(self):
+        """Tests that children and variations of a node are listed."""
+        data = self.get("/catalog/api/nodes/klader/children/", fields="slug")
+        self.assertEqual([n["slug"] for n in data["results"]],
+                         [n.slug for n in models.Node.objects.get(slug="klader").get_children()])
+        data = self.get("/catalog/api/nodes/tolles-hemd/variations/", fields="slug,available")
+        self.assertEqual(len(data["results"]), 3)
+        self.assertEqual(self.client.get("/catalog/api/nodes/klader/variations/").status_code, 404)
+
+    def test_prices(self):
+        """Tests that prices of many nodes are returned together."""
+        with self.assertNumQueries(1):
+            data = self.get("/catalog/api/prices/", slug=["bh", "tolles-hemd-rot", "nix"])
+        self.assertEqual(sorted(data), ["bh", "tolles-hemd-rot"])
+        self.assertEqual(data["bh"]["available"], 3)
+
+
+class GapTreeTest(TestCase):
+    def setUp(self):
+        self.settings = override_settings(CATALOG_TREE_GAP=1000)
+        self.settings.enable()
+        models.Node.objects.rebuild_tree_fields(
+            models.Node.objects.values_list("tree_id", flat=True).distinct())
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def numbers(self):
+        return dict((pk, values) for pk, values in
+                    [(row[0], row[1:]) for row in
+                     models.Node.objects.values_list("pk", "tree_id", "lft", "rght", "level")])
+
+    def structure(self):
+        """How the tree looks through the MPTT queries."""
+        result = []
+        for node in models.Node.objects.all():
+            result.append((node.slug,
+                           [n.slug for n in node.get_ancestors()],
+                           [n.slug for n in node.get_descendants()],
+                           [n.slug for n in node.get_children()],
+                           [n.slug for n in node.get_leafnodes()],
+                           node.get_descendant_count(),
+                           node.is_leaf_node(),
+                           node.level))
+        return result
+
+    def assertSameAsContiguous(self):
+        structure = self.structure()
+        with override_settings(CATALOG_TREE_GAP=0):
+            models.Node.objects.rebuild_tree_fields(
+                models.Node.objects.values_list("tree_id", flat=True).distinct())
+            self.assertEqual(self.structure(), structure)
+
+    def test_descendant_count(self):
+        """Tests that leaves are told from the stored rows, whatever the snapshot."""
+        snapshot.get_snapshot()
+        schmuck = models.Node.objects.get(slug="schmuck")
+        with self.assertNumQueries(0):
+            self.assertTrue(schmuck.is_leaf_node())
+        ring = make_node("ring", parent=schmuck)
+        self.assertFalse(schmuck.is_leaf_node())
+        schmuck = reload(schmuck)
+        self.assertEqual(list(schmuck.get_children()), [ring])
+        make_node("gold", parent=ring)
+        self.assertEqual(reload(schmuck).get_descendant_count(), 2)
+        reload(ring).move_to(models.Node.objects.get(slug="hardware"), "last-child")
+        self.assertTrue(reload(schmuck).is_leaf_node())
+        self.assertEqual(models.Node.objects.get(slug="hardware").get_descendant_count(), 3)
+        reload(ring).delete()
+        self.assertEqual(models.Node.objects.get(slug="hardware").get_descendant_count(), 1)
+        self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+        self.assertSameAsContiguous()
+
+    def test_insert(self):
+        """Tests that inserts only write the new row."""
+        before = self.numbers()
+        klader = models.Node.objects.get(slug="klader")
+        for name in ("aaa", "mmm", "zzz"):
+            node = make_node(name, parent=klader)
+            make_node(name + "-child", parent=node)
+        numbers = self.numbers()
+        for pk, values in before.items():
+            self.assertEqual(numbers[pk], values)
+        self.assertSameAsContiguous()
+
+    def test_gap_runs_out(self):
+        """Tests that the tree is renumbered once a gap has run out."""
+        klader = models.Node.objects.get(slug="klader")
+        for i in range(12):
+            make_node("a%02d" % (12 - i), parent=klader)  # All go to the same spot
+        names = [n.name for n in klader.get_children()]
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(len(names), 15)
+        self.assertSameAsContiguous()
+
+    def test_move(self):
+        """Tests that moves only write the moved rows."""
+        for slug, parent in (("damklader", "hardware"), ("tolles-hemd", "damklader"),
+                             ("tolle-hose", "tolles-hemd")):
+            before = self.numbers()
+            node = models.Node.objects.get(slug=slug)
+            moved = set(n.pk for n in node.get_descendants(include_self=True))
+            node.parent = models.Node.objects.get(slug=parent)
+            node.save()
+            numbers = self.numbers()
+            self.assertEqual(set(pk for pk in before if numbers[pk] != before[pk]), moved)
+            self.assertEqual(reload(node).get_ancestors(ascending=True)[0].slug, parent)
+        self.assertEqual(models.Node.objects.get(slug="hardware").stock, 3)
+        self.assertSameAsContiguous()
+
+    def test_delete(self):
+        """Tests that deletes leave their gap behind."""
+        before = self.numbers()
+        bh = models.Node.objects.get(slug="bh")
+        del before[bh.pk]
+        bh.delete()
+        self.assertEqual(self.numbers(), before)
+        self.assertTrue(models.Node.objects.get(slug="damklader").is_leaf_node())
+        self.assertSameAsContiguous()
+
+
+class PathTest(TestCase):
+    def slugs(self, slug):
+        return [entry.slug for entry in models.Node.objects.get(slug=slug).path]
+
+    def test_urls(self):
+        """Tests that breadcrumbs and variation URLs need no queries."""
+        rot = models.Node.objects.get(slug="tolles-hemd-rot")
+        with self.assertNumQueries(0):
+            self.assertEqual(rot.get_absolute_url(), "/catalog/tolles-hemd/")
+            self.assertEqual([(e.name, e.get_absolute_url()) for e in rot.path],
+                             [(u"Software", "/catalog/software/"),
+                              (u"Kl\xe4der", "/catalog/klader/"),
+                              (u"Tolles Hemd", "/catalog/tolles-hemd/")])
+        response = self.client.get("/catalog/tolles-hemd/")
+        self.assertEqual([e.slug for e in response.context["ancestors"]], ["software", "klader"])
+
+    def test_new_nodes(self):
+        """Tests that new nodes get the path of their parent."""
+        node = make_node("neu", parent=models.Node.objects.get(slug="tolles-hemd"))
+        self.assertEqual(self.slugs("neu"), ["software", "klader", "tolles-hemd"])
+        self.assertEqual(make_node("root").path, [])
+
+    def test_move(self):
+        """Tests that moved subtrees get new paths."""
+        damklader = models.Node.objects.get(slug="damklader")
+        damklader.parent = models.Node.objects.get(slug="hardware")
+        damklader.save()
+        self.assertEqual(self.slugs("bh"), ["hardware", "damklader"])
+        self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+
+    def test_move_to(self):
+        """Tests that move_to() keeps paths, prices and rollups in sync."""
+        a = make_node("aa", kind=models.Node.CATEGORY, _price=Money("10.00", "SEK"))
+        b = make_node("bb", kind=models.Node.CATEGORY, _price=Money("100.00", "SEK"))
+        c = make_node("cc", parent=a, kind=models.Node.CATEGORY, _price=Money("1.00", "SEK"))
+        make_node("pp", parent=c, _price=Money("5.00", "SEK"), _stock=7)
+        c.move_to(b)
+        self.assertEqual(c.parent_id, b.pk)
+        self.assertEqual(self.slugs("pp"), ["bb", "cc"])
+        self.assertEqual(models.Node.objects.get(slug="pp").price, Money("106.00", "SEK"))
+        self.assertEqual((reload(a).stock, reload(b).stock), (0, 7))
+        c.move_to(models.Node.objects.get(slug="damklader"), "left")
+        self.assertEqual(self.slugs("pp"), ["software", "klader", "cc"])
+        self.assertEqual(reload(b).stock, 0)
+        self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+        with override_settings(CATALOG_TREE_GAP=1000):
+            models.Node.objects.rebuild_tree_fields(
+                models.Node.objects.values_list("tree_id", flat=True).distinct())
+            c = reload(c)
+            c.move_to(a, "last-child")
+            self.assertEqual(self.slugs("pp"), ["aa", "cc"])
+            self.assertEqual(models.Node.objects.get(slug="pp").price, Money("16.00", "SEK"))
+            self.assertEqual(reload(a).stock, 7)
+            self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+
+    def test_rename(self):
+        """Tests that descendants follow new slugs and names."""
+        klader = models.Node.objects.get(slug="klader")
+        klader.slug = "kleider"
+        klader.name = "Kleider"
+        klader.save()
+        self.assertEqual(self.slugs("tolles-hemd-rot"), ["software", "kleider", "tolles-hemd"])
+        self.assertEqual(models.Node.objects.get(slug="bh").path[1].name, "Kleider")
+        self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+
+    def test_rebuild(self):
+        """Tests that paths are repaired by rebuild_derived()."""
+        models.Node.objects.update(_path="")
+        self.assertEqual(models.Node.objects.rebuild_derived(), models.Node.objects.count())
+        self.assertEqual(self.slugs("bh"), ["software", "klader", "damklader"])
+
+
+class TreeLockTest(TransactionTestCase):
+    def tree_fields(self):
+        return list(models.Node.objects.values_list("pk", "tree_id", "lft", "rght", "level"))
+
+    def assertValidTrees(self):
+        """Asserts that numbering the trees anew changes nothing."""
+        numbered = self.tree_fields()
+        models.Node.objects.rebuild_tree_fields(set(row[1] for row in numbered))
+        self.assertEqual(self.tree_fields(), numbered)
+        self.assertEqual(models.Node.objects.rebuild_derived(), 0)
+
+    def run_threads(self, *targets):
+        def run(target):
+            try:
+                target()
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=run, args=(target,)) for target in targets]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def test_new_roots(self):
+        """Tests that new roots become the last tree without moving others."""
+        trees = dict(models.Node.objects.values_list("slug", "tree_id"))
+        root = make_node("accessoires")
+        self.assertEqual(root.tree_id, max(trees.values()) + 1)
+        klader = models.Node.objects.get(slug="klader")
+        klader.parent = None
+        klader.save()
+        self.assertEqual(klader.tree_id, root.tree_id + 1)
+        self.assertEqual(models.Node.objects.get(slug="hardware").tree_id, trees["hardware"])
+        self.assertValidTrees()
+
+    @skipIf(connection.vendor == "sqlite" and
+            connection.settings_dict.get("TEST_NAME") in (None, "", ":memory:"),
+            "Threads do not share in-memory SQLite databases")
+    def test_concurrent_writers(self):
+        """Tests that concurrent edits of several trees keep all of them intact."""
+        def writer(parent, prefix):
+            def write():
+                for i in range(10):
+                    make_node("%s-%d" % (prefix, i), parent=models.Node.objects.get(slug=parent),
+                              _stock=1)
+            return write
+
+        def roots():
+            for i in range(5):
+                make_node("root-%d" % i)
+
+        for thread in self.run_threads(writer("hardware", "a"), writer("klader", "b"),
+                                       writer("tolles-hemd", "c"), roots):
+            thread.join()
+        self.assertEqual(models.Node.objects.get(slug="hardware").stock, 10)
+        self.assertEqual(models.Node.objects.filter(parent=None).count(), 7)
+        self.assertValidTrees()
+
+    @skipUnless(connection.features.has_select_for_update,
+                "The database does not lock rows")
+    def test_independent_trees(self):
+        """
+        Tests that a locked tree blocks writers to it only.
+
+        Skipped on SQLite, which has no SELECT ... FOR UPDATE and locks
+        the whole database instead of single trees.
+        """
+        locked, release = threading.Event(), threading.Event()
+        hardware_done, software_done = threading.Event(), threading.Event()
+
+        def hold():
+            with transaction.commit_on_success():
+                models.Node.objects.lock_trees([models.Node.objects.get(slug="software").tree_id])
+                locked.set()
+                release.wait(10)
+
+        def writer(parent, done):
+            def write():
+                make_node(parent + "-new", parent=models.Node.objects.get(slug=parent))
+                done.set()
+            return write
+
+        threads = self.run_threads(hold)
+        self.assertTrue(locked.wait(5))
+        threads += self.run_threads(writer("hardware", hardware_done),
+                                    writer("klader", software_done))
+        self.assertTrue(hardware_done.wait(5))
+        self.assertFalse(software_done.wait(0.5))
+        release.set()
+        self.assertTrue(software_done.wait(5))
+        for thread in threads:
+            thread.join()
+        self.assertValidTrees()
+
+
 class CategoryTest(TestCase):
-    pass
+    def count_queries(self, slug):
+        url = models.Node.objects.get(slug=slug).get_absolute_url()
+        connection.use_debug_cursor = True
+        try:
+            response = self.client.get(url)  # Resets connection.queries
+        finally:
+            connection.use_debug_cursor = False
+        self.assertEqual(response.status_code, 200)
+        return len(connection.queries)
+
+    def count_uncached_queries(self, slug):
+        """Queries of a page with no slugs resolved and all in-process indexes outdated."""
+        lookup.slugs.clear()
+        snapshot.invalidate()
+        facets.invalidate()
+        return self.count_queries(slug)
+
+    @override_settings(CATALOG_PAGE_CACHE_TIMEOUT=0)
+    def test_constant_queries(self):
+        """Tests that category pages cost the same for any number of children."""
+        before = self.count_uncached_queries("klader")
+        self.assertGreater(before, 0)
+        category = models.Node.objects.get(slug="klader")
+        for i in range(5):
+            make_node("extra-%d" % i, parent=category, _stock=i)
+        self.assertEqual(self.count_uncached_queries("klader"), before)
+
+    @override_settings(CATALOG_PAGE_CACHE_TIMEOUT=0)
+    def test_constant_queries_cached(self):
+        """Tests that category pages cost the same for any number of children once indexed."""
+        self.count_queries("klader")  # Resolves the slug into the lookup cache
+        self.count_queries("klader")  # Rebuilds indexes outdated by earlier changes
+        before = self.count_queries("klader")
+        self.assertGreater(before, 0)
+        self.assertLess(before, self.count_uncached_queries("klader"))
+        self.count_queries("klader")  # Indexes again
+        category = models.Node.objects.get(slug="klader")
+        for i in range(5):
+            make_node("extra-%d" % i, parent=category, _stock=i)
+        self.count_queries("klader")  # Rebuilds the in-process catalog indexes
+        self.count_queries("klader")  # And again, once the changes are committed
+        self.assertEqual(self.count_queries("klader"), before)
+
+    @override_settings(CATALOG_PAGE_CACHE_TIMEOUT=0)
+    def test_constant_queries_gap(self):
+        """Tests that trees numbered with gaps cost no queries per node."""
+        self.count_queries("klader")
+        self.count_queries("klader")
+        before = self.count_queries("klader")
+        with self.settings(CATALOG_TREE_GAP=1000):
+            models.Node.objects.rebuild_tree_fields(
+                models.Node.objects.values_list("tree_id", flat=True).distinct())
+            snapshot.get_snapshot()
+            nodes = list(models.Node.objects.all())
+            with self.assertNumQueries(0):
+                self.assertEqual([n.slug for n in nodes if n.is_leaf_node()],
+                                 ["schmuck", "bh", "tolle-hose", "tolles-hemd-blau",
+                                  "tolles-hemd-braun", "tolles-hemd-rot"])
+            self.count_queries("klader")
+            self.assertEqual(self.count_queries("klader"), before)
+
+    def test_roots_by_name(self):
+        """Tests that new roots are listed by name although their trees come last."""
+        root = make_node("accessoires", kind=models.Node.CATEGORY)
+        root.name = "Accessoires"
+        root.save()
+        self.assertEqual(models.Node.objects.filter(parent=None).latest("tree_id"), root)
+        response = self.client.get("/catalog/")
+        self.assertEqual([n.slug for n in response.context["categories"]],
+                         ["accessoires", "hardware", "schmuck", "software", "klader", "damklader"])
+        self.assertContains(response, '<a href="/catalog/schmuck/">Schmuck</a>')
+
+    def test_empty(self):
+        """Tests that categories without children and products without variations render."""
+        self.assertEqual(self.client.get("/catalog/schmuck/").status_code, 200)
+        self.assertEqual(self.client.get("/catalog/bh/").status_code, 200)
+        self.assertEqual(self.client.get("/catalog/tolle-hose/").status_code, 200)
+        self.assertEqual(list(models.Node.objects.get(slug="bh").get_children().with_aggregates()), [])
+
+    def test_with_aggregates(self):
+        """Tests that listing nodes fills in everything in one query."""
+        with self.assertNumQueries(1):
+            nodes = list(models.Node.objects.filter(kind=models.Node.VARIATION).with_aggregates())
+            self.assertEqual([n.get_absolute_url() for n in nodes],
+                             ["/catalog/tolles-hemd/"] * 3)
+            self.assertEqual([n.price for n in nodes],
+                             [Money("12.00", "SEK"), Money("12.00", "SEK"), Money("14.00", "SEK")])
+            self.assertFalse(any(n.in_stock for n in nodes))
 
 
 class ProductTest(TestCase):
-    pass
+    def setUp(self):
+        size = models.Variance.objects.create(name="Size")
+        colour = models.Variance.objects.create(name="Colour")
+        self.variants = dict((name, models.Variant.objects.create(name=name, variance=variance))
+                             for name, variance in (("S", size), ("M", size),
+                                                    ("red", colour), ("blue", colour)))
+        self.nodes = dict((n.slug, n) for n in models.Node.objects.all())
+        self.link("tolles-hemd-rot", "M", "red")
+        self.link("tolles-hemd-blau", "M", "blue")
+        self.link("tolles-hemd-braun", "S")
+        self.nodes["tolles-hemd-rot"].stock = 3
+        self.nodes["tolles-hemd-rot"].save()
+
+    def link(self, slug, *variants):
+        self.nodes[slug].variant.add(*[self.variants[name] for name in variants])
+
+    def test_matrix(self):
+        """Tests that variations are placed by their variants."""
+        m = matrix.build(self.nodes["tolles-hemd"])
+        self.assertEqual([axis.name for axis in m.axes], ["Size", "Colour"])
+        self.assertEqual([[v.name for v in column] for column in m.columns], [["red"], ["blue"]])
+        rows = [(variant.name, [cell and cell.slug for cell in cells]) for variant, cells in m.rows()]
+        self.assertEqual(rows, [("S", [None, None]),
+                                ("M", ["tolles-hemd-rot", "tolles-hemd-blau"])])
+        red = m.get((self.variants["M"], self.variants["red"]))
+        self.assertEqual((red.available, red.price_delta), (3, Money("2.00", "SEK")))
+        self.assertEqual(red.url, "/catalog/tolles-hemd/?variation=tolles-hemd-rot")
+        self.assertEqual([v.slug for v in m.unplaced], ["tolles-hemd-braun"])
+
+    def test_constant_queries(self):
+        """Tests that the matrix costs two queries for any number of variations."""
+        product = self.nodes["tolles-hemd"]
+        for i in range(20):
+            self.variants[str(i)] = models.Variant.objects.create(
+                name=str(i), variance=self.variants["S"].variance)
+            variation = make_node("hemd-%d" % i, parent=product, kind=models.Node.VARIATION)
+            self.nodes[variation.slug] = variation
+            self.link(variation.slug, str(i), "blue")
+        with self.assertNumQueries(2):
+            m = matrix.build(product)
+            self.assertEqual([sum(1 for cell in cells if cell) for variant, cells in m.rows()],
+                             [0, 2] + [1] * 20)
+            self.assertEqual(sum(cell.available for cell in m.cells.values()), 3)
+
+    def test_page(self):
+        """Tests that the product page shows the matrix and preselects variations."""
+        response = self.client.get("/catalog/tolles-hemd/")
+        self.assertContains(response, '<a href="/catalog/tolles-hemd/?variation=tolles-hemd-rot">'
+                                      '3 available +SEK 2.00</a>')
+        response = self.client.get("/catalog/tolles-hemd/?variation=tolles-hemd-rot")
+        self.assertEqual(response.context["form"].fields["product"].widget.attrs["value"],
+                         "tolles-hemd-rot")
+
+    def test_api(self):
+        """Tests the variation matrix of the JSON API."""
+        data = json.loads(self.client.get("/catalog/api/nodes/tolles-hemd/matrix/").content)
+        self.assertEqual([axis["name"] for axis in data["axes"]], ["Size", "Colour"])
+        self.assertEqual([(cell["slug"], cell["available"], cell["price_delta"]["amount"])
+                          for cell in data["cells"]],
+                         [("tolles-hemd-rot", 3, "2.00"), ("tolles-hemd-blau", 0, "0.00")])
+        self.assertEqual(data["unplaced"], ["tolles-hemd-braun"])
+        response = self.client.get("/catalog/api/nodes/klader/matrix/")
+        self.assertEqual(response.status_code, 404)
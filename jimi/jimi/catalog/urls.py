@@ -2,5 +2,15 @@ from django.conf.urls.defaults import patterns
 
 urlpatterns = patterns("jimi.catalog.views",
     (r"^/?$", "all_categories"),
+    (r"^search/$", "search", {}, "search"),  # Slug in Node.RESERVED_SLUGS
     (r"^(?P<slug>[-\w]+)/$", "node", {}, "node"),
 )
+
+urlpatterns += patterns("jimi.catalog.api",
+    (r"^api/nodes/$", "nodes", {}, "api_nodes"),
+    (r"^api/nodes/(?P<slug>[-\w]+)/$", "node", {}, "api_node"),
+    (r"^api/nodes/(?P<slug>[-\w]+)/children/$", "children", {}, "api_children"),
+    (r"^api/nodes/(?P<slug>[-\w]+)/variations/$", "variations", {}, "api_variations"),
+    (r"^api/nodes/(?P<slug>[-\w]+)/matrix/$", "matrix", {}, "api_matrix"),
+    (r"^api/prices/$", "prices", {}, "api_prices"),
+)
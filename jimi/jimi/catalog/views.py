@@ -1,11 +1,18 @@
+from urllib import urlencode
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
-#from django.template.loader import get_template
+from django.template.loader import render_to_string
 from django.core import urlresolvers
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, Http404, StreamingHttpResponse
 from django.core.context_processors import csrf
-from jimi.catalog.models import Node
+from django.middleware.csrf import get_token
+from django.core.paginator import Paginator, InvalidPage
+from django.views.decorators.http import condition
+from jimi.catalog.models import Node, Variant
+from jimi.catalog import conditional, facets, lookup, matrix, pagecache, sitemap as sitemaps
+from jimi.catalog.search import find
 from jimi.lists.models import Item, Cart, CART_ID_SESSION_KEY
+from jimi.routers import read_primary
 from jimi.catalog.forms import ProductAddToCartForm
 
 
@@ -51,36 +58,116 @@ def _add_to_cart(request):
         item.save()
 
 
+def _get_page_node(slug):
+    """
+    Node whose page is shown for a slug.
+
+    Variations are shown on the page of their product. The slug is
+    resolved from the lookup cache, so only the shown node is queried.
+    The query checks that the cached entry still holds, i.e. that the
+    node has the slug or, for variations, that the product still has a
+    variation with the slug. Entries cached by this process before
+    another one changed the node are thus detected and resolved again.
+    """
+    for attempt in range(2):
+        entry = lookup.resolve(slug)
+        if entry is None:
+            break
+        node_id, kind, product_id = entry
+        nodes = Node.objects.filter(pk=product_id)
+        if node_id == product_id:
+            nodes = nodes.filter(slug=slug)
+        else:
+            nodes = nodes.filter(children=node_id, children__slug=slug,
+                                 children__kind=Node.VARIATION)
+        nodes = list(nodes[:1])
+        if nodes:
+            return nodes[0]
+        lookup.slugs.discard(node_id)
+    raise Http404("No catalog node matches %s." % slug)
+
+
+def _facets(request, node):
+    """
+    Variant filters of a category page.
+
+    With variants selected in the query string, the products shown are
+    those anywhere below the category having them, else its children.
+    Every filter comes with the query string that selects its variant in
+    addition to the selected ones, or deselects it if it is selected.
+    """
+    selected = [int(v) for v in request.GET.getlist("variant") if v.isdigit()]
+    index = facets.get_index()
+    counts = index.counts(selected, within=node.pk)
+    c = {"selected": selected,
+         "facets": []}
+    if counts:
+        variants = Variant.objects.filter(pk__in=counts).select_related("variance")
+        for v in variants.order_by("variance__name", "name"):
+            if v.pk in selected:
+                toggled = [pk for pk in selected if pk != v.pk]
+            else:
+                toggled = selected + [v.pk]
+            c["facets"].append((v, counts[v.pk], urlencode([("variant", pk) for pk in toggled])))
+    if selected:
+        ids = index.products(index.match(selected, within=node.pk))
+        products = Node.objects.with_aggregates().in_bulk(ids)
+        c["products"] = [products[pk] for pk in ids if pk in products]
+    return c
+
+
+@condition(etag_func=conditional.node_etag,
+           last_modified_func=conditional.node_last_modified)
 def node(request, slug):
     """
     View node and it's decendants.
 
     Depending on whether the node is a category or a product,
     different responses with different templates are generated.
+    Rendered pages are cached, see jimi.catalog.pagecache.
     """
-    node = get_object_or_404(Node, slug=slug)
+    key = pagecache.page_key(request, slug)
+    cached = pagecache.get_page(key)
+    if cached is not None:
+        t, content = cached
+        if t == "product.html":
+            request.session.set_test_cookie()
+        return _page_response(request, content)
+    if key is None:
+        return _node_page(request, slug, key)
+    # Pages cached for everyone are read from the primary, as a lagging
+    # replica would store old content under the new versions
+    with read_primary():
+        return _node_page(request, slug, key)
+
+
+def _node_page(request, slug, key):
+    """Render the page of a node, and store it under ``key`` unless None."""
     # In case of product variation, get parent instead
-    if node.kind == node.VARIATION:
-        node = node.get_ancestors(ascending=True)[0]
+    node = _get_page_node(slug)
+    if key is not None:  # The key may come from an outdated lookup entry
+        key = pagecache.page_key(request, slug)
     c = {"node": node,
-         "ancestors": node.get_ancestors()}
+         "ancestors": node.path or node.get_cached_ancestors()}
     if node.kind == node.CATEGORY:
         t = "category.html"
         c["categories"] = []
         c["products"] = []
-        children = node.get_children()
+        children = node.get_children().with_aggregates()
         for child in children:
             if child.kind == node.CATEGORY:
                 c["categories"].append(child)
             elif child.kind == node.PRODUCT:
                 c["products"].append(child)
+        c.update(_facets(request, node))
     elif node.kind == node.PRODUCT:
         c.update(csrf(request))
         t = "product.html"
         c["variations"] = []
-        children = node.get_children()
+        children = node.get_children().with_aggregates()
         for child in children:
             c["variations"].append(child)
+        c["matrix"] = matrix.build(node, c["variations"])
         if request.method == 'POST':  # coming from the add to cart form
             postdata = request.POST.copy()
             form = ProductAddToCartForm(request, postdata)
@@ -93,20 +180,87 @@ def node(request, slug):
                 return HttpResponseRedirect(url)
         else:  # request.method == 'GET'
             form = ProductAddToCartForm(request=request, label_suffix=":")
-            form.fields['product'].widget.attrs['value'] = node.slug
+            # Variations are chosen from the matrix by their slug
+            selected = [v.slug for v in c["variations"] if v.slug == request.GET.get("variation")]
+            form.fields['product'].widget.attrs['value'] = selected and selected[0] or node.slug
             c['form'] = form
             # When loading the product page, set a test cookie
             request.session.set_test_cookie()
-#    C = RequestContext(request, c)
-#    return t.render(C)
-    return render_to_response(t, c, context_instance=RequestContext(request))
+    if key is not None:
+        c["csrf_token"] = pagecache.CSRF_PLACEHOLDER
+    content = render_to_string(t, c, context_instance=RequestContext(request))
+    pagecache.store_page(key, (t, content))
+    return _page_response(request, content)
+
 
+def _page_response(request, content):
+    """Response for a rendered page, with the CSRF token filled in."""
+    if pagecache.CSRF_PLACEHOLDER in content:
+        content = content.replace(pagecache.CSRF_PLACEHOLDER, get_token(request))
+    return HttpResponse(content)
 
+
+@condition(etag_func=conditional.categories_etag,
+           last_modified_func=conditional.categories_last_modified)
 def all_categories(request, slug=None):
     """
     View all categories.
 
-    Go through the categories and present them as tree(s).
+    Go through the categories and present them as tree(s), ordered by
+    the names of their roots.
     """
-    c = {"categories": Node.objects.filter(kind="C")}
+    c = {"categories": Node.objects.filter(kind=Node.CATEGORY).in_root_name_order()}
     return render_to_response("categories.html", c)
+
+
+def search(request):
+    """
+    Search the catalog.
+
+    Matching nodes are ranked by the search index, only the nodes on
+    the requested page are loaded. The best search.MAX_RESULTS matches
+    are paged through, later pages are not found.
+    """
+    query = request.GET.get("q", "").strip()
+    paginator = Paginator(query and find(query) or [], 20)
+    try:
+        page = paginator.page(request.GET.get("page", 1))
+    except InvalidPage:
+        raise Http404("No such page.")
+    nodes = Node.objects.with_aggregates().in_bulk(page.object_list)
+    c = {"query": query,
+         "paginator": paginator,
+         "page": page,
+         "nodes": [nodes[pk] for pk in page.object_list if pk in nodes]}
+    return render_to_response("search.html", c, context_instance=RequestContext(request))
+
+
+def sitemap_index(request):
+    """Sitemap index listing the chunks of the catalog sitemap."""
+    entries = []
+    for number, chunk in enumerate(sitemaps.chunks()):
+        url = urlresolvers.reverse("sitemap", kwargs={"number": number})
+        entries.append(sitemaps.INDEX_ENTRY % (request.build_absolute_uri(url),
+                                               chunk["lastmod"]))
+    content = sitemaps.INDEX_HEADER + "".join(entries) + sitemaps.INDEX_FOOTER
+    return HttpResponse(content, content_type="application/xml")
+
+
+def sitemap(request, number):
+    """
+    One chunk of the catalog sitemap.
+
+    Chunks are written to disk and streamed from there, unchanged chunks
+    are served from the file written before.
+    """
+    number = int(number)
+    chunks = sitemaps.chunks()
+    nodes = sitemaps.chunk_nodes(chunks, number)
+    if nodes is None:
+        raise Http404("No sitemap %d." % number)
+    base_url = request.build_absolute_uri(sitemaps.page_url_prefix())
+    key = sitemaps.fingerprint(chunks[number], base_url)
+    content = sitemaps.cached(number, key)
+    if content is None:
+        content = sitemaps.generate_and_store(number, key, sitemaps.generate(nodes, base_url))
+    return StreamingHttpResponse(content, content_type="application/xml")
@@ -1,7 +1,8 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext as _
-from jimi.price.fields import MoneyField
+from jimi.price.fields import DecimalMoneyField
+from jimi.price.managers import MoneyManager
 from jimi.catalog.models import Node
 
 CART_ID_SESSION_KEY = 'cartident'
@@ -117,13 +118,16 @@ class Item(models.Model):
     # TODO float amounts
     quantity = models.IntegerField(_("Quantity"),
                                    default=1)
-    orderprice = MoneyField(_("Price at order time"),
-                            blank=True,
-                            null=True,
-                            help_text=_("Product price when ordered, including discounts etc."))
+    # Amount in the orderprice column, currency code in orderprice_currency
+    orderprice = DecimalMoneyField(_("Price at order time"),
+                                   blank=True,
+                                   null=True,
+                                   help_text=_("Product price when ordered, including discounts etc."))
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    objects = MoneyManager()
+
     class Meta:
         db_table = 'jimi_listitem'
         ordering = ['created']
@@ -207,7 +211,7 @@ class Order(ItemList):
     def save(self, *args, **kwargs):
         self.kind = self.ORDER
         # Freeze item prices when order is created
-        for item in Item.objects.filter(itemlist__exact=self.ident):
+        for item in Item.objects.filter(itemlist__exact=self.ident).select_related('product'):
             item.orderprice = item.price
             item.save()
         super(Order, self).save(*args, **kwargs)
@@ -11,6 +11,6 @@ def cart(request):
     if request.session.get(CART_ID_SESSION_KEY):
         cart = get_object_or_404(Cart, ident=request.session[CART_ID_SESSION_KEY])
         c['cart'] = cart
-        items = Item.objects.filter(itemlist=cart)
+        items = Item.objects.filter(itemlist=cart).select_related('product__parent')
         c['items'] = [i for i in items]
     return render_to_response(t, c)
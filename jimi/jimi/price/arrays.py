@@ -0,0 +1,240 @@
+"""
+Arrays of money for batch arithmetic.
+
+A MoneyArray holds many amounts the way TreeSnapshot holds prices: as
+integer minor units (hundredths, the two decimal places money is stored
+with) in an array('l'), next to a list of currency codes. Adding,
+multiplying by quantities, taking percentages and tax and summing by
+currency are integer operations on the whole array, without a Money or
+Decimal object per element.
+
+Rounding rules:
+
+* Amounts taken from Money are rounded to hundredths, half to even, the
+  way a DecimalMoneyField column stores them.
+* Addition, subtraction, negation, whole quantities and sums are exact,
+  so they are equal to the same Money arithmetic on the elements.
+* Percentages (``percent % array``), tax, and quantities or factors that
+  are not whole numbers are computed exactly and rounded once per
+  element to hundredths, half to even. They are equal to the Money
+  result, e.g. ``percent % money``, rounded the same way. Money itself
+  keeps all the decimals.
+* with_tax() rounds the tax, then adds it, so a price with tax is always
+  the price plus its tax.
+
+Elements in different currencies cannot be added or ordered, as with
+Money, and raise TypeError. Comparisons work element by element, the way
+NumPy arrays compare, and return a list of booleans.
+"""
+from array import array
+from decimal import Decimal, ROUND_HALF_EVEN
+from itertools import izip
+from jimi.price.fields import Currency, Money, _money
+
+DECIMAL_PLACES = 2
+_SCALE = 10 ** DECIMAL_PLACES
+
+
+def to_minor(amount):
+    """Decimal amount in hundredths, rounded half to even."""
+    return int(Decimal(amount).scaleb(DECIMAL_PLACES).to_integral_value(ROUND_HALF_EVEN))
+
+
+def _ratio(number, float_as_str=False):
+    """
+    Exact (numerator, denominator) of an int, Decimal or float. Floats are
+    taken as their shortest repr with ``float_as_str``, the way Money takes
+    percentages and numbers it is compared with.
+    """
+    if isinstance(number, (int, long)):
+        return number, 1
+    if float_as_str and isinstance(number, float):
+        number = str(number)
+    sign, digits, exponent = Decimal(number).as_tuple()
+    numerator = int("".join(map(str, digits)) or "0") * (sign and -1 or 1)
+    if exponent >= 0:
+        return numerator * 10 ** exponent, 1
+    return numerator, 10 ** -exponent
+
+
+def _divide(numerator, denominator):
+    """numerator / denominator rounded half to even, for a positive denominator."""
+    quotient, remainder = divmod(numerator, denominator)
+    if 2 * remainder > denominator or (2 * remainder == denominator and quotient % 2):
+        quotient += 1
+    return quotient
+
+
+class MoneyArray(object):
+    """
+    Money amounts with their currencies, see the module documentation.
+
+    ``amounts`` are integer hundredths, ``currencies`` a code for every
+    amount or a single code for all of them.
+    """
+    __hash__ = None
+
+    def __init__(self, amounts=(), currencies=None):
+        self.amounts = array('l', amounts)
+        if currencies is None or isinstance(currencies, (basestring, Currency)):
+            currency = currencies and Currency(currencies) or Currency()
+            currencies = [intern(str(currency))] * len(self.amounts)
+        else:
+            currencies = [intern(str(Currency(c))) for c in currencies]
+            if len(currencies) != len(self.amounts):
+                raise ValueError("Got %d currencies for %d amounts." % (len(currencies), len(self.amounts)))
+        self.currencies = currencies
+
+    @classmethod
+    def from_money(cls, values):
+        """Array of Money values, rounded to hundredths."""
+        values = list(values)
+        return cls([to_minor(m.amount) for m in values], [m.currency.code for m in values])
+
+    def _new(self, amounts, currencies=None):
+        result = object.__new__(MoneyArray)
+        result.amounts = array('l', amounts)
+        result.currencies = currencies if currencies is not None else self.currencies
+        return result
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._new(self.amounts[index], self.currencies[index])
+        return _money(Decimal(self.amounts[index]).scaleb(-DECIMAL_PLACES),
+                      Currency(self.currencies[index]))
+
+    def __iter__(self):
+        for i in xrange(len(self.amounts)):
+            yield self[i]
+
+    def __repr__(self):
+        return "MoneyArray([%s])" % ", ".join(unicode(m) for m in self)
+
+    def _operand(self, other):
+        """Amounts and currencies of a MoneyArray or Money, matched with self."""
+        if isinstance(other, MoneyArray):
+            if len(other) != len(self):
+                raise ValueError("Cannot combine arrays of %d and %d amounts." % (len(self), len(other)))
+            return other.amounts, other.currencies
+        if isinstance(other, Money):
+            n = len(self.amounts)
+            return [to_minor(other.amount)] * n, [other.currency.code] * n
+        raise TypeError("Cannot combine a MoneyArray and non-Money (type(%s) == %s)." % (other, type(other)))
+
+    def _same_currencies(self, currencies, action):
+        if currencies is not self.currencies:
+            for mine, theirs in izip(self.currencies, currencies):
+                if mine != theirs:
+                    raise TypeError("Cannot %s Money in different currencies." % action)
+
+    def __pos__(self):
+        return self._new(self.amounts)
+
+    def __neg__(self):
+        return self._new([-a for a in self.amounts])
+
+    def __add__(self, other):
+        amounts, currencies = self._operand(other)
+        self._same_currencies(currencies, "add or subtract")
+        return self._new([a + b for a, b in izip(self.amounts, amounts)])
+
+    def __sub__(self, other):
+        amounts, currencies = self._operand(other)
+        self._same_currencies(currencies, "add or subtract")
+        return self._new([a - b for a, b in izip(self.amounts, amounts)])
+
+    __radd__ = __add__
+
+    def _scale(self, factors, divisor=1, float_as_str=False):
+        """Amounts times factors, a number or one per amount, divided and rounded."""
+        if isinstance(factors, (Money, MoneyArray)):
+            raise TypeError("Cannot multiply two Money instances.")
+        if not isinstance(factors, (list, tuple, array)):
+            numerator, denominator = _ratio(factors, float_as_str)
+            denominator *= divisor
+            if denominator == 1:
+                return self._new([a * numerator for a in self.amounts])
+            return self._new([_divide(a * numerator, denominator) for a in self.amounts])
+        if len(factors) != len(self.amounts):
+            raise ValueError("Got %d factors for %d amounts." % (len(factors), len(self.amounts)))
+        result = []
+        for amount, factor in izip(self.amounts, factors):
+            numerator, denominator = _ratio(factor, float_as_str)
+            denominator *= divisor
+            if denominator == 1:
+                result.append(amount * numerator)
+            else:
+                result.append(_divide(amount * numerator, denominator))
+        return self._new(result)
+
+    def __mul__(self, quantities):
+        """Amounts times a quantity, or one quantity per amount."""
+        return self._scale(quantities)
+
+    __rmul__ = __mul__
+
+    def __rmod__(self, percent):
+        """
+        Percentage of every amount, e.g. ``5 % prices``, for one percentage
+        or one per amount.
+        """
+        return self._scale(percent, 100, float_as_str=True)
+
+    def tax(self, percent):
+        """Tax of every amount, for a percentage, a Tax or one of them per amount."""
+        if isinstance(percent, (list, tuple)):
+            percent = [getattr(p, "percent", p) for p in percent]
+        return self._scale(getattr(percent, "percent", percent), 100, float_as_str=True)
+
+    def with_tax(self, percent):
+        """Amounts with their tax added, see tax()."""
+        return self + self.tax(percent)
+
+    def sum_by_currency(self):
+        """Sums of the amounts as Money, by currency code."""
+        sums = {}
+        for amount, code in izip(self.amounts, self.currencies):
+            sums[code] = sums.get(code, 0) + amount
+        return dict((code, _money(Decimal(amount).scaleb(-DECIMAL_PLACES), Currency(code)))
+                    for code, amount in sums.items())
+
+    def sum(self):
+        """Sum of all amounts as Money, which have to be in one currency."""
+        sums = self.sum_by_currency()
+        if len(sums) > 1:
+            raise TypeError("Cannot add or subtract Money in different currencies.")
+        return sums and sums.values()[0] or Money(0)
+
+    def _compare(self, other, compare, equality=False):
+        if isinstance(other, (Money, MoneyArray)):
+            amounts, currencies = self._operand(other)
+            if equality:
+                return [a == b and c == d or (a == 0 and b == 0) for a, b, c, d
+                        in izip(self.amounts, amounts, self.currencies, currencies)]
+            self._same_currencies(currencies, "compare")
+            return [compare(a, b) for a, b in izip(self.amounts, amounts)]
+        numerator, denominator = _ratio(other, float_as_str=True)
+        if equality:  # Money only equals the number 0, when it is 0 itself
+            return [a == 0 and numerator == 0 for a in self.amounts]
+        return [compare(a * denominator, numerator * _SCALE) for a in self.amounts]
+
+    def __eq__(self, other):
+        return self._compare(other, lambda a, b: a == b, equality=True)
+
+    def __ne__(self, other):
+        return [not equal for equal in self.__eq__(other)]
+
+    def __lt__(self, other):
+        return self._compare(other, lambda a, b: a < b)
+
+    def __le__(self, other):
+        return self._compare(other, lambda a, b: a <= b)
+
+    def __gt__(self, other):
+        return self._compare(other, lambda a, b: a > b)
+
+    def __ge__(self, other):
+        return self._compare(other, lambda a, b: a >= b)
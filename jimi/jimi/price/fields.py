@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from django import forms
 from django.db import models
 from django.core.exceptions import ValidationError
 from decimal import Decimal, InvalidOperation
@@ -194,35 +195,52 @@ DEFAULT_CURRENCY = settings.SHOP_CURRENCY
 
 @python_2_unicode_compatible
 class Currency(object):
-        """Currency: ISO code, name and abbreviation"""
-        def __init__(self, *args, **kwargs):
-                self.code = None
+        """Currency: ISO code, name and abbreviation
+
+        There is a single Currency object per code, shared by all money in
+        that currency. Asking for a currency again is a dict lookup."""
+        __slots__ = ("code", "name", "abbr")
+        _instances = {}  # Code, or a string asked for before -> Currency
+
+        def __new__(cls, *args, **kwargs):
+                if len(args) == 1 and not kwargs:
+                        if isinstance(args[0], Currency):
+                                return args[0]
+                        if isinstance(args[0], basestring) and args[0] in cls._instances:
+                                return cls._instances[args[0]]
+                code = cls._code(*args, **kwargs)
+                currency = cls._instances.get(code)
+                if currency is None:
+                        currency = object.__new__(cls)
+                        currency.code = code
+                        currency.name = CURRENCIES[code]["name"]
+                        currency.abbr = CURRENCIES[code]["abbr"] or code
+                        cls._instances[code] = currency
+                if len(args) == 1 and isinstance(args[0], basestring):
+                        cls._instances[args[0]] = currency
+                return currency
+
+        @staticmethod
+        def _code(*args, **kwargs):
+                """ISO code of the currency asked for, e.g. by a lower case code."""
                 if len(args) == 1:
-                        try:
-                                _c = str(args[0]).upper()
-                                self.code = CURRENCIES[_c]["code"]
-                                self.name = CURRENCIES[self.code]["name"]
-                                self.abbr = CURRENCIES[self.code]["abbr"] or self.code
-                        except:
+                        code = str(args[0]).upper()
+                        if code not in CURRENCIES:
                                 raise ValueError("Currency %s not defined." % args[0])
+                        return code
                 elif len(args) > 1:
-                        raise ValueError("Cannot figure out how to convert %s to currency." % args)
-                else:  # len(args) == 0
-                        if kwargs:
-                                if "code" in kwargs:
-                                        _c = kwargs["code"].upper()
-                                        if _c in CURRENCIES:
-                                                self.code = CURRENCIES[_c]["code"]
-                                                self.name = CURRENCIES[self.code]["name"]
-                                                self.abbr = CURRENCIES[self.code]["abbr"] or self.code
-                                        else:
-                                                raise ValueError("Currency %s not defined." % kwargs["code"])
-                        else:
-                                self.code = DEFAULT_CURRENCY
-                                self.name = CURRENCIES[self.code]["name"]
-                                self.abbr = CURRENCIES[self.code]["abbr"] or self.code
-                if not self.code:
-                        raise ValueError("Could not figure out what currency this is supposed to be: %s %s" % (args, kwargs))
+                        raise ValueError("Cannot figure out how to convert %s to currency." % (args,))
+                elif not kwargs:
+                        return DEFAULT_CURRENCY
+                elif "code" in kwargs:
+                        code = kwargs["code"].upper()
+                        if code not in CURRENCIES:
+                                raise ValueError("Currency %s not defined." % kwargs["code"])
+                        return code
+                raise ValueError("Could not figure out what currency this is supposed to be: %s %s" % (args, kwargs))
+
+        def __reduce__(self):
+                return (Currency, (self.code,))
 
         def __repr__(self):
                 return force_text(self.code)
@@ -231,20 +249,29 @@ class Currency(object):
                 return force_text(self.code)
 
         def __eq__(self, other):
-                return (isinstance(other, Currency) and
-                                self.code == other.code)
+                return self is other or (isinstance(other, Currency) and
+                                         self.code == other.code)
 
         def __ne__(self, other):
                 result = self.__eq__(other)
                 return not result
 
+        def __hash__(self):
+                return hash(self.code)
+
 
 @python_2_unicode_compatible
 class Money(object):
         """Money: Amount and currency.
 
         Some inspiration and code taken from python-money,
-        https://bitbucket.org/acoobe/python-money/"""
+        https://bitbucket.org/acoobe/python-money/
+
+        Money objects keep nothing but their two slots. Results of
+        arithmetic are made with _money(), skipping the checks of
+        __init__."""
+        __slots__ = ("amount", "currency")
+
         # def old__init__(self, amount=Decimal('0.0'), currency=None):
         #     if not isinstance(amount, Decimal):
         #         amount = Decimal(str(amount))
@@ -257,6 +284,15 @@ class Money(object):
         #         self.currency = currency
 
         def __init__(self, *args, **kwargs):
+                if kwargs and not args:  # Money(amount=..., currency=...), the usual way
+                        self.amount = Decimal(kwargs.get("amount", "0.0"))
+                        if "currency" in kwargs:
+                                self.currency = Currency(kwargs["currency"])
+                        elif "code" in kwargs:
+                                self.currency = Currency(kwargs["code"])
+                        else:
+                                self.currency = Currency()
+                        return
                 self.amount = None
                 self.currency = None
                 if len(args) == 1:
@@ -321,20 +357,21 @@ class Money(object):
                 result = self.__eq__(other)
                 return not result
 
+        def __reduce__(self):
+                return (_money, (self.amount, self.currency))
+
         def __pos__(self):
-                return Money(amount=self.amount, currency=self.currency)
+                return _money(self.amount, self.currency)
 
         def __neg__(self):
-                return Money(amount=-self.amount, currency=self.currency)
+                return _money(-self.amount, self.currency)
 
         def __add__(self, other):
                 if not isinstance(other, Money):
                         raise TypeError('Cannot add or subtract a ' +
                                                         'Money (%s) and non-Money (type(%s) == %s) instance.' % (self, other, type(other)))
-                if self.currency == other.currency:
-                        return Money(
-                                amount=self.amount + other.amount,
-                                currency=self.currency)
+                if self.currency is other.currency or self.currency == other.currency:
+                        return _money(self.amount + other.amount, self.currency)
                 raise TypeError('Cannot add or subtract two Money ' +
                                                 'instances with different currencies.')
 
@@ -344,12 +381,12 @@ class Money(object):
         def __mul__(self, other):
                 if isinstance(other, Money):
                         raise TypeError('Cannot multiply two Money instances.')
-                return Money(amount=self.amount * Decimal(other), currency=self.currency)
+                return _money(self.amount * Decimal(other), self.currency)
 
         def __div__(self, other):
                 if isinstance(other, Money):
                         raise TypeError('Cannot divide two Money instances.')
-                return Money(amount=self.amount / Decimal(other), currency=self.currency)
+                return _money(self.amount / Decimal(other), self.currency)
 
         def __rmod__(self, other):
                 """
@@ -364,8 +401,7 @@ class Money(object):
                 if isinstance(other, Money):
                         raise TypeError('Invalid __rmod__ operation')
                 else:
-                        return Money(amount=Decimal(str(other)) * self.amount / 100,
-                                                 currency=self.currency)
+                        return _money(Decimal(str(other)) * self.amount / 100, self.currency)
 
         def __float__(self):
                 return float(self.amount)
@@ -408,8 +444,76 @@ class Money(object):
                 return self.__repr__
 
 
+def _money(amount, currency, _new=object.__new__):
+        """Money of a Decimal amount and a Currency, without converting either."""
+        money = _new(Money)
+        money.amount = amount
+        money.currency = currency
+        return money
+
+
+PARSE_CACHE_SIZE = 1024
+_parsed = {}  # Recently parsed "SEK 12.00" strings -> (amount, Currency)
+
+
+def parse_money(value, error_messages):
+        """Money of a "SEK 12.00" string, None for None.
+
+        Stored prices repeat a lot, so the amount and currency of recent
+        strings are cached. Every call still returns a Money of its own."""
+        parsed = _parsed.get(value) if isinstance(value, basestring) else None
+        if parsed is not None:
+                return _money(*parsed)
+        try:
+                c, a = value.split(" ")
+        except ValueError:
+                msg = error_messages['invalid_format'] % value
+                raise ValidationError(msg)
+        except AttributeError:  # NoneType cannot be split
+                return None
+        try:
+                amount = Decimal(a)
+        except InvalidOperation:
+                msg = error_messages['invalid_amount'] % value
+                raise ValidationError(msg)
+        if amount > Decimal("999999999999999.99"):
+                msg = error_messages['invalid_amount'] % value
+                raise ValidationError(msg)
+        try:
+                currency = CURRENCIES[c.upper()]['code']
+        except:
+                msg = error_messages['invalid_currency'] % value
+                raise ValidationError(msg)
+        if len(_parsed) >= PARSE_CACHE_SIZE:
+                _parsed.clear()
+        _parsed[value] = parsed = (amount, Currency(currency))
+        return _money(*parsed)
+
+
+class ParsedMoneyDescriptor(object):
+        """Money of a MoneyField, parsed from the stored string on first access."""
+        def __init__(self, field):
+                self.field = field
+
+        def __get__(self, instance, owner):
+                if instance is None:
+                        return self
+                value = instance.__dict__.get(self.field.attname)
+                if value is None or value.__class__ is Money:
+                        return value
+                value = instance.__dict__[self.field.attname] = self.field.to_python(value)
+                return value
+
+        def __set__(self, instance, value):
+                instance.__dict__[self.field.attname] = value
+
+
 class MoneyField(models.CharField):
-        """Money stored in Django database"""
+        """Money stored in Django database
+
+        Values are stored as "SEK 12.00" strings. Instances keep the string
+        as loaded and parse it on first access, see ParsedMoneyDescriptor,
+        so rows whose money is never looked at cost nothing to convert."""
         empty_strings_allowed = False
         default_error_messages = {
                 'invalid_format': _("'%s' value has an invalid format. It must be "
@@ -422,40 +526,145 @@ class MoneyField(models.CharField):
                 }
         description = "Money: Amount and currency"
 
-        __metaclass__ = models.SubfieldBase
-
         def __init__(self, *args, **kwargs):
                 kwargs['max_length'] = 21  # up to 999999999999.99 XXX
                 super(MoneyField, self).__init__(*args, **kwargs)
 
+        def contribute_to_class(self, cls, name):
+                super(MoneyField, self).contribute_to_class(cls, name)
+                setattr(cls, self.name, ParsedMoneyDescriptor(self))
+
         def to_python(self, value):
                 if isinstance(value, Money):
                         return value
-                try:
-                        c, a = value.split(" ")
-                except ValueError:
-                        msg = self.error_messages['invalid_format'] % value
-                        raise ValidationError(msg)
-                except AttributeError:  # NoneType cannot be split
-                        return None
-                try:
-                        amount = Decimal(a)
-                except InvalidOperation:
-                        msg = self.error_messages['invalid_amount'] % value
-                        raise ValidationError(msg)
-                if amount > Decimal("999999999999999.99"):
-                        msg = self.error_messages['invalid_amount'] % value
-                        raise ValidationError(msg)
-                try:
-                        currency = CURRENCIES[c.upper()]['code']
-                except:
-                        msg = self.error_messages['invalid_currency'] % value
-                        raise ValidationError(msg)
-                return Money(amount=Decimal(amount), currency=Currency(currency))
+                return parse_money(value, self.error_messages)
+
+        def get_prep_value(self, value):
+                value = self.to_python(value)
+                return value if value is None else force_text(value)
 
         def value_to_string(self, obj):
                 val = self._get_val_from_obj(obj)
                 return self.get_prep_value(val)
 
+
+class CurrencyField(models.CharField):
+        """ISO code of the currency of a DecimalMoneyField"""
+        description = "Currency code"
+
+        def __init__(self, *args, **kwargs):
+                kwargs['max_length'] = 3
+                kwargs.setdefault('default', DEFAULT_CURRENCY)
+                super(CurrencyField, self).__init__(*args, **kwargs)
+
+        def south_field_triple(self):
+                from south.modelsinspector import introspector
+                args, kwargs = introspector(self)
+                return ("django.db.models.fields.CharField", args, kwargs)
+
+
+class MoneyDescriptor(object):
+        """Money of the amount and the currency attributes of a DecimalMoneyField."""
+        def __init__(self, field):
+                self.field = field
+
+        def __get__(self, instance, owner):
+                if instance is None:
+                        return self
+                return self.field.money(instance.__dict__.get(self.field.attname),
+                                        getattr(instance, self.field.currency_field.attname))
+
+        def __set__(self, instance, value):
+                if not isinstance(value, Money):
+                        value = self.field.to_python(value)
+                if isinstance(value, Money):
+                        instance.__dict__[self.field.attname] = self.field.quantize(value.amount)
+                        setattr(instance, self.field.currency_field.attname, value.currency.code)
+                else:
+                        instance.__dict__[self.field.attname] = self.field.quantize(value)
+
+
+class DecimalMoneyField(models.DecimalField):
+        """Money stored as a DECIMAL amount and a CHAR(3) currency code
+
+        The amount column is the field itself, the currency goes to a
+        CurrencyField added next to it, named like the field with a
+        _currency suffix. Instances show both as one Money attribute, so
+        the database can filter, order and aggregate prices while Python
+        code still sees Money. See jimi.price.managers.MoneyQuerySet for
+        lookups and aggregates respecting the currency."""
+        empty_strings_allowed = False
+        default_error_messages = MoneyField.default_error_messages
+        description = "Money: Decimal amount and currency code"
+
+        def __init__(self, *args, **kwargs):
+                kwargs.setdefault('max_digits', 17)  # up to 999999999999999.99
+                kwargs.setdefault('decimal_places', 2)
+                super(DecimalMoneyField, self).__init__(*args, **kwargs)
+                self._exponent = Decimal(10) ** -self.decimal_places
+
+        def contribute_to_class(self, cls, name):
+                super(DecimalMoneyField, self).contribute_to_class(cls, name)
+                self.currency_field = CurrencyField(editable=False,
+                                                    null=self.null,
+                                                    db_column=self.db_column and "%s_currency" % self.db_column)
+                # Ordered between the amount and the field before it, so that
+                # Model(price=Money(...)) sets the default currency first
+                self.currency_field.creation_counter = self.creation_counter - 0.5
+                cls.add_to_class("%s_currency" % name, self.currency_field)
+                setattr(cls, self.name, MoneyDescriptor(self))
+
+        def money(self, amount, currency):
+                """Money of an amount and a currency code as read from the database."""
+                if amount is None:
+                        return None
+                return _money(self.quantize(self.to_python(amount)), Currency(currency or DEFAULT_CURRENCY))
+
+        def quantize(self, amount):
+                """Amount rounded to the decimal places of the column, as stored."""
+                if isinstance(amount, Decimal):
+                        return amount.quantize(self._exponent)
+                return amount
+
+        def to_python(self, value):
+                if value is None or isinstance(value, (Money, Decimal)):
+                        return value
+                if isinstance(value, basestring) and " " in value.strip():  # As in a MoneyField
+                        return parse_money(value.strip(), self.error_messages)
+                return super(DecimalMoneyField, self).to_python(value)
+
+        def get_prep_value(self, value):
+                if isinstance(value, Money):
+                        value = value.amount
+                return super(DecimalMoneyField, self).get_prep_value(value)
+
+        def get_db_prep_save(self, value, connection):
+                if isinstance(value, Money):
+                        value = value.amount
+                return super(DecimalMoneyField, self).get_db_prep_save(value, connection)
+
+        def get_prep_lookup(self, lookup_type, value):
+                if isinstance(value, Money):
+                        value = value.amount
+                elif lookup_type in ('in', 'range'):
+                        value = [v.amount if isinstance(v, Money) else v for v in value]
+                return super(DecimalMoneyField, self).get_prep_lookup(lookup_type, value)
+
+        def value_to_string(self, obj):
+                value = self._get_val_from_obj(obj)
+                return value is not None and force_text(value.amount) or None
+
+        def formfield(self, **kwargs):
+                # Entered like a MoneyField, "SEK 12.00"
+                defaults = {'form_class': forms.CharField, 'max_length': 21}
+                defaults.update(kwargs)
+                return models.Field.formfield(self, **defaults)
+
+        def south_field_triple(self):
+                # Frozen as a plain DecimalField next to its CurrencyField
+                from south.modelsinspector import introspector
+                args, kwargs = introspector(self)
+                return ("django.db.models.fields.DecimalField", args, kwargs)
+
 from south.modelsinspector import add_introspection_rules
 add_introspection_rules([], ["^jimi\.price\.fields\.MoneyField"])
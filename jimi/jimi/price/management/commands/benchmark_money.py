@@ -0,0 +1,100 @@
+import sys
+import timeit
+from decimal import Decimal
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from jimi.price.arrays import MoneyArray
+from jimi.price.fields import Money, MoneyField, Currency, ParsedMoneyDescriptor
+
+
+def cart_lines(count):
+    """Prices and quantities of a cart, as loaded from its items."""
+    return [(Money(amount=Decimal("%d.%02d" % (10 + i, i)), currency="SEK"), 1 + i % 3)
+            for i in range(count)]
+
+
+def cart_total(lines):
+    total = Money(0, "SEK")
+    for price, quantity in lines:
+        total += price * quantity
+    return total
+
+
+def stored_field():
+    field = MoneyField()
+    field.set_attributes_from_name("price")
+    return field
+
+
+class Stored(object):
+    """Instance with a MoneyField, set from a row the way a model is."""
+    price = ParsedMoneyDescriptor(stored_field())
+
+    def __init__(self, pk, price):
+        self.pk = pk
+        self.price = price
+
+
+def stored_rows(count):
+    """Rows of a model with a MoneyField as read from the database, few distinct prices."""
+    return [(i, "SEK %d.%02d" % (10 + i % 40, i % 4 * 25)) for i in range(count)]
+
+
+def load(model, rows):
+    """Instances made of rows the way querysets make them, their prices looked at."""
+    return [model(*row).price for row in rows]
+
+
+def size(money):
+    """Bytes taken by a Money object itself, without its amount and currency."""
+    attributes = getattr(money, "__dict__", None)
+    return sys.getsizeof(money) + (attributes is not None and sys.getsizeof(attributes) or 0)
+
+
+class Command(NoArgsCommand):
+    help = ("Time Money arithmetic, construction and loading from rows, and show the memory"
+            " and Currency objects they take.")
+    option_list = NoArgsCommand.option_list + (
+        make_option("--lines",
+                    dest="lines",
+                    type="int",
+                    default=50,
+                    help="Number of lines of the summed cart."),
+        make_option("--repeat",
+                    dest="repeat",
+                    type="int",
+                    default=2000,
+                    help="Number of times every measurement is run."),
+        make_option("--rows",
+                    dest="rows",
+                    type="int",
+                    default=10000,
+                    help="Number of rows with a MoneyField loaded at once."),
+    )
+
+    def handle_noargs(self, **options):
+        lines = cart_lines(options.get("lines") or 50)
+        repeat = options.get("repeat") or 2000
+        rows = stored_rows(options.get("rows") or 10000)
+        field = MoneyField()
+        results = [price * quantity for price, quantity in lines]
+        prices = MoneyArray.from_money(price for price, quantity in lines)
+        quantities = [quantity for price, quantity in lines]
+        timings = (
+            ("Cart of %d lines summed" % len(lines), lambda: cart_total(lines)),
+            ("... as a MoneyArray", lambda: (prices * quantities).sum()),
+            ("25%% tax on %d lines" % len(lines), lambda: [p + 25 % p for p, q in lines]),
+            ("... as a MoneyArray", lambda: prices.with_tax(25)),
+            ("Money(amount, currency)", lambda: Money(amount=Decimal("12.00"), currency="SEK")),
+            ("Money + Money", lambda: lines[0][0] + lines[1][0]),
+            ("Currency(code)", lambda: Currency("SEK")),
+            ("MoneyField.to_python(string)", lambda: field.to_python("SEK 12.00")),
+        )
+        for name, function in timings:
+            seconds = min(timeit.repeat(function, number=repeat, repeat=3)) / repeat
+            self.stdout.write("%-30s %8.2f us\n" % (name, seconds * 1e6))
+        seconds = min(timeit.repeat(lambda: load(Stored, rows), number=1, repeat=3))
+        self.stdout.write("%-30s %8.2f ms\n" % ("Load %d rows" % len(rows), seconds * 1e3))
+        self.stdout.write("%-30s %8d bytes\n" % ("Money object", size(results[0])))
+        self.stdout.write("%-30s %8d for %d results\n" % (
+            "Currency objects", len(set(id(m.currency) for m in results)), len(results)))
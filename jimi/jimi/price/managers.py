@@ -0,0 +1,106 @@
+"""
+Queries on models with DecimalMoneyFields.
+
+Amounts are only comparable within a currency. Filtering on a money field
+by Money values therefore also filters on its currency column: a price
+below Money(10, "SEK") is a price in SEK below 10. Only keyword
+arguments are expanded, Q objects and F expressions see plain amounts.
+Updates set both columns, and aggregates are computed per currency.
+Amounts order correctly within one currency, so filter or order by the
+currency column first, e.g. order_by('price_currency', 'price').
+"""
+from decimal import Decimal
+from django.db import models
+from django.db.models import Sum
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.sql.constants import QUERY_TERMS
+from jimi.price.fields import DecimalMoneyField, Money
+
+
+def money_field(model, lookup):
+    """DecimalMoneyField a lookup like 'product__price__lt' is on and its path, or (None, None)."""
+    path = lookup.split(LOOKUP_SEP)
+    if len(path) > 1 and path[-1] in QUERY_TERMS:
+        path = path[:-1]
+    field = None
+    for name in path:
+        if model is None:
+            return None, None
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None, None
+        model = field.rel and field.rel.to or None
+    if not isinstance(field, DecimalMoneyField):
+        return None, None
+    return field, path
+
+
+def _currency(values):
+    """Currency code of Money values, all of which have to be in the same currency."""
+    codes = set(v.currency.code for v in values if isinstance(v, Money))
+    if len(codes) > 1:
+        raise ValueError("Cannot compare amounts in different currencies: %s." % ", ".join(sorted(codes)))
+    return codes and codes.pop() or None
+
+
+class MoneyQuerySet(QuerySet):
+    """QuerySet turning Money in lookups and updates into amount and currency."""
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        for lookup, value in kwargs.items():
+            if isinstance(value, (list, tuple)):
+                code = _currency(value)
+            else:
+                code = isinstance(value, Money) and value.currency.code or None
+            if code is None:
+                continue
+            field, path = money_field(self.model, lookup)
+            if field is not None:
+                currency = LOOKUP_SEP.join(path[:-1] + [field.currency_field.name])
+                if kwargs.setdefault(currency, code) != code:
+                    raise ValueError("Cannot compare amounts in different currencies: %s, %s."
+                                     % (kwargs[currency], code))
+        return super(MoneyQuerySet, self)._filter_or_exclude(negate, *args, **kwargs)
+
+    def update(self, **kwargs):
+        for name, value in kwargs.items():
+            if isinstance(value, Money):
+                field = self.model._meta.get_field(name)
+                if isinstance(field, DecimalMoneyField):
+                    kwargs[field.currency_field.name] = value.currency.code
+        return super(MoneyQuerySet, self).update(**kwargs)
+    update.alters_data = True
+
+    def money_aggregate(self, lookup, function=Sum):
+        """
+        Aggregate of a DecimalMoneyField, by default its sum, computed by
+        the database per currency. Returns a dict of Money by currency
+        code, e.g. {"SEK": Money(...), "EUR": Money(...)}, with no entry
+        for currencies having no amount.
+        """
+        field, path = money_field(self.model, lookup)
+        if field is None:
+            raise ValueError("%s is not a DecimalMoneyField." % lookup)
+        currency = LOOKUP_SEP.join(path[:-1] + [field.currency_field.name])
+        amounts = {}
+        rows = self.order_by().values_list(currency).annotate(function(LOOKUP_SEP.join(path)))
+        for code, amount in rows:
+            if amount is not None:
+                if not isinstance(amount, Decimal):  # E.g. averages, as float
+                    amount = Decimal(str(amount)).quantize(Decimal(10) ** -field.decimal_places)
+                amounts[code] = Money(amount=amount, currency=code)
+        return amounts
+
+
+class MoneyManager(models.Manager):
+    """Manager of models with DecimalMoneyFields, see MoneyQuerySet."""
+
+    def get_queryset(self):
+        return MoneyQuerySet(self.model, using=self._db)
+    get_query_set = get_queryset
+
+    def money_aggregate(self, *args, **kwargs):
+        return self.get_queryset().money_aggregate(*args, **kwargs)
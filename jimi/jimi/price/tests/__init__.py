@@ -1 +1 @@
-from models import CurrencyTest, MoneyTest, MoneyFieldTest
+from tests import CurrencyTest, MoneyTest, MoneyArrayTest, MoneyFieldTest, DecimalMoneyFieldTest
@@ -1,7 +1,16 @@
 from django.db import models
 from jimi.price import fields
+from jimi.price.managers import MoneyManager
 
 class TestModel(models.Model):
     """Simple model to test MoneyField"""
     ident = models.IntegerField(primary_key=True, unique=True)
     price = fields.MoneyField(blank=True)
+
+
+class DecimalTestModel(models.Model):
+    """Simple model to test DecimalMoneyField"""
+    ident = models.IntegerField(primary_key=True, unique=True)
+    price = fields.DecimalMoneyField(null=True, blank=True)
+
+    objects = MoneyManager()
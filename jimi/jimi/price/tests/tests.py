@@ -1,13 +1,17 @@
+import copy
+import pickle
 from django.test import TestCase
 from decimal import Decimal
 from jimi.price import fields
+from jimi.price.arrays import MoneyArray
 
 # All this is needed for temporary testing models
 from django.conf import settings
 from django.core.management import call_command
 from django.db.models import loading
+from django.db.models import Max, Min
 
-from models import TestModel
+from models import TestModel, DecimalTestModel
 
 
 class CurrencyTest(TestCase):
@@ -35,6 +39,15 @@ class CurrencyTest(TestCase):
         self.name = str(self.currency)
         self.assertEqual(self.name, fields.CURRENCIES[fields.DEFAULT_CURRENCY]["code"])
 
+    def test_flyweight(self):
+        """Testing if there is a single Currency object per code"""
+        currency = fields.Currency("SEK")
+        self.assertTrue(fields.Currency("sek") is currency)
+        self.assertTrue(fields.Currency(code="SEK") is currency)
+        self.assertTrue(fields.Currency(currency) is currency)
+        self.assertTrue(pickle.loads(pickle.dumps(currency)) is currency)
+        self.assertTrue(copy.deepcopy(currency) is currency)
+
 
 class MoneyTest(TestCase):
     def test_init_without_currency(self):
@@ -46,6 +59,22 @@ class MoneyTest(TestCase):
     def test_str(self):
         pass  # TODO string conversion
 
+    def test_slots(self):
+        """Testing if Money keeps nothing but amount and currency"""
+        self.price = fields.Money(amount="1.50", currency="SEK")
+        self.assertFalse(hasattr(self.price, "__dict__"))
+        total = self.price * 3 + self.price
+        self.assertEqual(total, fields.Money("6.00", "SEK"))
+        self.assertTrue(total.currency is self.price.currency)
+
+    def test_pickle(self):
+        """Testing if Money survives pickling and copying"""
+        self.price = fields.Money(amount="1.50", currency="EUR")
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(pickle.loads(pickle.dumps(self.price, protocol)), self.price)
+        self.assertEqual(copy.deepcopy(self.price), self.price)
+        self.assertTrue(copy.copy(self.price).currency is self.price.currency)
+
     def test_equality(self):
         """Testing if == works"""
         self.price1 = fields.Money(amount=3.14, currency="USD")
@@ -186,7 +215,55 @@ class MoneyTest(TestCase):
         pass  # TODO hashing
 
 
-class MoneyFieldTest(TestCase):
+class MoneyArrayTest(TestCase):
+    def setUp(self):
+        self.money = [fields.Money(amount=a, currency=c) for a, c in
+                      (("12.34", "SEK"), ("0.05", "SEK"), ("-7.50", "SEK"), ("199.99", "EUR"))]
+        self.prices = MoneyArray.from_money(self.money)
+
+    def test_conversion(self):
+        """Tests that arrays hold hundredths and give back the Money they were made of."""
+        self.assertEqual(list(self.prices.amounts), [1234, 5, -750, 19999])
+        self.assertEqual(list(self.prices), self.money)
+        self.assertEqual(list(MoneyArray([125, 3], "EUR")),
+                         [fields.Money("1.25", "EUR"), fields.Money("0.03", "EUR")])
+        # Rounded half to even, like a decimal column
+        self.assertEqual(list(MoneyArray.from_money([fields.Money("0.125", "SEK")]).amounts), [12])
+
+    def test_arithmetic(self):
+        """Tests that batch arithmetic equals Money arithmetic, rounded to hundredths."""
+        quantities = [3, 1, 2, 4]
+        self.assertEqual(list(self.prices * quantities),
+                         [m * q for m, q in zip(self.money, quantities)])
+        self.assertEqual(list(self.prices + self.prices * 2), [m * 3 for m in self.money])
+        self.assertEqual(list(-self.prices), [-m for m in self.money])
+        self.assertEqual([m.amount for m in 12.5 % self.prices],
+                         [Decimal("1.54"), Decimal("0.01"), Decimal("-0.94"), Decimal("25.00")])
+        self.assertEqual(list(self.prices.with_tax(25)),
+                         [fields.Money("15.42", "SEK"), fields.Money("0.06", "SEK"),
+                          fields.Money("-9.38", "SEK"), fields.Money("249.99", "EUR")])
+        self.assertRaises(TypeError, lambda: self.prices + self.prices[::-1])
+        self.assertRaises(TypeError, lambda: self.prices * self.prices)
+
+    def test_sums(self):
+        """Tests that sums are kept apart by currency."""
+        self.assertEqual(self.prices.sum_by_currency(),
+                         {"SEK": fields.Money("4.89", "SEK"), "EUR": fields.Money("199.99", "EUR")})
+        self.assertEqual(self.prices[:3].sum(), fields.Money("4.89", "SEK"))
+        self.assertRaises(TypeError, self.prices.sum)
+
+    def test_comparisons(self):
+        """Tests that comparisons work element by element, like Money."""
+        sek = self.prices[:3]
+        self.assertEqual(sek > fields.Money("1.00", "SEK"), [True, False, False])
+        self.assertEqual(sek <= 0.05, [False, True, True])
+        self.assertEqual(sek == sek * 1, [True, True, True])
+        self.assertEqual(sek != MoneyArray([1234, 0, 0], "SEK"), [False, True, True])
+        self.assertRaises(TypeError, lambda: self.prices < fields.Money("1.00", "SEK"))
+
+
+class AppTestCase(TestCase):
+    """TestCase with the test models of this app in the db."""
     apps = ("jimi.price.tests",)
 
     def _pre_setup(self):
@@ -197,15 +274,17 @@ class MoneyFieldTest(TestCase):
         loading.cache.loaded = False
         call_command('syncdb', interactive=False, migrate=False, verbose=0)
         # Call the original method that does the fixtures etc.
-        super(MoneyFieldTest, self)._pre_setup()
+        super(AppTestCase, self)._pre_setup()
 
     def _post_teardown(self):
         # Call the original method.
-        super(MoneyFieldTest, self)._post_teardown()
+        super(AppTestCase, self)._post_teardown()
         # Restore the settings.
         settings.INSTALLED_APPS = self._original_installed_apps
         loading.cache.loaded = False
 
+
+class MoneyFieldTest(AppTestCase):
     def setUp(self):
         a = TestModel(ident=1, price=fields.Money(amount="11.11", currency="USD"))
         a.save()
@@ -216,3 +295,61 @@ class MoneyFieldTest(TestCase):
 #        res = TestModel.objects.get(price__gt=fields.Money(amount=100, currency="USD"))
         res = TestModel.objects.filter(ident__exact=1)
         self.assertEqual(res[0].price, fields.Money("11.11", "USD"))
+
+    def test_parse_once(self):
+        """Tests that stored strings are parsed on first access, into Money of their own."""
+        a = TestModel.objects.get(ident=1)
+        self.assertEqual(a.__dict__["price"], "USD 11.11")
+        price = a.price
+        self.assertEqual(price, fields.Money("11.11", "USD"))
+        self.assertTrue(a.price is price)
+        self.assertFalse(TestModel.objects.get(ident=1).price is price)
+        a.price = fields.Money("1.00", "SEK")
+        a.save()
+        self.assertEqual(TestModel.objects.get(ident=1).price, fields.Money("1.00", "SEK"))
+
+
+class DecimalMoneyFieldTest(AppTestCase):
+    def setUp(self):
+        for ident, amount, currency in ((1, "11.11", "USD"), (2, "200.02", "USD"),
+                                        (3, "50.00", "EUR"), (4, "7.50", "USD")):
+            DecimalTestModel(ident=ident, price=fields.Money(amount=amount, currency=currency)).save()
+        DecimalTestModel(ident=5, price=None).save()
+
+    def test_columns(self):
+        """Tests that amount and currency are stored apart and read back as Money."""
+        row = DecimalTestModel.objects.filter(ident=3).values("price", "price_currency")[0]
+        self.assertEqual(row, {"price": Decimal("50.00"), "price_currency": "EUR"})
+        self.assertEqual(DecimalTestModel.objects.get(ident=3).price, fields.Money("50.00", "EUR"))
+        self.assertEqual(DecimalTestModel.objects.get(ident=5).price, None)
+        a = DecimalTestModel(ident=6, price="SEK 1.50")
+        self.assertEqual(a.price, fields.Money("1.50", "SEK"))
+        a.price = Decimal("2")
+        self.assertEqual(a.price, fields.Money("2.00", "SEK"))
+
+    def test_lookups(self):
+        """Tests that Money lookups compare amounts within their currency."""
+        usd = lambda amount: fields.Money(amount=amount, currency="USD")
+        filtered = lambda **kwargs: sorted(DecimalTestModel.objects.filter(**kwargs).values_list("ident", flat=True))
+        self.assertEqual(filtered(price__gt=usd(10)), [1, 2])
+        self.assertEqual(filtered(price__lte=usd("11.11")), [1, 4])
+        self.assertEqual(filtered(price__range=(usd(5), usd(100))), [1, 4])
+        self.assertEqual(filtered(price=fields.Money("50", "EUR")), [3])
+        self.assertEqual(filtered(price__gt=10), [1, 2, 3])
+        self.assertRaises(ValueError, filtered, price__range=(usd(5), fields.Money("100", "EUR")))
+        ordered = DecimalTestModel.objects.filter(price_currency="USD").order_by("-price")
+        self.assertEqual([m.ident for m in ordered], [2, 1, 4])
+
+    def test_update(self):
+        """Tests that updating with Money sets the currency too."""
+        DecimalTestModel.objects.filter(ident=1).update(price=fields.Money("3.00", "EUR"))
+        self.assertEqual(DecimalTestModel.objects.get(ident=1).price, fields.Money("3.00", "EUR"))
+
+    def test_aggregates(self):
+        """Tests that aggregates are computed by the database per currency."""
+        self.assertEqual(DecimalTestModel.objects.money_aggregate("price"),
+                         {"USD": fields.Money("218.63", "USD"), "EUR": fields.Money("50.00", "EUR")})
+        self.assertEqual(DecimalTestModel.objects.money_aggregate("price", Min)["USD"],
+                         fields.Money("7.50", "USD"))
+        self.assertEqual(DecimalTestModel.objects.filter(price__lt=fields.Money("100", "USD"))
+                         .money_aggregate("price", Max), {"USD": fields.Money("11.11", "USD")})
@@ -0,0 +1,119 @@
+"""
+Database routing between the primary database and read replicas.
+
+Catalog browsing reads a lot and writes little, so within GET and HEAD
+requests the catalog and price models are read from one of the replica
+aliases listed in settings.DATABASE_REPLICAS. Everything else, all writes
+and everything outside of requests (management commands, the shell) use
+the default database.
+
+As soon as a request writes anything it sticks to the primary for the rest
+of the request, and a cookie keeps the following requests of the same
+browser on the primary for REPLICA_LAG_SECONDS, so customers see their own
+changes even if the replicas lag behind.
+
+Caches shared with other requests, like the catalog snapshot or cached
+pages, are filled within read_primary(). A lagging replica would otherwise
+fill them with data older than the versions they are kept under.
+
+To try it locally, add a second SQLite file to django_db.JIMI_DEV, e.g.
+``'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'replica.db',
+'TEST_MIRROR': 'default'}``, copy the primary file over it and set
+``DATABASE_REPLICAS = ('replica',)``.
+"""
+import random
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+
+# Models read from replicas, as (app label, model name).
+REPLICATED_MODELS = set([('catalog', 'node'),
+                         ('catalog', 'variant'),
+                         ('catalog', 'variance'),
+                         ('price', 'country'),
+                         ('price', 'tax')])
+# Writes to these do not pin requests to the primary.
+UNPINNED_MODELS = set([('sessions', 'session')])
+PRIMARY_COOKIE = "jimi_primary"
+
+_state = threading.local()
+
+
+def _key(model):
+    opts = model._meta.concrete_model._meta
+    return opts.app_label, opts.object_name.lower()
+
+
+def replicas():
+    return tuple(getattr(settings, 'DATABASE_REPLICAS', ()))
+
+
+def start_request(replica=None):
+    """Track writes in this thread and read replicated models from ``replica``."""
+    _state.in_request = True
+    _state.replica = replica
+    _state.wrote = False
+
+
+def finish_request():
+    """Stop tracking writes in this thread. Returns whether anything was written."""
+    wrote = getattr(_state, 'wrote', False)
+    _state.in_request = _state.wrote = False
+    _state.replica = None
+    return wrote
+
+
+def current_replica():
+    """Alias replicated models are read from in this thread, or None."""
+    if getattr(_state, 'primary', 0):
+        return None
+    return getattr(_state, 'replica', None)
+
+
+@contextmanager
+def read_primary():
+    """Read everything from the primary database while running a block."""
+    _state.primary = getattr(_state, 'primary', 0) + 1
+    try:
+        yield
+    finally:
+        _state.primary -= 1
+
+
+class ReplicaRouter(object):
+    """Send reads of replicated models to the replica chosen for the request."""
+
+    def db_for_read(self, model, **hints):
+        replica = current_replica()
+        if replica is not None and _key(model) in REPLICATED_MODELS:
+            return replica
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        if getattr(_state, 'in_request', False) and _key(model) not in UNPINNED_MODELS:
+            _state.replica = None  # Read own writes from now on
+            _state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # Replicas hold the same data
+
+    def allow_syncdb(self, db, model):
+        return db not in replicas()
+
+
+class ReplicaMiddleware(object):
+    """Choose a replica for safe requests of browsers that did not write recently."""
+
+    def process_request(self, request):
+        replica = None
+        if (replicas() and request.method in ('GET', 'HEAD') and
+                PRIMARY_COOKIE not in request.COOKIES):
+            replica = random.choice(replicas())
+        start_request(replica)
+
+    def process_response(self, request, response):
+        if finish_request():
+            response.set_cookie(PRIMARY_COOKIE, "1",
+                                max_age=getattr(settings, 'REPLICA_LAG_SECONDS', 5))
+        return response
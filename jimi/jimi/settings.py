@@ -11,6 +11,27 @@ ADMINS = (
 MANAGERS = ADMINS
 
 from django_db import JIMI_DEV as DATABASES
+# Aliases in DATABASES to read the catalog from in GET requests, see jimi.routers
+DATABASE_REPLICAS = ()
+# Seconds a browser keeps reading from the primary after it wrote something
+REPLICA_LAG_SECONDS = 5
+DATABASE_ROUTERS = ['jimi.routers.ReplicaRouter']
+
+# The catalog snapshot, facet index, page cache and stock versions are
+# invalidated through the default cache, so every process serving the shop
+# must share it: a file cache on a single host, memcached across hosts.
+# A per-process cache like locmem is refused unless CATALOG_SINGLE_PROCESS
+# is set, see jimi.catalog.snapshot
+import os.path
+import tempfile
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'jimi-cache'),
+    }
+}
+# Set when only one process serves the shop, e.g. runserver, to allow locmem
+CATALOG_SINGLE_PROCESS = False
 
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
@@ -81,6 +102,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'jimi.routers.ReplicaMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -150,3 +172,14 @@ LOGGING = {
 
 # Jimi specific settings
 SHOP_CURRENCY = "SEK"
+# Number of URL slugs each process keeps resolved in memory
+CATALOG_SLUG_CACHE_SIZE = 1000
+# Seconds rendered catalog pages are cached, 0 to render every request
+CATALOG_PAGE_CACHE_TIMEOUT = 60 * 60
+# Distance between the lft/rght values of catalog trees. Above 1, e.g. 1000,
+# inserts and moves take free numbers instead of shifting the tree; run
+# rebuild_catalog --renumber after changing it
+CATALOG_TREE_GAP = 0
+# Directory the chunks of the catalog sitemap are kept in, defaults to
+# jimi-sitemaps in the temporary directory
+# CATALOG_SITEMAP_ROOT = '/var/cache/jimi/sitemaps'
@@ -11,6 +11,8 @@ urlpatterns = patterns('',
     # url(r'^$', 'jimi.views.home', name='home'),
     url(_(r'^catalog/'), include('jimi.catalog.urls')),
     url(_(r'^cart/'), include('jimi.lists.urls')),
+    url(r'^sitemap\.xml$', 'jimi.catalog.views.sitemap_index'),
+    url(r'^sitemap-(?P<number>\d+)\.xml$', 'jimi.catalog.views.sitemap', name='sitemap'),
 
     # Uncomment the admin/doc line below to enable admin documentation:
     url(r'^admin/doc/', include('django.contrib.admindocs.urls')),